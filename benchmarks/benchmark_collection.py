@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import generate_synthetic_runs
+
+import sequencing_runs_collector.core as core
+import sequencing_runs_collector.fastq_stats as fastq_stats_engine
+import sequencing_runs_collector.illumina as illumina
+import sequencing_runs_collector.parsers.samplesheet as samplesheet
+import sequencing_runs_collector.run_state as run_state
+
+ILLUMINA_LAYOUTS = [layout for layout, instrument_model in generate_synthetic_runs.LAYOUTS.items() if instrument_model in ['MISEQ', 'NEXTSEQ']]
+
+
+def time_call(func, repeats):
+    """
+    Call `func` `repeats` times, and report the best and mean times, along with the result of the last call.
+    """
+    durations = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+    timing = {
+        'best_seconds': round(min(durations), 4),
+        'mean_seconds': round(sum(durations) / len(durations), 4),
+        'repeats': repeats,
+    }
+
+    return timing, result
+
+
+def add_throughput(timing, num_bytes=None, num_reads=None):
+    """
+    Add MB/second and reads/second to a timing, based on its best time.
+    """
+    best_seconds = timing['best_seconds']
+    if num_bytes is not None:
+        timing['num_bytes'] = num_bytes
+        timing['mb_per_second'] = round(num_bytes / 1024 / 1024 / best_seconds, 2) if best_seconds > 0 else None
+    if num_reads is not None:
+        timing['num_reads'] = num_reads
+        timing['reads_per_second'] = round(num_reads / best_seconds) if best_seconds > 0 else None
+
+    return timing
+
+
+def stub_interop():
+    """
+    The synthetic runs don't have InterOp files, which are binary metrics written by the instrument.
+    Runs without an InterOp directory get an empty InterOp summary instead.
+    """
+    get_illumina_interop_summary = illumina.get_illumina_interop_summary
+    def get_illumina_interop_summary_or_stub(run_dir):
+        if not os.path.isdir(os.path.join(run_dir, 'InterOp')):
+            return {'cluster_density': None, 'cluster_density_passed_filter': None}
+        return get_illumina_interop_summary(run_dir)
+    illumina.get_illumina_interop_summary = get_illumina_interop_summary_or_stub
+
+
+def get_first_demultiplexing(run):
+    """
+    Get the output directory, SampleSheet and FASTQ directory of a run's first demultiplexing.
+    """
+    instrument_model = run['instrument_model']
+    demultiplexing_output_dir = sorted(illumina.find_demultiplexing_output_dirs(run['run_dir'], instrument_model))[0]
+    demultiplexing = {
+        'demultiplexing_output_dir': demultiplexing_output_dir,
+        'samplesheet_path': illumina.find_samplesheet(demultiplexing_output_dir, instrument_model),
+        'fastq_dir': illumina.find_fastq_output_dir(demultiplexing_output_dir, instrument_model),
+    }
+
+    return demultiplexing
+
+
+def get_fastq_bytes(fastq_dir):
+    """
+    Total size of the FASTQ files in a directory.
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(fastq_dir) if entry.name.endswith('.fastq.gz'))
+
+
+def benchmark_find_runs(run_parent_dir, repeats):
+    """
+    Time `core.find_runs` over the synthetic runs: 'cold' with an empty run state store, so that every run is new,
+    and 'warm' with a store that already has every run, so that the unchanged run parent directory isn't listed again.
+    """
+    config = {'run_parent_dirs': [run_parent_dir]}
+    def find_runs_cold():
+        run_state_conn = run_state.open_run_state(run_state.IN_MEMORY_RUN_STATE_PATH)
+        return [run for run in core.find_runs(config, run_state_conn) if run is not None]
+    cold_timing, found_runs = time_call(find_runs_cold, repeats)
+    cold_timing['num_runs_found'] = len(found_runs)
+
+    run_state_conn = run_state.open_run_state(run_state.IN_MEMORY_RUN_STATE_PATH)
+    list(core.find_runs(config, run_state_conn))
+    warm_timing, found_runs = time_call(lambda: [run for run in core.find_runs(config, run_state_conn) if run is not None], repeats)
+    warm_timing['num_runs_found'] = len(found_runs)
+
+    return {'find_runs.cold': cold_timing, 'find_runs.warm': warm_timing}
+
+
+def benchmark_parse_samplesheet(runs_by_layout, repeats):
+    """
+    Time `parse_samplesheet` on the SampleSheet of each layout's first demultiplexing.
+    """
+    results = {}
+    for layout in ILLUMINA_LAYOUTS:
+        if layout not in runs_by_layout:
+            continue
+        run = runs_by_layout[layout]
+        samplesheet_path = get_first_demultiplexing(run)['samplesheet_path']
+        timing, _ = time_call(lambda: samplesheet.parse_samplesheet(samplesheet_path, 'ILLUMINA', run['instrument_model']), repeats)
+        results[f"parse_samplesheet.{layout}"] = timing
+
+    return results
+
+
+def benchmark_get_sequenced_libraries(runs_by_layout, config, fastq_stats_pool, repeats):
+    """
+    Time `get_sequenced_libraries_from_samplesheet`, with FASTQ statistics, on each layout's first demultiplexing.
+    """
+    results = {}
+    for layout in ILLUMINA_LAYOUTS:
+        if layout not in runs_by_layout:
+            continue
+        run = runs_by_layout[layout]
+        demultiplexing = get_first_demultiplexing(run)
+        parsed_samplesheet = samplesheet.parse_samplesheet(demultiplexing['samplesheet_path'], 'ILLUMINA', run['instrument_model'])
+        def get_sequenced_libraries():
+            return illumina.get_sequenced_libraries_from_samplesheet(
+                parsed_samplesheet,
+                run['instrument_model'],
+                demultiplexing['demultiplexing_output_dir'],
+                {},
+                collect_fastq_stats=True,
+                num_fastq_stats_processes=fastq_stats_pool['num_processes'],
+                fastq_stats_pool=fastq_stats_pool['pool'],
+                fastq_stats_mode=config['fastq_stats_mode'],
+                fastq_checksum_algorithm=config['fastq_checksum_algorithm'],
+                fastq_reader_backend=config['fastq_reader_backend'],
+            )
+        timing, sequenced_libraries = time_call(get_sequenced_libraries, repeats)
+        num_reads = sum(sequenced_library.get('num_reads', None) or 0 for sequenced_library in sequenced_libraries)
+        results[f"get_sequenced_libraries_from_samplesheet.{layout}"] = add_throughput(timing, get_fastq_bytes(demultiplexing['fastq_dir']), num_reads)
+
+    return results
+
+
+def benchmark_get_fastq_stats(runs_by_layout, config, repeats):
+    """
+    Time `get_fastq_stats` on the largest R1 FASTQ file of the first Illumina run, in a single process.
+    """
+    for layout in ILLUMINA_LAYOUTS:
+        if layout in runs_by_layout:
+            fastq_dir = get_first_demultiplexing(runs_by_layout[layout])['fastq_dir']
+            break
+    else:
+        return {}
+    fastq_paths = [entry.path for entry in os.scandir(fastq_dir) if '_R1_' in entry.name and entry.name.endswith('.fastq.gz')]
+    fastq_path = max(fastq_paths, key=os.path.getsize)
+    timing, fastq_stat = time_call(
+        lambda: illumina.get_fastq_stats(fastq_path, 'library', 'R1', hash_algorithm=config['fastq_checksum_algorithm'], reader_backend=config['fastq_reader_backend']),
+        repeats,
+    )
+    timing['fastq_path'] = os.path.basename(fastq_path)
+
+    return {'get_fastq_stats': add_throughput(timing, os.path.getsize(fastq_path), fastq_stat['counts']['num_reads'])}
+
+
+def benchmark_collect_illumina_run(runs_by_layout, config, fastq_stats_pool, repeats):
+    """
+    Time `collect_illumina_run` end-to-end, without the FASTQ statistics cache or checkpoints, on each layout's run.
+    """
+    results = {}
+    for layout in ILLUMINA_LAYOUTS:
+        if layout not in runs_by_layout:
+            continue
+        run = runs_by_layout[layout]
+        timing, collected_run = time_call(lambda: core.collect_illumina_run(config, run, fastq_stats_pool), repeats)
+        num_reads = sum(
+            sequenced_library.get('num_reads', None) or 0
+            for demultiplexing in collected_run['demultiplexings']
+            for sequenced_library in demultiplexing['sequenced_libraries']
+        )
+        timing['num_demultiplexings'] = len(collected_run['demultiplexings'])
+        results[f"collect_illumina_run.{layout}"] = add_throughput(timing, run['fastq_bytes'], num_reads)
+
+    return results
+
+
+def compare_results(benchmarks, baseline_benchmarks):
+    """
+    Compare each benchmark's best time against a baseline. A speedup above 1 means that this run was faster.
+    """
+    comparison = {}
+    for benchmark_name, timing in benchmarks.items():
+        baseline_timing = baseline_benchmarks.get(benchmark_name, None)
+        if baseline_timing is None or not timing['best_seconds']:
+            continue
+        comparison[benchmark_name] = {
+            'baseline_best_seconds': baseline_timing['best_seconds'],
+            'best_seconds': timing['best_seconds'],
+            'speedup': round(baseline_timing['best_seconds'] / timing['best_seconds'], 3),
+        }
+
+    return comparison
+
+
+def get_git_commit():
+    """
+    Get the commit that the benchmarks were run on, or None if it can't be found.
+    """
+    try:
+        git_rev_parse = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError as e:
+        return None
+    if git_rev_parse.returncode != 0:
+        return None
+
+    return git_rev_parse.stdout.strip()
+
+
+def main(args):
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    stub_interop()
+    config = {
+        'project_id_translation': {},
+        'collect_fastq_stats': True,
+        'num_fastq_stats_collection_processes': args.num_processes,
+        'fastq_stats_mode': args.fastq_stats_mode,
+        'fastq_checksum_algorithm': args.fastq_checksum_algorithm,
+        'fastq_reader_backend': args.fastq_reader_backend,
+    }
+
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmp_dir:
+        run_parent_dir = os.path.join(tmp_dir, 'runs')
+        timestamp_generate_start = time.perf_counter()
+        runs = generate_synthetic_runs.generate_runs(
+            run_parent_dir,
+            args.layouts,
+            num_demultiplexings=args.num_demultiplexings,
+            num_samples=args.num_samples,
+            num_reads=args.num_reads,
+            read_length=args.read_length,
+            compression=args.compression,
+            compresslevel=args.compresslevel,
+            seed=args.seed,
+        )
+        generate_seconds = time.perf_counter() - timestamp_generate_start
+        runs_by_layout = {run['layout']: run for run in runs}
+
+        fastq_stats_pool = core.update_fastq_stats_pool(None, config)
+        try:
+            benchmarks = {}
+            benchmarks.update(benchmark_find_runs(run_parent_dir, args.repeats))
+            benchmarks.update(benchmark_parse_samplesheet(runs_by_layout, args.repeats))
+            benchmarks.update(benchmark_get_fastq_stats(runs_by_layout, config, args.repeats))
+            benchmarks.update(benchmark_get_sequenced_libraries(runs_by_layout, config, fastq_stats_pool, args.repeats))
+            benchmarks.update(benchmark_collect_illumina_run(runs_by_layout, config, fastq_stats_pool, args.repeats))
+        finally:
+            core.close_fastq_stats_pool(fastq_stats_pool)
+
+    results = {
+        'git_commit': get_git_commit(),
+        'timestamp': datetime.datetime.now().astimezone().isoformat(),
+        'python_version': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {k: v for k, v in vars(args).items() if k not in ['output', 'compare', 'tmpdir']},
+        'runs': [{k: v for k, v in run.items() if k != 'run_dir'} for run in runs],
+        'generate_seconds': round(generate_seconds, 2),
+        'benchmarks': benchmarks,
+    }
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline_results = json.load(f)
+        if baseline_results.get('parameters', None) != results['parameters']:
+            logging.warning(json.dumps({'event_type': 'benchmark_parameters_differ', 'baseline': args.compare}))
+        results['baseline_git_commit'] = baseline_results.get('git_commit', None)
+        results['comparison'] = compare_results(benchmarks, baseline_results.get('benchmarks', {}))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark run discovery and collection on synthetic run directories')
+    parser.add_argument('--layouts', nargs='+', choices=list(generate_synthetic_runs.LAYOUTS), default=list(generate_synthetic_runs.LAYOUTS))
+    parser.add_argument('--num-demultiplexings', type=int, default=1)
+    parser.add_argument('--num-samples', type=int, default=8)
+    parser.add_argument('--num-reads', type=int, default=20000, help='Average reads per library FASTQ file')
+    parser.add_argument('--read-length', type=int, default=151)
+    parser.add_argument('--compression', choices=generate_synthetic_runs.COMPRESSIONS, default='gzip')
+    parser.add_argument('--compresslevel', type=int, default=generate_synthetic_runs.DEFAULT_COMPRESSLEVEL)
+    parser.add_argument('--num-processes', type=int, default=2, help='FASTQ statistics worker processes')
+    parser.add_argument('--fastq-stats-mode', choices=illumina.FASTQ_STATS_MODES, default='exact')
+    parser.add_argument('--fastq-checksum-algorithm', choices=fastq_stats_engine.HASH_ALGORITHMS, default=fastq_stats_engine.DEFAULT_HASH_ALGORITHM)
+    parser.add_argument('--fastq-reader-backend', default=fastq_stats_engine.DEFAULT_READER_BACKEND)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tmpdir', help='Directory to generate the runs in (default: the system temporary directory)')
+    parser.add_argument('-o', '--output', help='Also write the results to this file')
+    parser.add_argument('--compare', help='Results from an earlier run of this benchmark (e.g. on another commit) to compare against')
+    args = parser.parse_args()
+    main(args)
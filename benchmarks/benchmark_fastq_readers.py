@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import json
+import os
+import random
+import tempfile
+import time
+
+import sequencing_runs_collector.fastq_stats as fastq_stats_engine
+
+# These differ between backends by design (e.g. pyfastx reads the file a second time to hash it).
+IO_STATS_KEYS = ['bytes_read', 'duration_seconds']
+
+
+def generate_fastq(fastq_path, num_reads, read_length, seed):
+    """
+    Write a gzipped FASTQ file of random reads, with the binned quality
+    scores that NextSeq and MiSeq instruments emit.
+    """
+    rng = random.Random(seed)
+    binned_quality_chars = '#,:F'
+    weights = [1, 2, 7, 90]
+    with gzip.open(fastq_path, 'wt', compresslevel=6) as f:
+        for read_num in range(num_reads):
+            seq = ''.join(rng.choices('ACGTN', weights=[25, 25, 25, 24, 1], k=read_length))
+            qual = ''.join(rng.choices(binned_quality_chars, weights=weights, k=read_length))
+            f.write(f"@read_{read_num} 1:N:0:1\n{seq}\n+\n{qual}\n")
+
+
+def time_backend(reader_backend, fastq_paths, repeats):
+    """
+    Collect statistics for every file with one reader backend, `repeats` times, and report the best time.
+    """
+    best_seconds = None
+    counts = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        counts = [
+            fastq_stats_engine.collect_fastq_stats(fastq_path, reader_backend=reader_backend)
+            for fastq_path in fastq_paths
+        ]
+        elapsed = time.perf_counter() - start
+        if best_seconds is None or elapsed < best_seconds:
+            best_seconds = elapsed
+
+    num_reads = sum(c['num_reads'] for c in counts)
+    num_compressed_bytes = sum(os.path.getsize(p) for p in fastq_paths)
+
+    return {
+        'seconds': round(best_seconds, 4),
+        'compressed_mb_per_second': round(num_compressed_bytes / 1e6 / best_seconds, 2) if best_seconds > 0 else None,
+        'reads_per_second': round(num_reads / best_seconds) if best_seconds > 0 else None,
+        'counts': [{k: v for k, v in c.items() if k not in IO_STATS_KEYS} for c in counts],
+    }
+
+
+def main(args):
+    available_backends = fastq_stats_engine.available_reader_backends()
+    backends = args.backends if args.backends else available_backends
+    unavailable_backends = [b for b in backends if b not in available_backends]
+    backends = [b for b in backends if b in available_backends]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.fastq:
+            fastq_paths = args.fastq
+        else:
+            fastq_path = os.path.join(tmp_dir, 'synthetic.fastq.gz')
+            generate_fastq(fastq_path, args.num_reads, args.read_length, args.seed)
+            fastq_paths = [fastq_path]
+
+        results_by_backend = {backend: time_backend(backend, fastq_paths, args.repeats) for backend in backends}
+        num_compressed_bytes = sum(os.path.getsize(p) for p in fastq_paths)
+
+    baseline_counts = results_by_backend[backends[0]]['counts'] if backends else None
+    results = {
+        'source': args.fastq if args.fastq else 'synthetic',
+        'num_compressed_bytes': num_compressed_bytes,
+        'unavailable_backends': unavailable_backends,
+        'backends': {
+            backend: {k: v for k, v in backend_results.items() if k != 'counts'}
+            for backend, backend_results in results_by_backend.items()
+        },
+        'counts_match': all(r['counts'] == baseline_counts for r in results_by_backend.values()),
+    }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare FASTQ reader backends on the same files')
+    parser.add_argument('--fastq', action='append', help='Read this FASTQ file instead of generating one. May be repeated.')
+    parser.add_argument('--backends', nargs='+', help='Reader backends to compare (default: all available)')
+    parser.add_argument('--num-reads', type=int, default=200000)
+    parser.add_argument('--read-length', type=int, default=150)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import json
+import random
+import time
+
+import sequencing_runs_collector.fastq_stats as fastq_stats_engine
+
+
+def generate_quals(num_reads, read_length, seed):
+    """
+    Generate random quality strings using the binned quality
+    scores that NextSeq and MiSeq instruments emit.
+    """
+    rng = random.Random(seed)
+    binned_quality_chars = '#,:F'
+    weights = [1, 2, 7, 90]
+    quals = []
+    for _ in range(num_reads):
+        quals.append(''.join(rng.choices(binned_quality_chars, weights=weights, k=read_length)))
+
+    return quals
+
+
+def load_quals(fastq_path, max_reads):
+    """
+    Load up to `max_reads` quality strings from a (optionally gzipped) FASTQ file.
+    """
+    open_fn = gzip.open if fastq_path.endswith('.gz') else open
+    quals = []
+    with open_fn(fastq_path, 'rt') as f:
+        for line_num, line in enumerate(f):
+            if line_num % 4 == 3:
+                quals.append(line.rstrip('\n'))
+                if len(quals) >= max_reads:
+                    break
+
+    return quals
+
+
+def count_quality_legacy(quals):
+    """
+    The original per-base loop from `illumina.get_fastq_stats`.
+    """
+    num_bases_over_q30 = 0
+    num_bases_over_q30_last_25 = 0
+    for qual in quals:
+        for q in qual:
+            phred_quality = ord(q) - 33
+            if phred_quality >= 30:
+                num_bases_over_q30 += 1
+        for q in qual[-25:]:
+            phred_quality = ord(q) - 33
+            if phred_quality >= 30:
+                num_bases_over_q30_last_25 += 1
+
+    return {
+        'num_bases_over_q30': num_bases_over_q30,
+        'num_bases_over_q30_last_25': num_bases_over_q30_last_25,
+    }
+
+
+def count_quality_batched(quals, batch_size):
+    """
+    The batched engine, including the str -> bytes conversion that
+    `illumina.get_fastq_stats` performs on each read.
+    """
+    counts = {
+        'num_bases_over_q30': 0,
+        'num_bases_over_q30_last_25': 0,
+    }
+    for batch_start in range(0, len(quals), batch_size):
+        batch = [qual.encode('ascii') for qual in quals[batch_start:batch_start + batch_size]]
+        batch_counts = fastq_stats_engine.count_quality_batch(batch)
+        counts['num_bases_over_q30'] += batch_counts['num_bases_over_q30']
+        counts['num_bases_over_q30_last_25'] += batch_counts['num_bases_over_q30_last_n']
+
+    return counts
+
+
+def time_counter(count_fn, quals, num_bases, repeats):
+    """
+    Run `count_fn` `repeats` times and report the best time.
+    """
+    best_seconds = None
+    counts = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        counts = count_fn(quals)
+        elapsed = time.perf_counter() - start
+        if best_seconds is None or elapsed < best_seconds:
+            best_seconds = elapsed
+
+    return {
+        'seconds': round(best_seconds, 4),
+        'bases_per_second': round(num_bases / best_seconds) if best_seconds > 0 else None,
+        'counts': counts,
+    }
+
+
+def main(args):
+    if args.fastq:
+        quals = load_quals(args.fastq, args.num_reads)
+    else:
+        quals = generate_quals(args.num_reads, args.read_length, args.seed)
+    num_bases = sum(len(qual) for qual in quals)
+
+    legacy = time_counter(count_quality_legacy, quals, num_bases, args.repeats)
+    batched = time_counter(lambda q: count_quality_batched(q, args.batch_size), quals, num_bases, args.repeats)
+
+    results = {
+        'source': args.fastq if args.fastq else 'synthetic',
+        'num_reads': len(quals),
+        'num_bases': num_bases,
+        'batch_size': args.batch_size,
+        'legacy': legacy,
+        'batched': batched,
+        'speedup': round(legacy['seconds'] / batched['seconds'], 2) if batched['seconds'] > 0 else None,
+        'counts_match': legacy['counts'] == batched['counts'],
+    }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the legacy per-base Q30 loop against the batched engine')
+    parser.add_argument('--fastq', help='Take quality strings from this FASTQ instead of generating them')
+    parser.add_argument('--num-reads', type=int, default=200000)
+    parser.add_argument('--read-length', type=int, default=150)
+    parser.add_argument('--batch-size', type=int, default=fastq_stats_engine.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import gzip
+import json
+import os
+import random
+import struct
+import zlib
+
+# Run directory layouts that can be generated, and the instrument model for each.
+LAYOUTS = {
+    'miseq_basecalls': 'MISEQ',
+    'miseq_alignment': 'MISEQ',
+    'nextseq': 'NEXTSEQ',
+    'gridion': 'GRIDION',
+}
+COMPRESSIONS = ['gzip', 'bgzf']
+# Uncompressed bytes in each BGZF block. The format allows up to 64 KiB per block, including the header.
+BGZF_BLOCK_SIZE_BYTES = 65280
+BGZF_EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# Reads are drawn from a pool of random reads, so that large files can be written quickly.
+# The pool is much bigger than gzip's 32 KiB window, so that it doesn't make the files unrealistically compressible.
+READ_POOL_SIZE_BYTES = 2 * 1024 * 1024
+# bcl2fastq's default compression level.
+DEFAULT_COMPRESSLEVEL = 4
+BINNED_QUALITY_CHARS = '#,:F'
+BINNED_QUALITY_WEIGHTS = [1, 2, 7, 90]
+
+
+def _bgzf_compress(data, compresslevel):
+    """
+    Compress data as BGZF: a series of gzip members of at most 64 KiB each, each with its compressed size in a 'BC' extra field.
+    """
+    blocks = []
+    for offset in range(0, len(data), BGZF_BLOCK_SIZE_BYTES):
+        block_data = data[offset:offset + BGZF_BLOCK_SIZE_BYTES]
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        compressed_block_data = compressor.compress(block_data) + compressor.flush()
+        block_size = 18 + len(compressed_block_data) + 8
+        header = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', block_size - 1)
+        blocks.append(header + compressed_block_data + struct.pack('<II', zlib.crc32(block_data), len(block_data)))
+    blocks.append(BGZF_EOF_BLOCK)
+
+    return b''.join(blocks)
+
+
+def _random_read_pool(rng, read_length):
+    """
+    Generate random sequences, and quality strings with the binned quality scores that NextSeq and MiSeq instruments emit.
+    Quality drops off towards the end of each read, as it does on real runs.
+    """
+    read_pool = []
+    tail_length = read_length // 5
+    for _ in range(max(64, READ_POOL_SIZE_BYTES // (2 * read_length))):
+        seq = ''.join(rng.choices('ACGTN', weights=[25, 25, 25, 24, 1], k=read_length))
+        qual = ''.join(rng.choices(BINNED_QUALITY_CHARS, weights=BINNED_QUALITY_WEIGHTS, k=read_length - tail_length))
+        qual += ''.join(rng.choices(BINNED_QUALITY_CHARS, weights=[5, 10, 25, 60], k=tail_length))
+        read_pool.append((seq, qual))
+
+    return read_pool
+
+
+def write_fastq(fastq_path, num_reads, read_pool, read_header_prefix, read_header_suffix, rng, compression='gzip', compresslevel=DEFAULT_COMPRESSLEVEL):
+    """
+    Write a compressed FASTQ file, with reads drawn at random from `read_pool`.
+
+    :param fastq_path: Path to write to
+    :type fastq_path: str
+    :param num_reads: Number of reads
+    :type num_reads: int
+    :param read_pool: Sequences and quality strings to draw reads from, as returned by `_random_read_pool`
+    :type read_pool: list[tuple[str, str]]
+    :param read_header_prefix: Start of each read's header, before its read number
+    :type read_header_prefix: str
+    :param read_header_suffix: End of each read's header, after its read number
+    :type read_header_suffix: str
+    :param rng: Random number generator
+    :type rng: random.Random
+    :param compression: 'gzip' or 'bgzf'
+    :type compression: str
+    :param compresslevel: Compression level
+    :type compresslevel: int
+    :return: Size of the file, in bytes
+    :rtype: int
+    """
+    records = []
+    for read_num in range(num_reads):
+        seq, qual = read_pool[rng.randrange(len(read_pool))]
+        records.append(f"@{read_header_prefix}{read_num}{read_header_suffix}\n{seq}\n+\n{qual}\n")
+    data = ''.join(records).encode('ascii')
+    if compression == 'bgzf':
+        compressed_data = _bgzf_compress(data, compresslevel)
+    else:
+        compressed_data = gzip.compress(data, compresslevel=compresslevel, mtime=0)
+    with open(fastq_path, 'wb') as f:
+        f.write(compressed_data)
+
+    return len(compressed_data)
+
+
+def make_libraries(num_samples, num_reads, rng, num_projects=2):
+    """
+    Make up the libraries for a demultiplexing. Library sizes vary by up to 50% either side of `num_reads`, as they do on real runs.
+
+    :return: Libraries. Keys: [library_id, project_id, index, index2, sample_number, num_reads]
+    :rtype: list[dict[str, object]]
+    """
+    libraries = []
+    for sample_number in range(1, num_samples + 1):
+        libraries.append({
+            'library_id': f"SYN{sample_number:04d}",
+            'project_id': f"project{(sample_number - 1) % num_projects + 1}",
+            'index': ''.join(rng.choices('ACGT', k=10)),
+            'index2': ''.join(rng.choices('ACGT', k=10)),
+            'sample_number': sample_number,
+            'num_reads': max(1, int(num_reads * rng.uniform(0.5, 1.5))),
+        })
+
+    return libraries
+
+
+def write_runinfo(run_dir, run_id, flowcell_id, instrument_id, read_length, index_length=10):
+    """
+    Write a RunInfo.xml with reads R1, I1, I2, R2.
+    """
+    reads = [(1, read_length, 'N'), (2, index_length, 'Y'), (3, index_length, 'Y'), (4, read_length, 'N')]
+    read_elements = '\n'.join(f'      <Read Number="{number}" NumCycles="{num_cycles}" IsIndexedRead="{is_indexed_read}" />' for number, num_cycles, is_indexed_read in reads)
+    with open(os.path.join(run_dir, 'RunInfo.xml'), 'w') as f:
+        f.write(f"""<?xml version="1.0"?>
+<RunInfo xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" Version="2">
+  <Run Id="{run_id}" Number="1">
+    <Flowcell>{flowcell_id}</Flowcell>
+    <Instrument>{instrument_id}</Instrument>
+    <Date>{run_id[:6]}</Date>
+    <Reads>
+{read_elements}
+    </Reads>
+  </Run>
+</RunInfo>
+""")
+
+
+def write_miseq_samplesheet(samplesheet_path, experiment_name, libraries, read_length):
+    """
+    Write a MiSeq (IEM v5) SampleSheet.
+    """
+    rows = '\n'.join(
+        f"{library['library_id']},{library['library_id']},,,N7{library['sample_number']:02d},{library['index']},S5{library['sample_number']:02d},{library['index2']},{library['project_id']},"
+        for library in libraries
+    )
+    with open(samplesheet_path, 'w') as f:
+        f.write(f"""[Header]
+IEMFileVersion,5
+Experiment Name,{experiment_name}
+Date,2024-01-01
+Workflow,GenerateFASTQ
+Application,FASTQ Only
+Instrument Type,MiSeq
+Assay,Nextera XT
+Index Adapters,IDT-ILMN Nextera DNA UD Indexes (96 Indexes)
+Chemistry,Amplicon
+
+[Reads]
+{read_length}
+{read_length}
+
+[Settings]
+ReverseComplement,0
+
+[Data]
+Sample_ID,Sample_Name,Sample_Plate,Sample_Well,I7_Index_ID,index,I5_Index_ID,index2,Sample_Project,Description
+{rows}
+""")
+
+
+def write_nextseq_samplesheet(samplesheet_path, run_name, libraries, read_length):
+    """
+    Write a NextSeq 2000 (v2) SampleSheet.
+    """
+    bclconvert_rows = '\n'.join(f"{library['library_id']},{library['index']},{library['index2']}" for library in libraries)
+    cloud_rows = '\n'.join(f"{library['library_id']},{library['project_id']},{library['library_id']}" for library in libraries)
+    with open(samplesheet_path, 'w') as f:
+        f.write(f"""[Header]
+FileFormatVersion,2
+RunName,{run_name}
+InstrumentPlatform,NextSeq1k2k
+InstrumentType,NextSeq2000
+
+[Reads]
+Read1Cycles,{read_length}
+Read2Cycles,{read_length}
+Index1Cycles,10
+Index2Cycles,10
+
+[Sequencing_Settings]
+LibraryPrepKitName,IlluminaDNAPrep
+
+[BCLConvert_Settings]
+SoftwareVersion,3.10.12
+FastqCompressionFormat,gzip
+
+[BCLConvert_Data]
+Sample_ID,Index,Index2
+{bclconvert_rows}
+
+[Cloud_Settings]
+GeneratedVersion,1.6.0
+
+[Cloud_Data]
+Sample_ID,ProjectName,LibraryName
+{cloud_rows}
+""")
+
+
+def _write_illumina_fastqs(fastq_dir, libraries, read_pool, run_id, instrument_id, flowcell_id, rng, compression, compresslevel):
+    """
+    Write R1 and R2 FASTQ files for each library, named as bcl2fastq and BCL Convert name them.
+    """
+    os.makedirs(fastq_dir, exist_ok=True)
+    total_fastq_bytes = 0
+    for library in libraries:
+        for read_type_num in [1, 2]:
+            fastq_path = os.path.join(fastq_dir, f"{library['library_id']}_S{library['sample_number']}_L001_R{read_type_num}_001.fastq.gz")
+            total_fastq_bytes += write_fastq(
+                fastq_path,
+                library['num_reads'],
+                read_pool,
+                f"{instrument_id}:1:{flowcell_id}:1:1101:",
+                f":1000 {read_type_num}:N:0:{library['index']}+{library['index2']}",
+                rng,
+                compression,
+                compresslevel,
+            )
+
+    return total_fastq_bytes
+
+
+def generate_illumina_run(run_parent_dir, layout, run_num=1, num_demultiplexings=1, num_samples=8, num_reads=10000, read_length=151, compression='gzip', compresslevel=DEFAULT_COMPRESSLEVEL, seed=0):
+    """
+    Generate an Illumina run directory.
+
+    - 'miseq_basecalls': the old MiSeq layout. FASTQ files and SampleSheetUsed.csv are in Data/Intensities/BaseCalls. Always has one demultiplexing.
+    - 'miseq_alignment': the new MiSeq layout. Each demultiplexing is in Alignment_N/<timestamp>, with its FASTQ files in Fastq/.
+    - 'nextseq': each demultiplexing is in Analysis/N/Data, with its FASTQ files in fastq/.
+
+    Each run has a RunInfo.xml and an upload_complete.json. No InterOp files are written.
+
+    :param run_parent_dir: Directory to create the run in
+    :type run_parent_dir: str
+    :param layout: One of 'miseq_basecalls', 'miseq_alignment' or 'nextseq'
+    :type layout: str
+    :param run_num: Run number, used to make the run ID unique
+    :type run_num: int
+    :param num_demultiplexings: Number of demultiplexings
+    :type num_demultiplexings: int
+    :param num_samples: Number of libraries in each demultiplexing
+    :type num_samples: int
+    :param num_reads: Average number of reads in each library's FASTQ files
+    :type num_reads: int
+    :param read_length: Read length
+    :type read_length: int
+    :param compression: 'gzip' or 'bgzf'
+    :type compression: str
+    :param compresslevel: Compression level
+    :type compresslevel: int
+    :param seed: Random seed
+    :type seed: int
+    :return: Run. Keys: [run_id, run_dir, layout, instrument_model, num_demultiplexings, num_libraries, fastq_bytes]
+    :rtype: dict[str, object]
+    """
+    rng = random.Random(f"{seed}-{layout}-{run_num}")
+    instrument_model = LAYOUTS[layout]
+    if instrument_model == 'MISEQ':
+        instrument_id = 'M00123'
+        flowcell_id = f"000000000-{rng.choice('ABCDEFGHJK')}{run_num:04d}"
+        run_id = f"240101_{instrument_id}_{run_num:04d}_{flowcell_id}"
+    else:
+        instrument_id = 'VH00123'
+        flowcell_id = f"AAAA{run_num:05d}"
+        run_id = f"240101_{instrument_id}_{run_num}_{flowcell_id}"
+    run_dir = os.path.join(run_parent_dir, run_id)
+    os.makedirs(run_dir)
+    write_runinfo(run_dir, run_id, flowcell_id, instrument_id, read_length)
+    read_pool = _random_read_pool(rng, read_length)
+
+    if layout == 'miseq_basecalls':
+        num_demultiplexings = 1
+    fastq_bytes = 0
+    num_libraries = 0
+    for demultiplexing_num in range(1, num_demultiplexings + 1):
+        libraries = make_libraries(num_samples, num_reads, rng)
+        num_libraries += len(libraries)
+        if layout == 'miseq_basecalls':
+            demultiplexing_output_dir = os.path.join(run_dir, 'Data', 'Intensities', 'BaseCalls')
+            fastq_dir = demultiplexing_output_dir
+            os.makedirs(fastq_dir)
+            write_miseq_samplesheet(os.path.join(demultiplexing_output_dir, 'SampleSheetUsed.csv'), run_id, libraries, read_length)
+        elif layout == 'miseq_alignment':
+            timestamp = datetime.datetime(2024, 1, 2, 12, 0, 0) + datetime.timedelta(hours=demultiplexing_num)
+            demultiplexing_output_dir = os.path.join(run_dir, f"Alignment_{demultiplexing_num}", timestamp.strftime('%Y%m%d_%H%M%S'))
+            fastq_dir = os.path.join(demultiplexing_output_dir, 'Fastq')
+            os.makedirs(fastq_dir)
+            write_miseq_samplesheet(os.path.join(demultiplexing_output_dir, 'SampleSheetUsed.csv'), run_id, libraries, read_length)
+        else:
+            demultiplexing_output_dir = os.path.join(run_dir, 'Analysis', str(demultiplexing_num))
+            fastq_dir = os.path.join(demultiplexing_output_dir, 'Data', 'fastq')
+            os.makedirs(fastq_dir)
+            write_nextseq_samplesheet(os.path.join(demultiplexing_output_dir, 'Data', 'SampleSheet.csv'), run_id, libraries, read_length)
+            with open(os.path.join(demultiplexing_output_dir, 'Data', 'dmx_dragen_events.csv'), 'w') as f:
+                f.write(f"time,label\n2024-01-0{demultiplexing_num + 1}T12:00:00Z,DRAGEN START\n")
+        fastq_bytes += _write_illumina_fastqs(fastq_dir, libraries, read_pool, run_id, instrument_id, flowcell_id, rng, compression, compresslevel)
+
+    with open(os.path.join(run_dir, 'upload_complete.json'), 'w') as f:
+        json.dump({'run_id': run_id}, f)
+
+    run = {
+        'run_id': run_id,
+        'run_dir': run_dir,
+        'layout': layout,
+        'instrument_model': instrument_model,
+        'num_demultiplexings': num_demultiplexings,
+        'num_libraries': num_libraries,
+        'fastq_bytes': fastq_bytes,
+    }
+
+    return run
+
+
+def generate_gridion_run(run_parent_dir, run_num=1, num_samples=8, num_reads=10000, read_length=1500, compression='gzip', compresslevel=DEFAULT_COMPRESSLEVEL, seed=0):
+    """
+    Generate a GridION run directory, with a sample sheet, a report JSON, and one FASTQ file for each barcode in fastq_pass/.
+
+    :param run_parent_dir: Directory to create the run in
+    :type run_parent_dir: str
+    :param run_num: Run number, used to make the run ID unique
+    :type run_num: int
+    :param num_samples: Number of barcoded libraries
+    :type num_samples: int
+    :param num_reads: Average number of reads for each barcode
+    :type num_reads: int
+    :param read_length: Read length
+    :type read_length: int
+    :param compression: 'gzip' or 'bgzf'
+    :type compression: str
+    :param compresslevel: Compression level
+    :type compresslevel: int
+    :param seed: Random seed
+    :type seed: int
+    :return: Run. Keys: [run_id, run_dir, layout, instrument_model, num_demultiplexings, num_libraries, fastq_bytes]
+    :rtype: dict[str, object]
+    """
+    rng = random.Random(f"{seed}-gridion-{run_num}")
+    flowcell_id = f"FAQ{run_num:05d}"
+    run_hash = ''.join(rng.choices('0123456789abcdef', k=8))
+    run_id = f"20240101_1200_X1_{flowcell_id}_{run_hash}"
+    run_dir = os.path.join(run_parent_dir, run_id)
+    os.makedirs(run_dir)
+    read_pool = _random_read_pool(rng, read_length)
+    libraries = make_libraries(num_samples, num_reads, rng)
+
+    with open(os.path.join(run_dir, f"sample_sheet_{flowcell_id}_{run_hash}.csv"), 'w') as f:
+        f.write('flow_cell_id,kit,sample_id,experiment_id,barcode,alias\n')
+        for library in libraries:
+            f.write(f"{flowcell_id},SQK-NBD114-24,{run_id},{run_id},barcode{library['sample_number']:02d},{library['library_id']}_{library['project_id']}\n")
+    report = {
+        'protocol_run_info': {
+            'run_id': run_hash,
+            'flow_cell': {'flow_cell_id': flowcell_id, 'product_code': 'FLO-MIN114', 'channel_count': 512},
+        },
+    }
+    with open(os.path.join(run_dir, f"report_{flowcell_id}_{run_hash}.json"), 'w') as f:
+        json.dump(report, f)
+
+    fastq_bytes = 0
+    for library in libraries:
+        barcode = f"barcode{library['sample_number']:02d}"
+        barcode_dir = os.path.join(run_dir, 'fastq_pass', barcode)
+        os.makedirs(barcode_dir)
+        fastq_bytes += write_fastq(
+            os.path.join(barcode_dir, f"{flowcell_id}_pass_{barcode}_{run_hash}_0.fastq.gz"),
+            library['num_reads'],
+            read_pool,
+            f"{run_hash}-",
+            f" runid={run_hash} barcode={barcode}",
+            rng,
+            compression,
+            compresslevel,
+        )
+
+    with open(os.path.join(run_dir, 'upload_complete.json'), 'w') as f:
+        json.dump({'run_id': run_id}, f)
+
+    run = {
+        'run_id': run_id,
+        'run_dir': run_dir,
+        'layout': 'gridion',
+        'instrument_model': 'GRIDION',
+        'num_demultiplexings': 0,
+        'num_libraries': len(libraries),
+        'fastq_bytes': fastq_bytes,
+    }
+
+    return run
+
+
+def generate_runs(run_parent_dir, layouts=tuple(LAYOUTS), num_runs_per_layout=1, num_demultiplexings=1, num_samples=8, num_reads=10000, read_length=151, nanopore_read_length=1500, compression='gzip', compresslevel=DEFAULT_COMPRESSLEVEL, seed=0):
+    """
+    Generate runs with each of the `layouts`, in `run_parent_dir`. The same arguments and seed always generate the same runs.
+
+    :return: Runs, as returned by `generate_illumina_run` and `generate_gridion_run`
+    :rtype: list[dict[str, object]]
+    """
+    os.makedirs(run_parent_dir, exist_ok=True)
+    runs = []
+    run_num = 1
+    for layout in layouts:
+        for _ in range(num_runs_per_layout):
+            if layout == 'gridion':
+                run = generate_gridion_run(run_parent_dir, run_num, num_samples, num_reads, nanopore_read_length, compression, compresslevel, seed)
+            else:
+                run = generate_illumina_run(run_parent_dir, layout, run_num, num_demultiplexings, num_samples, num_reads, read_length, compression, compresslevel, seed)
+            runs.append(run)
+            run_num += 1
+
+    return runs
+
+
+def main(args):
+    runs = generate_runs(
+        args.outdir,
+        args.layouts,
+        args.num_runs_per_layout,
+        args.num_demultiplexings,
+        args.num_samples,
+        args.num_reads,
+        args.read_length,
+        args.nanopore_read_length,
+        args.compression,
+        args.compresslevel,
+        args.seed,
+    )
+
+    print(json.dumps(runs, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic sequencing run directories, for benchmarking')
+    parser.add_argument('-o', '--outdir', required=True, help='Run parent directory to create the runs in')
+    parser.add_argument('--layouts', nargs='+', choices=list(LAYOUTS), default=list(LAYOUTS))
+    parser.add_argument('--num-runs-per-layout', type=int, default=1)
+    parser.add_argument('--num-demultiplexings', type=int, default=1, help='Demultiplexings per run (MiSeq Alignment_N and NextSeq layouts)')
+    parser.add_argument('--num-samples', type=int, default=8, help='Libraries per demultiplexing')
+    parser.add_argument('--num-reads', type=int, default=10000, help='Average reads per library FASTQ file')
+    parser.add_argument('--read-length', type=int, default=151)
+    parser.add_argument('--nanopore-read-length', type=int, default=1500)
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='gzip')
+    parser.add_argument('--compresslevel', type=int, default=DEFAULT_COMPRESSLEVEL)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -1,58 +1,29 @@
 #!/usr/bin/env python3
 
 import argparse
-import hashlib
 import json
 import os
 
-import pyfastx
-
-
-def md5(file_path):
-    """
-    """
-    with open(file_path, 'rb') as f:
-        file_contents = f.read()
-        md5 = hashlib.md5(file_contents).hexdigest()
-
-    return md5
+import sequencing_runs_collector.fastq_stats as fastq_stats_engine
 
 
 def main(args):
     filename = os.path.basename(args.fastq)
-    md5_checksum = md5(args.fastq)
-    total_reads = 0
-    total_bases = 0
-    num_bases_greater_or_equal_to_q30 = 0
-    min_read_length = None
-    max_read_length = 0
-    file_stats = os.stat(args.fastq)
-    file_size_bytes = file_stats.st_size
-    fq = pyfastx.Fastx(args.fastq)
-    
-    for name, seq, qual, comment in fq:
-        read_length = len(seq)
-        if min_read_length is None or read_length < min_read_length:
-            min_read_length = read_length
-        if read_length > max_read_length:
-            max_read_length = read_length
-        total_reads += 1
-        total_bases += read_length
-        for q in qual:
-            phred = ord(q) - 33
-            if phred >= 30:
-                num_bases_greater_or_equal_to_q30 += 1
+    collected_stats = fastq_stats_engine.collect_fastq_stats(
+        args.fastq,
+        metrics=['num_reads', 'num_bases', 'read_length', 'q30', 'md5', 'file_size'],
+    )
 
     stats = {
         'filename': filename,
-        'md5_checksum': md5_checksum,
-        'size_bytes': file_size_bytes,
-        'total_reads': total_reads,
-        'total_bases': total_bases,
-        'num_bases_greater_or_equal_to_q30': num_bases_greater_or_equal_to_q30,
-        'mean_read_length': total_bases / total_reads,
-        'max_read_length': max_read_length,
-        'min_read_length': min_read_length,
+        'md5_checksum': collected_stats['md5'],
+        'size_bytes': collected_stats['file_size_bytes'],
+        'total_reads': collected_stats['num_reads'],
+        'total_bases': collected_stats['num_bases'],
+        'num_bases_greater_or_equal_to_q30': collected_stats['num_bases_over_q30'],
+        'mean_read_length': collected_stats['mean_read_length'],
+        'max_read_length': collected_stats['max_read_length'],
+        'min_read_length': collected_stats['min_read_length'],
     }
 
     print(json.dumps(stats, indent=2))
@@ -2,18 +2,22 @@
 
 import argparse
 import datetime
-import glob
 import json
 import logging
 import os
-import time
+import select
 
-from pathlib import Path
 
 import sequencing_runs_collector.config
 import sequencing_runs_collector.core as core
+import sequencing_runs_collector.metrics as metrics
+import sequencing_runs_collector.run_parent_dir_scanner as run_parent_dir_scanner
+import sequencing_runs_collector.run_scheduler as run_scheduler
+import sequencing_runs_collector.run_state as run_state
+import sequencing_runs_collector.run_watcher as run_watcher
 
 DEFAULT_SCAN_INTERVAL_SECONDS = 3600
+DEFAULT_RUN_DISCOVERY_MODE = 'poll'
 
 def main():
     parser = argparse.ArgumentParser()
@@ -22,6 +26,7 @@ def main():
     args = parser.parse_args()
 
     config = {}
+    config_cache = sequencing_runs_collector.config.new_config_cache(args.config) if args.config else None
 
     try:
         log_level = getattr(logging, args.log_level.upper())
@@ -29,123 +34,117 @@ def main():
         log_level = logging.INFO
 
     logging.basicConfig(
-        format='{"timestamp": "%(asctime)s.%(msecs)03d", "level": "%(levelname)s", "module": "%(module)s", "function_name": "%(funcName)s", "line_num": %(lineno)d, "message": %(message)s}',
+        format='{"timestamp": "%(asctime)s.%(msecs)03d", "level": "%(levelname)s", "module": "%(module)s", "function_name": "%(funcName)s", "line_num": %(lineno)d, "correlation_id": %(correlation_id)s, "message": %(message)s}',
         datefmt='%Y-%m-%dT%H:%M:%S',
         encoding='utf-8',
         level=log_level,
     )
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(run_scheduler.add_correlation_id)
     logging.debug(json.dumps({"event_type": "debug_logging_enabled"}))
 
     quit_when_safe = False
     scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
+    # Created once and reused for every run, rather than starting new workers for each demultiplexing.
+    # Shared by all of the runs being collected at once.
+    fastq_stats_pool = None
+    # Opened once the config has been loaded, and kept open for the life of the process.
+    run_state_conn = None
+    # Serves metrics on `metrics_port`, if it is set.
+    metrics_server = None
+    # Remembers which run parent directories are degraded (too slow to scan) between scans.
+    scanner = run_parent_dir_scanner.new_scanner()
+    # Only used when `run_discovery_mode` is 'inotify'. Scans are still run every `scan_interval_seconds`,
+    # to pick up runs on directories that can't be watched, and any events that were missed.
+    watcher = None
+    inotify_unavailable = False
+    # Up to `num_concurrent_runs` runs are collected at once, each in its own thread.
+    # A byte is written to the wake pipe when a run finishes, so that the main loop can start the next one.
+    run_executor = None
+    runs_in_progress = {}
+    wake_fd_read, wake_fd_write = os.pipe()
+    os.set_blocking(wake_fd_read, False)
 
     while(True):
         if quit_when_safe:
+            run_scheduler.wait_for_runs(runs_in_progress, run_state_conn)
+            core.close_fastq_stats_pool(fastq_stats_pool)
+            metrics.close_metrics_server(metrics_server)
             exit(0)
         try:
-            if args.config:
-                try:
-                    config = sequencing_runs_collector.config.load_config(args.config)
-                    logging.info(json.dumps({
-                        "event_type": "config_loaded",
-                        "config_file": os.path.abspath(args.config)
-                    }))
-                except json.decoder.JSONDecodeError as e:
-                    # If we fail to load the config file, we continue on with the
-                    # last valid config that was loaded.
-                    logging.error(json.dumps({
-                        "event_type": "load_config_failed",
-                        "config_file": os.path.abspath(args.config)
-                    }))
+            if config_cache is not None:
+                # Only re-parsed when the config file or project ID translation file has changed.
+                config = sequencing_runs_collector.config.get_config(config_cache)
+            if run_state_conn is None:
+                run_state_path = config.get('run_state_path', run_state.IN_MEMORY_RUN_STATE_PATH)
+                run_state_conn = run_state.open_run_state(run_state_path)
+                num_interrupted_runs = run_state.reset_interrupted_runs(run_state_conn)
+                logging.info(json.dumps({
+                    "event_type": "run_state_opened",
+                    "run_state_path": run_state_path if run_state_path == run_state.IN_MEMORY_RUN_STATE_PATH else os.path.abspath(run_state_path),
+                    "num_interrupted_runs": num_interrupted_runs,
+                }))
+            run_scheduler.drain_wake_fd(wake_fd_read)
+            run_scheduler.finish_completed_runs(runs_in_progress, run_state_conn)
+            # The pool can only be replaced while it is idle.
+            if not runs_in_progress:
+                fastq_stats_pool = core.update_fastq_stats_pool(fastq_stats_pool, config)
+            run_executor = run_scheduler.update_run_executor(run_executor, config)
+            metrics_server = metrics.update_metrics_server(metrics_server, config)
 
             scan_start_timestamp = datetime.datetime.now()
-            existing_run_output_ids = []
-            existing_run_output_dirs_glob = os.path.join(str(config['output_directory']), '*', '*')
-            existing_run_output_dirs = glob.glob(existing_run_output_dirs_glob)
-            for existing_run_output_dir in existing_run_output_dirs:
-                existing_run_output_ids.append(os.path.basename(existing_run_output_dir))
-
-            for run in core.scan(config):
+            for run in core.scan(config, run_state_conn, scanner):
                 if run is not None:
-                    try:
-                        config = sequencing_runs_collector.config.load_config(args.config)
-                        logging.debug(json.dumps({
-                            "event_type": "config_loaded",
-                            "config_file": os.path.abspath(args.config)
-                        }))
-                    except json.decoder.JSONDecodeError as e:
-                        logging.error(json.dumps({
-                            "event_type": "load_config_failed",
-                            "config_file": os.path.abspath(args.config)
-                        }))
-
-                    
-                    if run['run_id'] in existing_run_output_ids:
-                        logging.debug(json.dumps({'event_type': 'skipped_existing_run', 'run': run}))
+                    if len(runs_in_progress) >= run_executor['num_concurrent_runs']:
+                        # Left as 'ready', to be started when another run finishes.
+                        logging.debug(json.dumps({'event_type': 'run_collection_deferred', 'sequencing_run_id': run['run_id']}))
                         continue
-                    if run['instrument_type'] == 'ILLUMINA':
-                        timestamp_collect_run_start = datetime.datetime.now()
-                        logging.info(json.dumps({
-                            'event_type': 'collect_run_start',
-                            'sequencing_run_id': run['run_id'],
-                            'run_dir': run['run_dir']
-                        }))
-                        collected_run = core.collect_illumina_run(config, run)
-                        timestamp_collect_run_complete = datetime.datetime.now()
-                        logging.info(json.dumps({
-                            'event_type': 'collect_run_complete',
-                            'sequencing_run_id': run['run_id'],
-                            'collect_run_duration_seconds': (timestamp_collect_run_complete - timestamp_collect_run_start).total_seconds()
-                        }))
-                        if collected_run is None:
-                            logging.error(json.dumps({
-                                'event_type': 'collect_run_returned_none',
-                                'sequencing_run_id': run['run_id'],
-                            }))
-                            continue
-                        
-                        run_output_dir = Path(os.path.join(str(config['output_directory']), 'illumina', str(run['run_id'])))
-                        os.makedirs(run_output_dir)
-                        core.write_collected_illumina_run(collected_run, run_output_dir)
-                        logging.info(json.dumps({
-                            'event_type': 'run_data_written',
-                            'sequencing_run_id': run['run_id'],
-                            'output_dir': os.path.abspath(run_output_dir)
-                        }))
-
-                    elif run['instrument_type'] == 'NANOPORE':
-                        collected_run = core.collect_nanopore_run(config, run)
-                        if collected_run is None:
-                            logging.error(json.dumps({
-                                'event_type': 'collect_run_returned_none',
-                                'sequencing_run_id': run['run_id'],
-                            }))
-                            continue
-
-                        run_output_dir = Path(os.path.join(str(config['output_directory']), 'nanopore', str(run['run_id'])))
-                        os.makedirs(run_output_dir)
-                        core.write_collected_nanopore_run(collected_run, run_output_dir)
-                        logging.info(json.dumps({
-                            'event_type': 'run_data_written',
-                            'sequencing_run_id': run['run_id'],
-                            'output_dir': os.path.abspath(run_output_dir)
-                        }))
+                    run_state.set_run_status(run_state_conn, run['run_id'], 'collecting')
+                    runs_in_progress[run['run_id']] = run_scheduler.submit_run(run_executor, config, run, fastq_stats_pool, wake_fd_write)
                 if quit_when_safe:
-                    exit(0)
+                    break
+            metrics.set_gauge('runs_in_progress', len(runs_in_progress))
             scan_complete_timestamp = datetime.datetime.now()
             scan_duration_delta = scan_complete_timestamp - scan_start_timestamp
             scan_duration_seconds = scan_duration_delta.total_seconds()
-            logging.info(json.dumps({"event_type": "scan_complete", "scan_duration_seconds": scan_duration_seconds}))
+            logging.info(json.dumps({
+                "event_type": "scan_complete",
+                "scan_duration_seconds": scan_duration_seconds,
+                "sequencing_run_ids_in_progress": sorted(runs_in_progress),
+            }))
 
             if quit_when_safe:
-                exit(0)
+                continue
 
             if "scan_interval_seconds" in config:
                 try:
                     scan_interval = float(str(config['scan_interval_seconds']))
                 except ValueError as e:
                     scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
-            time.sleep(scan_interval)
+
+            if config.get('run_discovery_mode', DEFAULT_RUN_DISCOVERY_MODE) == 'inotify':
+                if watcher is None and not inotify_unavailable:
+                    watcher = run_watcher.open_watcher()
+                    inotify_unavailable = watcher is None
+            elif watcher is not None:
+                run_watcher.close_watcher(watcher)
+                watcher = None
+
+            if watcher is not None:
+                run_parent_dirs = core.get_run_parent_dirs(config)
+                pending_run_dirs = [run['run_dir'] for run in run_state.get_runs(run_state_conn, ['discovered'], run_parent_dirs)]
+                scan_now = run_watcher.update_watches(watcher, run_parent_dirs, pending_run_dirs)
+                if not scan_now:
+                    run_events = run_watcher.wait_for_run_events(watcher, scan_interval, wake_fd_read)
+                    if run_events:
+                        logging.info(json.dumps({
+                            "event_type": "run_discovery_events_received",
+                            "num_events": len(run_events),
+                            "directories": sorted(set(os.path.join(str(event['path']), str(event['name'])) for event in run_events)),
+                        }))
+            else:
+                # Wakes early when a run finishes.
+                select.select([wake_fd_read], [], [], scan_interval)
         except KeyboardInterrupt as e:
             logging.info(json.dumps({"event_type": "quit_when_safe_enabled"}))
             quit_when_safe = True
@@ -1,8 +1,47 @@
 import json
+import logging
 import os
 import csv
 
 from pathlib import Path
+from typing import Optional
+
+
+def _get_file_signature(path: Optional[Path]) -> Optional[tuple[int, int]]:
+    """
+    Get the mtime and size of a file, to tell whether it has changed. Returns None if the file doesn't exist.
+    """
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def load_project_id_translation(project_id_translation_path: Optional[Path]) -> dict[str, str]:
+    """
+    Load the project ID translation table.
+
+    :param project_id_translation_path: Path to a .csv file with headers `samplesheet_project_id` and `translated_project_id`
+    :type project_id_translation_path: Optional[Path]
+    :return: Translated project IDs, indexed by samplesheet project ID. Empty if there is no translation file.
+    :rtype: dict[str, str]
+    """
+    project_id_translation = {}
+    if project_id_translation_path is not None and os.path.exists(project_id_translation_path):
+        with open(project_id_translation_path, 'r') as f:
+            reader = csv.DictReader(f, dialect='unix')
+            for row in reader:
+                samplesheet_project_id = row.get('samplesheet_project_id', None)
+                translated_project_id = row.get('translated_project_id', None)
+                if samplesheet_project_id is not None and translated_project_id is not None:
+                    project_id_translation[samplesheet_project_id] = translated_project_id
+
+    return project_id_translation
+
 
 def load_config(config_path: Path) -> dict[str, object]:
     """
@@ -16,15 +55,100 @@ def load_config(config_path: Path) -> dict[str, object]:
     with open(config_path, 'r') as f:
         config = json.load(f)
 
-    config['project_id_translation'] = {}
-
-    if 'project_id_translation_file' in config and os.path.exists(config['project_id_translation_file']):
-        with open(config['project_id_translation_file'], 'r') as f:
-            reader = csv.DictReader(f, dialect='unix')
-            for row in reader:
-                samplesheet_project_id = row.get('samplesheet_project_id', None)
-                translated_project_id = row.get('translated_project_id', None)
-                if samplesheet_project_id is not None and translated_project_id is not None:
-                    config['project_id_translation'][samplesheet_project_id] = translated_project_id
+    config['project_id_translation'] = load_project_id_translation(config.get('project_id_translation_file', None))
 
     return config
+
+
+def new_config_cache(config_path: Path) -> dict[str, object]:
+    """
+    Create a cache for the app config, for use with `get_config`.
+
+    :param config_path: Path to config file
+    :type config_path: Path
+    :return: Config cache. Keys: [config_path, config, base_config, config_file_signature, failed_config_file_signature, project_id_translation_file_signature]
+    :rtype: dict[str, object]
+    """
+    config_cache = {
+        'config_path': config_path,
+        # The config as returned by `get_config`, including the project ID translation table.
+        'config': {},
+        # The config as parsed from the config file.
+        'base_config': None,
+        'config_file_signature': None,
+        'failed_config_file_signature': None,
+        'project_id_translation_file_signature': None,
+    }
+
+    return config_cache
+
+
+def get_config(config_cache: dict[str, object]) -> dict[str, object]:
+    """
+    Get the app config. The config file and project ID translation file are only parsed again
+    when their mtime or size changes, so an unchanged config costs two `stat` calls.
+
+    If the config file can't be loaded, the last config that loaded successfully is kept, and the
+    failure is logged once for each version of the file. The config returned by a previous call is
+    never modified, so it can be safely held on to (e.g. by a run that is being collected).
+
+    :param config_cache: Config cache, as returned by `new_config_cache`. Updated in place.
+    :type config_cache: dict[str, object]
+    :return: App config
+    :rtype: dict[str, object]
+    """
+    config_path = config_cache['config_path']
+    config_file_signature = _get_file_signature(config_path)
+    config_file_changed = config_file_signature != config_cache['config_file_signature']
+    if config_file_changed and config_file_signature != config_cache['failed_config_file_signature']:
+        try:
+            with open(config_path, 'r') as f:
+                base_config = json.load(f)
+        except (json.decoder.JSONDecodeError, OSError) as e:
+            # If we fail to load the config file, we continue on with the
+            # last valid config that was loaded.
+            config_cache['failed_config_file_signature'] = config_file_signature
+            logging.error(json.dumps({
+                "event_type": "load_config_failed",
+                "config_file": os.path.abspath(config_path),
+                "error": str(e),
+                "using_last_known_good_config": config_cache['base_config'] is not None,
+            }))
+        else:
+            config_cache['base_config'] = base_config
+            config_cache['config_file_signature'] = config_file_signature
+            config_cache['failed_config_file_signature'] = None
+            # Make sure that the translation table is rebuilt into the new config.
+            config_cache['project_id_translation_file_signature'] = None
+            logging.info(json.dumps({
+                "event_type": "config_loaded",
+                "config_file": os.path.abspath(config_path),
+            }))
+
+    base_config = config_cache['base_config']
+    if base_config is None:
+        return config_cache['config']
+
+    project_id_translation_path = base_config.get('project_id_translation_file', None)
+    project_id_translation_file_signature = (project_id_translation_path, _get_file_signature(project_id_translation_path))
+    if project_id_translation_file_signature != config_cache['project_id_translation_file_signature']:
+        try:
+            project_id_translation = load_project_id_translation(project_id_translation_path)
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            logging.error(json.dumps({
+                "event_type": "load_project_id_translation_failed",
+                "project_id_translation_file": os.path.abspath(project_id_translation_path),
+                "error": str(e),
+            }))
+            project_id_translation = config_cache['config'].get('project_id_translation', {})
+        else:
+            if project_id_translation_path is not None:
+                logging.info(json.dumps({
+                    "event_type": "project_id_translation_loaded",
+                    "project_id_translation_file": os.path.abspath(project_id_translation_path),
+                    "num_project_ids": len(project_id_translation),
+                }))
+        config_cache['project_id_translation_file_signature'] = project_id_translation_file_signature
+        config_cache['config'] = {**base_config, 'project_id_translation': project_id_translation}
+
+    return config_cache['config']
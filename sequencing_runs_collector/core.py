@@ -3,13 +3,32 @@ import json
 import logging
 import os
 import re
+import sqlite3
+import time
 
 from typing import Iterable, Optional
 from pathlib import Path
 
+import sequencing_runs_collector.fastq_stats as fastq_stats_engine
+import sequencing_runs_collector.fastq_stats_cache as fastq_stats_cache
 import sequencing_runs_collector.illumina as illumina
+import sequencing_runs_collector.metrics as metrics
 import sequencing_runs_collector.nanopore as nanopore
 import sequencing_runs_collector.parsers.samplesheet as samplesheet
+import sequencing_runs_collector.run_parent_dir_scanner as run_parent_dir_scanner
+import sequencing_runs_collector.run_staging as run_staging
+import sequencing_runs_collector.run_state as run_state
+import sequencing_runs_collector.tracing as tracing
+
+DEFAULT_FAILED_RUN_RETRY_INTERVAL_SECONDS = 3600
+# Ways to order the runs that are waiting to be collected. Later policies break ties in earlier ones.
+RUN_PRIORITY_POLICIES = ['newest_first', 'oldest_first', 'smallest_first', 'instrument']
+DEFAULT_RUN_PRIORITY_POLICY = ['newest_first']
+DEFAULT_RUN_PRIORITY_INSTRUMENT_ORDER = ['MISEQ', 'NEXTSEQ', 'GRIDION', 'PROMETHION']
+# Number of runs at the front of the queue to include in each `run_queue` log event.
+NUM_RUN_QUEUE_RUNS_LOGGED = 10
+# Collected runs are checked for new demultiplexings for this long after they were last collected.
+DEFAULT_NEW_DEMULTIPLEXING_CHECK_DAYS = 30
 
 
 def get_instrument_info_by_sequencing_run_id(sequencing_run_id):
@@ -71,82 +90,424 @@ def run_id_to_date(run_id):
     return run_date
 
 
-def find_runs(config: dict[str, object]) -> Iterable[Optional[dict[str, object]]]:
+def load_priority_run_ids(run_priority_file: Optional[str]) -> list[str]:
     """
-    Find all sequencing runs under all of the `run_parent_dirs` from the config.
-    Runs are found by matching sub-directory names against the following regexes: `"\\d{6}_M\\d{5}_\\d+_\\d{9}-[A-Z0-9]{5}"` (MiSeq) and `"\\d{6}_VH\\d{5}_\\d+_[A-Z0-9]{9}"` (NextSeq)
+    Load the IDs of runs that should be collected before any others, from a control file with one run ID per line.
+    Blank lines, and lines starting with '#', are ignored.
 
+    :param run_priority_file: Path to the control file
+    :type run_priority_file: Optional[str]
+    :return: Run IDs, in the order that they should be collected. Empty if there is no control file.
+    :rtype: list[str]
+    """
+    priority_run_ids = []
+    if run_priority_file is None:
+        return priority_run_ids
+    try:
+        with open(run_priority_file, 'r') as f:
+            for line in f:
+                run_id = line.strip()
+                if run_id and not run_id.startswith('#') and run_id not in priority_run_ids:
+                    priority_run_ids.append(run_id)
+    except OSError as e:
+        pass
+
+    return priority_run_ids
+
+
+def _run_priority_key(run: dict[str, object], policies: list[str], instrument_order: list[str], priority_run_ids: list[str]) -> tuple:
+    """
+    Sort key for a run waiting to be collected. Runs in the priority control file come first, then the policies are applied in order.
+    Runs with no date, or no FASTQ size estimate, go last for the policies that need them.
+    """
+    key = [priority_run_ids.index(run['run_id']) if run['run_id'] in priority_run_ids else len(priority_run_ids)]
+    run_date = run_id_to_date(run['run_id'])
+    for policy in policies:
+        if policy == 'newest_first':
+            key.append(-int(run_date.replace('-', '')) if run_date else 0)
+        elif policy == 'oldest_first':
+            key.append(int(run_date.replace('-', '')) if run_date else float('inf'))
+        elif policy == 'smallest_first':
+            estimated_fastq_bytes = run.get('estimated_fastq_bytes', None)
+            key.append(estimated_fastq_bytes if estimated_fastq_bytes is not None else float('inf'))
+        elif policy == 'instrument':
+            instrument_model = run['instrument_model']
+            key.append(instrument_order.index(instrument_model) if instrument_model in instrument_order else len(instrument_order))
+    key.append(run['run_id'])
+
+    return tuple(key)
+
+
+def prioritize_runs(runs: list[dict[str, object]], config: dict[str, object], run_state_conn: sqlite3.Connection) -> list[dict[str, object]]:
+    """
+    Order the runs that are waiting to be collected.
+
+    Runs listed in the `run_priority_file` control file come first, in the order they are listed. The rest are ordered by
+    `run_priority_policy`: a list of policies from `RUN_PRIORITY_POLICIES` (default: `['newest_first']`).
+    The 'instrument' policy orders runs by `run_priority_instrument_order` (default: `DEFAULT_RUN_PRIORITY_INSTRUMENT_ORDER`).
+    For the 'smallest_first' policy, each Illumina run's FASTQ data is measured once, and stored in the run state store.
+
+    :param runs: Runs, as returned by `run_state.get_runs`
+    :type runs: list[dict[str, object]]
     :param config: Application config.
     :type config: dict[str, object]
-    :return: Dictionary of sequencin run info, indexed by sequencing run ID.
-    :rtype: Iterable[dict[str, object]]
-    """
-    run = {}
-    run_parent_dirs = config.get('run_parent_dirs', None)
-    if run_parent_dirs is not None:
-        for run_parent_dir in run_parent_dirs:
-            if run_parent_dir is not None and os.path.exists(run_parent_dir):
-                subdirs = os.scandir(run_parent_dir)
-                for subdir in subdirs:
-                    run = {}
-                    instrument_type = None
-                    instrument_model = None
-                    run_id = subdir.name
-                    if re.match(illumina.MISEQ_RUN_ID_REGEX, run_id):
-                        instrument_type = "ILLUMINA"
-                        instrument_model = "MISEQ"
-                    elif re.match(illumina.NEXTSEQ_RUN_ID_REGEX, run_id):
-                        instrument_type = "ILLUMINA"
-                        instrument_model = "NEXTSEQ"
-                    elif re.match(nanopore.GRIDION_RUN_ID_REGEX, run_id):
-                        instrument_type = "NANOPORE"
-                        instrument_model = "GRIDION"
-                    elif re.match(nanopore.PROMETHION_RUN_ID_REGEX, run_id):
-                        instrument_type = "NANOPORE"
-                        instrument_model = "PROMETHION"
-                    else:
-                        logging.info(json.dumps({'event_type': 'sequencing_run_skipped', 'directory': subdir.path}))
-                        yield None
-                    if subdir.is_dir() and instrument_model != None and os.path.exists(os.path.join(subdir.path, "upload_complete.json")):
-                        logging.debug(json.dumps({"event_type": "sequencing_run_found", "sequencing_run_id": run_id}))
-                        run = {
-                            "run_id": run_id,
-                            "instrument_type": instrument_type,
-                            "instrument_model": instrument_model,
-                            "run_dir": subdir.path,
-                        }
-
-                        yield run
-
-
-def scan(config):
+    :param run_state_conn: Connection to the run state store
+    :type run_state_conn: sqlite3.Connection
+    :return: Runs, highest priority first
+    :rtype: list[dict[str, object]]
+    """
+    policies = config.get('run_priority_policy', DEFAULT_RUN_PRIORITY_POLICY)
+    if isinstance(policies, str):
+        policies = [policies]
+    invalid_policies = [policy for policy in policies if policy not in RUN_PRIORITY_POLICIES]
+    if invalid_policies:
+        logging.error(json.dumps({
+            'event_type': 'invalid_run_priority_policy',
+            'run_priority_policy': invalid_policies,
+            'available_run_priority_policies': RUN_PRIORITY_POLICIES,
+        }))
+        policies = [policy for policy in policies if policy in RUN_PRIORITY_POLICIES] or DEFAULT_RUN_PRIORITY_POLICY
+    instrument_order = [instrument_model.upper() for instrument_model in config.get('run_priority_instrument_order', DEFAULT_RUN_PRIORITY_INSTRUMENT_ORDER)]
+    priority_run_ids = load_priority_run_ids(config.get('run_priority_file', None))
+
+    if 'smallest_first' in policies:
+        for run in runs:
+            if run.get('estimated_fastq_bytes', None) is None and run['instrument_type'] == 'ILLUMINA':
+                run['estimated_fastq_bytes'] = illumina.estimate_run_fastq_bytes(run['run_dir'], run['instrument_model'])
+                run_state.set_estimated_fastq_bytes(run_state_conn, run['run_id'], run['estimated_fastq_bytes'])
+
+    prioritized_runs = sorted(runs, key=lambda run: _run_priority_key(run, policies, instrument_order, priority_run_ids))
+
+    return prioritized_runs
+
+
+def get_run_parent_dirs(config: dict[str, object]) -> list[str]:
+    """
+    Get the run parent directories from the config, as absolute paths.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Absolute paths to run parent directories
+    :rtype: list[str]
+    """
+    run_parent_dirs = [os.path.abspath(d) for d in (config.get('run_parent_dirs', None) or []) if d is not None]
+
+    return run_parent_dirs
+
+
+def get_written_demultiplexing_ids(run_output_dir: Path) -> set[str]:
+    """
+    Get the IDs of the demultiplexings in a run's output directory.
+
+    :param run_output_dir: Run's output directory
+    :type run_output_dir: Path
+    :return: Demultiplexing IDs. Empty if the run has no output.
+    :rtype: set[str]
+    """
+    try:
+        demultiplexing_ids = set(os.listdir(os.path.join(run_output_dir, 'demultiplexings')))
+    except OSError as e:
+        demultiplexing_ids = set()
+
+    return demultiplexing_ids
+
+
+def find_runs(config: dict[str, object], run_state_conn: sqlite3.Connection, scanner: Optional[dict[str, object]] = None) -> Iterable[Optional[dict[str, object]]]:
+    """
+    Find sequencing runs that are ready to be collected, under all of the `run_parent_dirs` from the config.
+    Runs are found by matching sub-directory names against the run ID regexes for each instrument (see `get_instrument_info_by_sequencing_run_id`).
+
+    Runs are recorded in the run state store as they are found. A run parent directory is only listed
+    again when its mtime changes, which happens when run directories are added to it or removed from it.
+    Runs whose upload wasn't complete when they were found are checked again on every scan.
+    Runs that already have an output directory when they are found are recorded as 'collected'.
+
+    Illumina runs that were collected in the last `new_demultiplexing_check_days` are checked for new demultiplexings
+    (e.g. a new `Alignment_2/<timestamp>` or `Analysis/2`). A run with a new demultiplexing is queued again, and only
+    the new demultiplexings are collected (see `run_scheduler.collect_and_write_run`). A run is only checked again once the
+    directories that new demultiplexings are added to have changed (see `illumina.get_demultiplexing_parent_dirs_mtime_ns`),
+    or while one of its demultiplexings is still being written. Runs that already had output when they were found are treated
+    as collected when their output directory was last modified.
+
+    The run parent directories are scanned in parallel, with a deadline of `run_parent_dir_scan_timeout_seconds`
+    (see `run_parent_dir_scanner.scan_run_parent_dirs`). Runs under a directory that couldn't be scanned in time aren't queued.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_state_conn: Connection to the run state store
+    :type run_state_conn: sqlite3.Connection
+    :param scanner: Scanner state kept between scans, as returned by `run_parent_dir_scanner.new_scanner`. If None, degraded directories aren't remembered between scans.
+    :type scanner: Optional[dict[str, object]]
+    :return: Runs that are ready to be collected, or that failed at least `failed_run_retry_interval_seconds` ago (default: `scan_interval_seconds`),
+             highest priority first (see `prioritize_runs`). Keys: [run_id, instrument_type, instrument_model, run_dir, queue_position, queue_wait_seconds, collected_demultiplexing_ids] None is yielded for each directory that isn't a sequencing run.
+    :rtype: Iterable[Optional[dict[str, object]]]
+    """
+    if scanner is None:
+        scanner = run_parent_dir_scanner.new_scanner()
+    run_parent_dirs = get_run_parent_dirs(config)
+    output_directory = config.get('output_directory', None)
+    scan_timeout_seconds = float(config.get('run_parent_dir_scan_timeout_seconds', run_parent_dir_scanner.DEFAULT_RUN_PARENT_DIR_SCAN_TIMEOUT_SECONDS))
+    new_demultiplexing_check_seconds = float(config.get('new_demultiplexing_check_days', DEFAULT_NEW_DEMULTIPLEXING_CHECK_DAYS)) * 24 * 60 * 60
+    now = time.time()
+    scan_inputs_by_run_parent_dir = {}
+    for run_parent_dir in run_parent_dirs:
+        scan_inputs_by_run_parent_dir[run_parent_dir] = {
+            'last_scan': run_state.get_parent_dir_scan(run_state_conn, run_parent_dir),
+            'known_run_ids': run_state.get_run_ids(run_state_conn, run_parent_dir),
+            'pending_run_dirs': [run['run_dir'] for run in run_state.get_runs(run_state_conn, ['discovered'], [run_parent_dir])],
+            'collected_runs': sorted(
+                [
+                    run for run in run_state.get_runs(run_state_conn, ['collected'], [run_parent_dir])
+                    if run['instrument_type'] == 'ILLUMINA' and run['timestamp_collected'] is not None and now - run['timestamp_collected'] <= new_demultiplexing_check_seconds
+                ],
+                key=lambda run: run['timestamp_collected'],
+                reverse=True,
+            ),
+        }
+    scan_results = run_parent_dir_scanner.scan_run_parent_dirs(scanner, run_parent_dirs, scan_inputs_by_run_parent_dir, scan_timeout_seconds)
+
+    scanned_run_parent_dirs = []
+    for run_parent_dir in run_parent_dirs:
+        scan_result = scan_results.get(run_parent_dir, None)
+        if scan_result is None or scan_result['error'] is not None:
+            continue
+        scanned_run_parent_dirs.append(run_parent_dir)
+        if scan_result['entries'] is None:
+            logging.debug(json.dumps({"event_type": "run_parent_dir_unchanged", "run_parent_dir": run_parent_dir}))
+        else:
+            known_run_ids = scan_inputs_by_run_parent_dir[run_parent_dir]['known_run_ids']
+            present_run_ids = set()
+            for subdir in scan_result['entries']:
+                run_id = subdir['name']
+                instrument = get_instrument_info_by_sequencing_run_id(run_id)
+                if instrument['instrument_type'] == "UNKNOWN":
+                    logging.info(json.dumps({'event_type': 'sequencing_run_skipped', 'directory': subdir['path']}))
+                    yield None
+                    continue
+                if not subdir['is_dir']:
+                    continue
+                present_run_ids.add(run_id)
+                if run_id in known_run_ids:
+                    continue
+                run = {
+                    "run_id": run_id,
+                    "instrument_type": instrument['instrument_type'],
+                    "instrument_model": instrument['instrument_model'],
+                    "run_dir": subdir['path'],
+                }
+                run_status = 'ready' if subdir['upload_complete'] else 'discovered'
+                timestamp_collected = None
+                if output_directory is not None:
+                    try:
+                        timestamp_collected = os.stat(os.path.join(str(output_directory), instrument['instrument_type'].lower(), run_id)).st_mtime
+                        run_status = 'collected'
+                    except FileNotFoundError as e:
+                        pass
+                if run_state.add_run(run_state_conn, run, run_parent_dir, run_status, timestamp_collected):
+                    metrics.increment('runs_discovered_total')
+                    logging.debug(json.dumps({"event_type": "sequencing_run_discovered", "sequencing_run_id": run_id, "run_status": run_status}))
+            num_runs_removed = run_state.remove_missing_runs(run_state_conn, run_parent_dir, present_run_ids)
+            run_state.store_parent_dir_scan(run_state_conn, run_parent_dir, scan_result['mtime_ns'], scan_result['timestamp_scan_start_ns'])
+            logging.debug(json.dumps({
+                "event_type": "run_parent_dir_scanned",
+                "run_parent_dir": run_parent_dir,
+                "num_runs": len(present_run_ids),
+                "num_runs_removed": num_runs_removed,
+            }))
+
+        upload_complete_run_dirs = set(scan_result['upload_complete_run_dirs'])
+        for run in run_state.get_runs(run_state_conn, ['discovered'], [run_parent_dir]):
+            if run['run_dir'] in upload_complete_run_dirs:
+                run_state.set_run_status(run_state_conn, run['run_id'], 'ready')
+
+        if scan_result['num_demultiplexing_checks_deferred'] > 0:
+            logging.info(json.dumps({
+                "event_type": "demultiplexing_checks_deferred",
+                "run_parent_dir": run_parent_dir,
+                "num_runs": scan_result['num_demultiplexing_checks_deferred'],
+            }))
+        for run_id, demultiplexing_check in scan_result['demultiplexing_checks_by_run_id'].items():
+            if demultiplexing_check['demultiplexing_parent_dirs_mtime_ns'] is not None:
+                run_state.set_demultiplexing_parent_dirs_mtime_ns(run_state_conn, run_id, demultiplexing_check['demultiplexing_parent_dirs_mtime_ns'])
+            demultiplexings = demultiplexing_check['demultiplexings']
+            collected_demultiplexing_ids = run_state.get_collected_demultiplexing_ids(run_state_conn, run_id)
+            if not collected_demultiplexing_ids and output_directory is not None:
+                # Runs collected before demultiplexings were recorded. Their demultiplexings are in the output directory.
+                collected_demultiplexing_ids = get_written_demultiplexing_ids(os.path.join(str(output_directory), 'illumina', run_id))
+                run_state.add_collected_demultiplexings(run_state_conn, run_id, collected_demultiplexing_ids)
+            new_demultiplexing_ids = [
+                demultiplexing['demultiplexing_id'] for demultiplexing in demultiplexings
+                if demultiplexing['demultiplexing_id'] not in collected_demultiplexing_ids
+            ]
+            # A run with nothing recorded at all has no output to add to.
+            if new_demultiplexing_ids and collected_demultiplexing_ids:
+                run_state.set_run_status(run_state_conn, run_id, 'ready')
+                logging.info(json.dumps({
+                    "event_type": "new_demultiplexings_found",
+                    "sequencing_run_id": run_id,
+                    "demultiplexing_ids": sorted(new_demultiplexing_ids),
+                }))
+
+    # Failed runs wait before they are retried, so that a run that fails straight away isn't retried in a tight loop.
+    failed_run_retry_interval_seconds = float(config.get('failed_run_retry_interval_seconds', config.get('scan_interval_seconds', DEFAULT_FAILED_RUN_RETRY_INTERVAL_SECONDS)))
+    now = time.time()
+    queued_runs = [
+        run for run in run_state.get_runs(run_state_conn, ['ready', 'failed'], scanned_run_parent_dirs)
+        if run['status'] != 'failed' or now - run['timestamp_updated'] >= failed_run_retry_interval_seconds
+    ]
+    queued_runs = prioritize_runs(queued_runs, config, run_state_conn)
+    # Runs are queued from when they become ready, or from when they last failed.
+    queue_wait_seconds_by_run_id = {run['run_id']: round(now - run['timestamp_updated'], 3) for run in queued_runs}
+    metrics.set_gauge('runs_queued', len(queued_runs))
+    metrics.set_gauge('oldest_queued_run_age_seconds', max(queue_wait_seconds_by_run_id.values(), default=0))
+    if queued_runs:
+        logging.info(json.dumps({
+            "event_type": "run_queue",
+            "queue_depth": len(queued_runs),
+            "max_queue_wait_seconds": max(queue_wait_seconds_by_run_id.values()),
+            "queued_runs": [
+                {"sequencing_run_id": run['run_id'], "run_status": run['status'], "queue_wait_seconds": queue_wait_seconds_by_run_id[run['run_id']]}
+                for run in queued_runs[:NUM_RUN_QUEUE_RUNS_LOGGED]
+            ],
+        }))
+
+    for queue_position, run in enumerate(queued_runs):
+        logging.debug(json.dumps({"event_type": "sequencing_run_found", "sequencing_run_id": run['run_id'], "run_status": run['status']}))
+        yield {
+            "run_id": run['run_id'],
+            "instrument_type": run['instrument_type'],
+            "instrument_model": run['instrument_model'],
+            "run_dir": run['run_dir'],
+            "queue_position": queue_position,
+            "queue_wait_seconds": queue_wait_seconds_by_run_id[run['run_id']],
+            "collected_demultiplexing_ids": sorted(run_state.get_collected_demultiplexing_ids(run_state_conn, run['run_id'])),
+        }
+
+
+def scan(config, run_state_conn, scanner=None):
     """
     Scanning involves looking for all existing runs...
 
     :param config: Application config.
     :type config: dict[str, object]
+    :param run_state_conn: Connection to the run state store
+    :type run_state_conn: sqlite3.Connection
+    :param scanner: Scanner state kept between scans, as returned by `run_parent_dir_scanner.new_scanner`
+    :type scanner: Optional[dict[str, object]]
     :return: None
     :rtype: NoneType
     """
     logging.info(json.dumps({"event_type": "scan_start"}))
+    timestamp_scan_start = time.monotonic()
 
     logging.debug(json.dumps({"event_type": "find_runs_start"}))
     num_runs_found = 0
-    for run in find_runs(config):
+    for run in find_runs(config, run_state_conn, scanner):
         if run is not None:
+            num_runs_found += 1
             yield run
 
+    metrics.set_gauge('scan_duration_seconds', round(time.monotonic() - timestamp_scan_start, 3))
+    metrics.set_gauge('last_successful_scan_timestamp_seconds', round(time.time(), 3))
     logging.info(json.dumps({"event_type": "find_and_store_runs_complete", "num_runs_found": num_runs_found}))
 
 
-def collect_illumina_run(config, run):
+def update_fastq_stats_pool(fastq_stats_pool, config):
+    """
+    Make sure the FASTQ statistics worker pool matches the config.
+    The pool is kept for the life of the daemon. It is only replaced when `num_fastq_stats_collection_processes`
+    or `fastq_stats_max_tasks_per_worker` change, and is shut down if `collect_fastq_stats` is disabled.
+    Only call this between runs, while the pool is idle.
+
+    :param fastq_stats_pool: Current pool, as returned by a previous call. Keys: [pool, num_processes, max_tasks_per_worker]
+    :type fastq_stats_pool: Optional[dict[str, object]]
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Pool matching the config, or None if FASTQ statistics aren't being collected.
+    :rtype: Optional[dict[str, object]]
+    """
+    if not config.get('collect_fastq_stats', False):
+        close_fastq_stats_pool(fastq_stats_pool)
+        metrics.set_gauge('fastq_stats_pool_processes', 0)
+        return None
+
+    num_processes = config.get('num_fastq_stats_collection_processes', 1)
+    # Workers are replaced after this many tasks, so that memory held by a worker can't keep growing.
+    max_tasks_per_worker = config.get('fastq_stats_max_tasks_per_worker', None)
+    if fastq_stats_pool is not None:
+        if fastq_stats_pool['num_processes'] == num_processes and fastq_stats_pool['max_tasks_per_worker'] == max_tasks_per_worker:
+            return fastq_stats_pool
+        close_fastq_stats_pool(fastq_stats_pool)
+
+    fastq_stats_pool = {
+        'pool': illumina.new_fastq_stats_pool(num_processes, max_tasks_per_worker),
+        'num_processes': num_processes,
+        'max_tasks_per_worker': max_tasks_per_worker,
+    }
+    metrics.set_gauge('fastq_stats_pool_processes', num_processes)
+    logging.info(json.dumps({
+        'event_type': 'fastq_stats_pool_started',
+        'num_processes': num_processes,
+        'max_tasks_per_worker': max_tasks_per_worker,
+    }))
+
+    return fastq_stats_pool
+
+
+def close_fastq_stats_pool(fastq_stats_pool):
+    """
+    Shut down the FASTQ statistics worker pool, waiting for its workers to exit.
+
+    :param fastq_stats_pool: Pool, as returned by `update_fastq_stats_pool`
+    :type fastq_stats_pool: Optional[dict[str, object]]
+    :return: None
+    :rtype: NoneType
+    """
+    if fastq_stats_pool is None:
+        return
+    fastq_stats_pool['pool'].close()
+    fastq_stats_pool['pool'].join()
+    logging.info(json.dumps({
+        'event_type': 'fastq_stats_pool_closed',
+        'num_processes': fastq_stats_pool['num_processes'],
+    }))
+
+
+def _get_file_signature(path) -> Optional[list[int]]:
+    """
+    Get the mtime and size of a file or directory, or None if it doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        return None
+
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def collect_illumina_run(config, run, fastq_stats_pool=None, checkpoint_dir=None, skip_demultiplexing_ids=None):
     """
     Collect data for an Illumina sequencing run.
 
+    If `checkpoint_dir` is given, the sequenced libraries of each demultiplexing are checkpointed there as soon as
+    they have been collected, as are the statistics for each FASTQ file. If collection is interrupted, the next attempt
+    picks up from the checkpoints. A demultiplexing's checkpoint is only used if its SampleSheet, FASTQ directory,
+    and the config that affects its libraries, are unchanged.
+
+    Demultiplexings in `skip_demultiplexing_ids` (e.g. ones that have already been collected) are left out.
+
+    Each stage is timed with `tracing.span`, so that it appears in the run's collection profile.
+
     :param config: Application config.
     :type config: dict[str, object]
     :param run: Run directory. Keys: [run_id, run_dir]
     :type run: dict[str, object]
+    :param fastq_stats_pool: Worker pool for FASTQ statistics, as returned by `update_fastq_stats_pool`. If None, a pool is created for each demultiplexing.
+    :type fastq_stats_pool: Optional[dict[str, object]]
+    :param checkpoint_dir: Run's checkpoint directory (see `run_staging.get_run_staging_dir`). If None, nothing is checkpointed.
+    :type checkpoint_dir: Optional[str]
+    :param skip_demultiplexing_ids: IDs of demultiplexings not to collect
+    :type skip_demultiplexing_ids: Optional[set[str]]
     :return: Sequencing run data. Keys: [sequencing_run_id, flowcell_id, run_date, instrument_id, reads, clusters, yield, demultiplexings]
     :rtype: dict[str, object]
     """
@@ -166,51 +527,107 @@ def collect_illumina_run(config, run):
     sequencing_run['instrument_id'] = instrument.get('instrument_id')
 
     
-    interop_summary = illumina.get_illumina_interop_summary(run_dir)
+    with tracing.span('get_interop_summary'):
+        interop_summary = illumina.get_illumina_interop_summary(run_dir)
     sequencing_run.update(interop_summary)
-    runinfo = illumina.get_runinfo(run_dir)
+    with tracing.span('get_runinfo'):
+        runinfo = illumina.get_runinfo(run_dir)
     sequencing_run.update(runinfo)
 
-    demultiplexing_output_dirs = illumina.find_demultiplexing_output_dirs(run_dir, instrument['instrument_model'])
+    with tracing.span('find_demultiplexing_output_dirs'):
+        demultiplexing_output_dirs = illumina.find_demultiplexing_output_dirs(run_dir, instrument['instrument_model'])
 
     sequencing_run['demultiplexings'] = []
     for demultiplexing_output_dir in demultiplexing_output_dirs:
-        demultiplexing = {
-            'demultiplexing_id': None,
-            'demultiplexing_num': None,
-            'samplesheet_path': None,
-            'fastq_dir_path': None,
-            'timestamp_demultiplexing_started': None,
-            'sequenced_libraries': [],
-        }
-        demultiplexing_num = illumina.get_demultiplexing_num(run_id, demultiplexing_output_dir, instrument['instrument_model'])
-        demultiplexing['demultiplexing_num'] = demultiplexing_num
-        demultiplexing_id = '-'.join([run_id, "DEMUX", str(demultiplexing_num)])
-        demultiplexing['demultiplexing_id'] = demultiplexing_id
-        demultiplexing_start_timestamp = illumina.get_demultiplexing_start_timestamp(run_id, Path(demultiplexing_output_dir), instrument['instrument_model'])
-        demultiplexing['timestamp_demultiplexing_started'] = demultiplexing_start_timestamp
-        samplesheet_path = illumina.find_samplesheet(demultiplexing_output_dir, instrument['instrument_model'])
-        if samplesheet_path is not None:
-            samplesheet_path_relative = os.path.relpath(samplesheet_path, run_dir)
-        else:
-            samplesheet_path_relative = None
-        demultiplexing['samplesheet_path'] = samplesheet_path_relative
-        fastq_dir = illumina.find_fastq_output_dir(demultiplexing_output_dir, instrument['instrument_model'])
-        demultiplexing['fastq_dir_path'] = os.path.relpath(fastq_dir, run_dir)
-
-        if samplesheet_path is not None:
-            parsed_samplesheet = samplesheet.parse_samplesheet(samplesheet_path, instrument['instrument_type'], instrument['instrument_model'])
-            if instrument['instrument_model'].upper() == "MISEQ":
-                sequencing_run['experiment_name'] = parsed_samplesheet.get('header', {}).get('experiment_name', None)
-            elif instrument['instrument_model'].upper() == "NEXTSEQ":
-                sequencing_run['experiment_name'] = parsed_samplesheet.get('header', {}).get('run_name', None)
-
-            collect_fastq_stats = config.get('collect_fastq_stats', False)
-            num_fastq_stats_collection_processes = config.get('num_fastq_stats_collection_processes', 1)
-            sequenced_libraries = illumina.get_sequenced_libraries_from_samplesheet(parsed_samplesheet, instrument['instrument_model'], demultiplexing_output_dir, config['project_id_translation'], collect_fastq_stats, num_fastq_stats_collection_processes)
-            demultiplexing['sequenced_libraries'] = sequenced_libraries
+        demultiplexing_id = illumina.get_demultiplexing_id(run_id, demultiplexing_output_dir, instrument['instrument_model'])
+        if skip_demultiplexing_ids is not None and demultiplexing_id in skip_demultiplexing_ids:
+            logging.debug(json.dumps({'event_type': 'demultiplexing_skipped', 'demultiplexing_id': demultiplexing_id}))
+            continue
+        with tracing.span('collect_demultiplexing', demultiplexing_id=demultiplexing_id):
+            demultiplexing = {
+                'demultiplexing_id': None,
+                'demultiplexing_num': None,
+                'samplesheet_path': None,
+                'fastq_dir_path': None,
+                'timestamp_demultiplexing_started': None,
+                'sequenced_libraries': [],
+            }
+            demultiplexing_num = illumina.get_demultiplexing_num(run_id, demultiplexing_output_dir, instrument['instrument_model'])
+            demultiplexing['demultiplexing_num'] = demultiplexing_num
+            demultiplexing['demultiplexing_id'] = demultiplexing_id
+            demultiplexing_start_timestamp = illumina.get_demultiplexing_start_timestamp(run_id, Path(demultiplexing_output_dir), instrument['instrument_model'])
+            demultiplexing['timestamp_demultiplexing_started'] = demultiplexing_start_timestamp
+            samplesheet_path = illumina.find_samplesheet(demultiplexing_output_dir, instrument['instrument_model'])
+            if samplesheet_path is not None:
+                samplesheet_path_relative = os.path.relpath(samplesheet_path, run_dir)
+            else:
+                samplesheet_path_relative = None
+            demultiplexing['samplesheet_path'] = samplesheet_path_relative
+            fastq_dir = illumina.find_fastq_output_dir(demultiplexing_output_dir, instrument['instrument_model'])
+            demultiplexing['fastq_dir_path'] = os.path.relpath(fastq_dir, run_dir)
+
+            if samplesheet_path is not None:
+                with tracing.span('parse_samplesheet'):
+                    parsed_samplesheet = samplesheet.parse_samplesheet(samplesheet_path, instrument['instrument_type'], instrument['instrument_model'])
+                if instrument['instrument_model'].upper() == "MISEQ":
+                    sequencing_run['experiment_name'] = parsed_samplesheet.get('header', {}).get('experiment_name', None)
+                elif instrument['instrument_model'].upper() == "NEXTSEQ":
+                    sequencing_run['experiment_name'] = parsed_samplesheet.get('header', {}).get('run_name', None)
+
+                collect_fastq_stats = config.get('collect_fastq_stats', False)
+                num_fastq_stats_collection_processes = config.get('num_fastq_stats_collection_processes', 1)
+                pool = None
+                if fastq_stats_pool is not None:
+                    num_fastq_stats_collection_processes = fastq_stats_pool['num_processes']
+                    pool = fastq_stats_pool['pool']
+                chunked_fastq_stats_min_file_size_mb = config.get('chunked_fastq_stats_min_file_size_mb', None)
+                fastq_stats_cache_path = config.get('fastq_stats_cache_path', None)
+                fastq_stats_cache_max_entries = config.get('fastq_stats_cache_max_entries', fastq_stats_cache.DEFAULT_MAX_ENTRIES)
+                fastq_stats_mode = config.get('fastq_stats_mode', 'exact')
+                fastq_stats_sample_num_reads = config.get('fastq_stats_sample_num_reads', fastq_stats_engine.DEFAULT_SAMPLE_NUM_READS)
+                fastq_checksum_algorithm = config.get('fastq_checksum_algorithm', fastq_stats_engine.DEFAULT_HASH_ALGORITHM)
+                fastq_reader_backend = config.get('fastq_reader_backend', fastq_stats_engine.DEFAULT_READER_BACKEND)
+                # The reader backend and number of processes don't change the results, so they aren't part of the key.
+                checkpoint_key = {
+                    'demultiplexing_output_dir': os.path.abspath(demultiplexing_output_dir),
+                    'samplesheet': _get_file_signature(samplesheet_path),
+                    'fastq_dir': _get_file_signature(fastq_dir),
+                    'project_id_translation': config['project_id_translation'],
+                    'collect_fastq_stats': collect_fastq_stats,
+                    'fastq_stats_mode': fastq_stats_mode,
+                    'fastq_stats_sample_num_reads': fastq_stats_sample_num_reads,
+                    'fastq_checksum_algorithm': fastq_checksum_algorithm,
+                }
+                sequenced_libraries = None
+                if checkpoint_dir is not None:
+                    with tracing.span('load_demultiplexing_checkpoint'):
+                        sequenced_libraries = run_staging.load_demultiplexing_checkpoint(checkpoint_dir, demultiplexing_id, checkpoint_key)
+                if sequenced_libraries is None:
+                    with tracing.span('get_sequenced_libraries'):
+                        sequenced_libraries = illumina.get_sequenced_libraries_from_samplesheet(
+                            parsed_samplesheet,
+                            instrument['instrument_model'],
+                            demultiplexing_output_dir,
+                            config['project_id_translation'],
+                            collect_fastq_stats,
+                            num_fastq_stats_collection_processes,
+                            chunked_fastq_stats_min_file_size_mb,
+                            fastq_stats_cache_path,
+                            fastq_stats_cache_max_entries,
+                            run_id,
+                            pool,
+                            fastq_stats_mode,
+                            fastq_stats_sample_num_reads,
+                            fastq_checksum_algorithm,
+                            fastq_reader_backend,
+                            checkpoint_dir,
+                        )
+                    if checkpoint_dir is not None:
+                        run_staging.store_demultiplexing_checkpoint(checkpoint_dir, demultiplexing_id, checkpoint_key, sequenced_libraries)
+                demultiplexing['sequenced_libraries'] = sequenced_libraries
 
         sequencing_run['demultiplexings'].append(demultiplexing)
+        metrics.increment('demultiplexings_collected_total')
 
     return sequencing_run
 
@@ -229,7 +646,8 @@ def collect_nanopore_run(config, run):
     run_date = run_id_to_date(sequencing_run_id)
     sequencing_run['run_date'] = run_date
 
-    samplesheet_path = nanopore.find_samplesheet(run_dir, instrument_model)
+    with tracing.span('find_samplesheet'):
+        samplesheet_path = nanopore.find_samplesheet(run_dir, instrument_model)
     if not samplesheet_path:
         logging.error(json.dumps({
             'event_type': 'failed_to_find_samplesheet',
@@ -238,7 +656,8 @@ def collect_nanopore_run(config, run):
         }))
         return sequencing_run
     
-    parsed_samplesheet = samplesheet.parse_samplesheet(samplesheet_path, instrument_type, instrument_model)
+    with tracing.span('parse_samplesheet'):
+        parsed_samplesheet = samplesheet.parse_samplesheet(samplesheet_path, instrument_type, instrument_model)
     if not parsed_samplesheet:
         logging.error(json.dumps({
             'event_type': 'failed_to_parse_samplesheet',
@@ -257,7 +676,8 @@ def collect_nanopore_run(config, run):
         }
         sequencing_run['sequenced_libraries'].append(sequenced_library)
     
-    report_json_path = nanopore.find_report_json(run_dir, instrument_type)
+    with tracing.span('find_report_json'):
+        report_json_path = nanopore.find_report_json(run_dir, instrument_type)
     if not report_json_path:
         logging.error(json.dumps({
             'event_type': 'failed_to_find_report_json',
@@ -266,11 +686,94 @@ def collect_nanopore_run(config, run):
         }))
         return sequencing_run
         
-    parsed_report_json = nanopore.parse_report_json(report_json_path)
+    with tracing.span('parse_report_json'):
+        parsed_report_json = nanopore.parse_report_json(report_json_path)
 
     return sequencing_run
 
 
+def write_per_cycle_quality(sequenced_libraries: list[dict], output_path: Path):
+    """
+    Write the per-cycle quality profile of each library's FASTQ files, one row per library, read type and cycle.
+
+    :param sequenced_libraries: Sequenced libraries, with keys ['library_id', 'per_cycle_quality_r1', 'per_cycle_quality_r2']
+    :type sequenced_libraries: list[dict]
+    :param output_path: Path to write to
+    :type output_path: Path
+    :return: None
+    :rtype: NoneType
+    """
+    per_cycle_quality_output_fieldnames = [
+        "library_id",
+        "read_type",
+        "cycle",
+        "num_bases",
+        "mean_quality",
+        "q30_percent",
+    ]
+    with open(output_path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=per_cycle_quality_output_fieldnames, quoting=csv.QUOTE_MINIMAL)
+        writer.writeheader()
+        for sequenced_library in sequenced_libraries:
+            for read_type in ['R1', 'R2']:
+                per_cycle_quality = sequenced_library.get('per_cycle_quality_' + read_type.lower(), None)
+                if per_cycle_quality is None:
+                    continue
+                per_cycle_values = zip(per_cycle_quality['num_bases'], per_cycle_quality['quality_sum'], per_cycle_quality['num_bases_over_q30'])
+                for cycle_index, (num_bases, quality_sum, num_bases_over_q30) in enumerate(per_cycle_values):
+                    writer.writerow({
+                        'library_id': sequenced_library['library_id'],
+                        'read_type': read_type,
+                        'cycle': cycle_index + 1,
+                        'num_bases': num_bases,
+                        'mean_quality': round(quality_sum / num_bases, 4) if num_bases > 0 else None,
+                        'q30_percent': round(num_bases_over_q30 / num_bases * 100, 4) if num_bases > 0 else None,
+                    })
+
+
+def write_quality_histograms(sequenced_libraries: list[dict], output_path: Path):
+    """
+    Write the number of bases at each phred quality score for each library's FASTQ files,
+    for all bases and for the last 25 bases of each read. Quality scores with no bases are left out.
+    Each row also has the number of reads in the FASTQ file, which the last-25-bases percentages are calculated from.
+
+    :param sequenced_libraries: Sequenced libraries, with keys ['library_id', 'quality_histograms_r1', 'quality_histograms_r2']
+    :type sequenced_libraries: list[dict]
+    :param output_path: Path to write to
+    :type output_path: Path
+    :return: None
+    :rtype: NoneType
+    """
+    quality_histograms_output_fieldnames = [
+        "library_id",
+        "read_type",
+        "bases",
+        "quality",
+        "num_bases",
+        "num_reads",
+    ]
+    with open(output_path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=quality_histograms_output_fieldnames, quoting=csv.QUOTE_MINIMAL)
+        writer.writeheader()
+        for sequenced_library in sequenced_libraries:
+            for read_type in ['R1', 'R2']:
+                quality_histograms = sequenced_library.get('quality_histograms_' + read_type.lower(), None)
+                if quality_histograms is None:
+                    continue
+                for bases in ['all_bases', 'last_25_bases']:
+                    for quality, num_bases in enumerate(quality_histograms[bases]):
+                        if num_bases == 0:
+                            continue
+                        writer.writerow({
+                            'library_id': sequenced_library['library_id'],
+                            'read_type': read_type,
+                            'bases': bases,
+                            'quality': quality,
+                            'num_bases': num_bases,
+                            'num_reads': quality_histograms.get('num_reads', None),
+                        })
+
+
 def write_collected_illumina_run(collected_run: dict, run_output_path: Path):
     """
     """
@@ -300,10 +803,11 @@ def write_collected_illumina_run(collected_run: dict, run_output_path: Path):
     ]
 
     run_summary_output_path = os.path.join(run_output_path, f"{sequencing_run_id}_run_summary.csv")
-    with open(run_summary_output_path, 'w') as f:
-        writer = csv.DictWriter(f, fieldnames=run_summary_output_fieldnames, quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
-        writer.writeheader()
-        writer.writerow(collected_run)
+    with tracing.span('write_run_summary'):
+        with open(run_summary_output_path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=run_summary_output_fieldnames, quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerow(collected_run)
 
     run_demultiplexings_output_path = os.path.join(run_output_path, 'demultiplexings')
     os.makedirs(run_demultiplexings_output_path, exist_ok=True)
@@ -330,44 +834,92 @@ def write_collected_illumina_run(collected_run: dict, run_output_path: Path):
         "q30_percent_r1",
         "q30_percent_last_25_bases_r1",
         "fastq_md5_r1",
+        "fastq_checksum_r1",
+        "fastq_checksum_algorithm_r1",
+        "fastq_checksum_source_r1",
         "fastq_file_size_mb_r1",
         "q30_percent_r2",
         "q30_percent_last_25_bases_r2",
         "fastq_md5_r2",
+        "fastq_checksum_r2",
+        "fastq_checksum_algorithm_r2",
+        "fastq_checksum_source_r2",
         "fastq_file_size_mb_r2",
         "num_reads",
         "num_bases",
         "q30_percent",
         "q30_percent_last_25_bases",
+        "pairing_error",
+    ]
+    # Only written when FASTQ statistics were estimated from a sample of reads.
+    sampled_fastq_stats_output_fieldnames = [
+        "fastq_stats_mode",
+        "estimated_fields",
+        "q30_percent_r1_ci_lower",
+        "q30_percent_r1_ci_upper",
+        "q30_percent_last_25_bases_r1_ci_lower",
+        "q30_percent_last_25_bases_r1_ci_upper",
+        "mean_read_length_r1",
+        "mean_read_length_r1_ci_lower",
+        "mean_read_length_r1_ci_upper",
+        "q30_percent_r2_ci_lower",
+        "q30_percent_r2_ci_upper",
+        "q30_percent_last_25_bases_r2_ci_lower",
+        "q30_percent_last_25_bases_r2_ci_upper",
+        "mean_read_length_r2",
+        "mean_read_length_r2_ci_lower",
+        "mean_read_length_r2_ci_upper",
+        "q30_percent_ci_lower",
+        "q30_percent_ci_upper",
+        "q30_percent_last_25_bases_ci_lower",
+        "q30_percent_last_25_bases_ci_upper",
     ]
     for demultiplexing in collected_run['demultiplexings']:
         demultiplexing['sequencing_run_id'] = sequencing_run_id
         demultiplexing_id = demultiplexing['demultiplexing_id']
-        demultiplexing_output_dir = os.path.join(
-            run_demultiplexings_output_path,
-            demultiplexing_id,
-        )
-        os.makedirs(demultiplexing_output_dir, exist_ok=True)
-        demultiplexing_output_path = os.path.join(
-            demultiplexing_output_dir,
-            f"{demultiplexing_id}_demultiplexing.csv",
-        )
-        with open(demultiplexing_output_path, 'w') as f:
-            writer = csv.DictWriter(f, fieldnames=demultiplexing_output_fieldnames, quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
-            writer.writeheader()
-            writer.writerow(demultiplexing)
-
-        sequenced_libraries_output_path = os.path.join(
-            demultiplexing_output_dir,
-            f"{demultiplexing_id}_sequenced_libraries.csv"
-        )
-        with open(sequenced_libraries_output_path, 'w') as f:
-            writer = csv.DictWriter(f, fieldnames=sequenced_libraries_output_fieldnames, quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
-            writer.writeheader()
-            for sequenced_library in demultiplexing['sequenced_libraries']:
-                sequenced_library['sequencing_run_id'] = sequencing_run_id
-                sequenced_library['demultiplexing_id'] = demultiplexing_id
-                writer.writerow(sequenced_library)
+        with tracing.span('write_demultiplexing', demultiplexing_id=demultiplexing_id):
+            demultiplexing_output_dir = os.path.join(
+                run_demultiplexings_output_path,
+                demultiplexing_id,
+            )
+            os.makedirs(demultiplexing_output_dir, exist_ok=True)
+            demultiplexing_output_path = os.path.join(
+                demultiplexing_output_dir,
+                f"{demultiplexing_id}_demultiplexing.csv",
+            )
+            with open(demultiplexing_output_path, 'w') as f:
+                writer = csv.DictWriter(f, fieldnames=demultiplexing_output_fieldnames, quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerow(demultiplexing)
+
+            sequenced_libraries_output_path = os.path.join(
+                demultiplexing_output_dir,
+                f"{demultiplexing_id}_sequenced_libraries.csv"
+            )
+            fieldnames = sequenced_libraries_output_fieldnames
+            if any(sequenced_library.get('fastq_stats_mode', None) == 'sampled' for sequenced_library in demultiplexing['sequenced_libraries']):
+                fieldnames = sequenced_libraries_output_fieldnames + sampled_fastq_stats_output_fieldnames
+            with open(sequenced_libraries_output_path, 'w') as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+                writer.writeheader()
+                for sequenced_library in demultiplexing['sequenced_libraries']:
+                    sequenced_library['sequencing_run_id'] = sequencing_run_id
+                    sequenced_library['demultiplexing_id'] = demultiplexing_id
+                    writer.writerow(sequenced_library)
+
+            if any(sequenced_library.get('per_cycle_quality_r1', None) is not None for sequenced_library in demultiplexing['sequenced_libraries']):
+                per_cycle_quality_output_path = os.path.join(
+                    demultiplexing_output_dir,
+                    f"{demultiplexing_id}_per_cycle_quality.csv"
+                )
+                write_per_cycle_quality(demultiplexing['sequenced_libraries'], per_cycle_quality_output_path)
+
+            if any(sequenced_library.get('quality_histograms_r1', None) is not None for sequenced_library in demultiplexing['sequenced_libraries']):
+                quality_histograms_output_path = os.path.join(
+                    demultiplexing_output_dir,
+                    f"{demultiplexing_id}_quality_histograms.csv"
+                )
+                write_quality_histograms(demultiplexing['sequenced_libraries'], quality_histograms_output_path)
         
             
         
@@ -393,7 +945,8 @@ def write_collected_nanopore_run(collected_run: dict, run_output_path: Path):
 
     run_summary_output_path = os.path.join(run_output_path, f"{sequencing_run_id}_run_summary.csv")
     print(json.dumps(collected_run, indent=2))
-    with open(run_summary_output_path, 'w') as f:
-        writer = csv.DictWriter(f, fieldnames=run_summary_output_fieldnames, quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
-        writer.writeheader()
-        writer.writerow(collected_run)
+    with tracing.span('write_run_summary'):
+        with open(run_summary_output_path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=run_summary_output_fieldnames, quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerow(collected_run)
@@ -0,0 +1,159 @@
+import functools
+import json
+import logging
+import os
+import re
+
+from pathlib import Path
+from typing import Optional
+
+import sequencing_runs_collector.fastq_stats as fastq_stats_engine
+
+# Sidecar files sit next to the FASTQ file they describe, named after it plus one of these extensions.
+CHECKSUM_SIDECAR_EXTENSIONS = {
+    'md5': ['.md5'],
+    'sha1': ['.sha1'],
+    'sha256': ['.sha256'],
+    'blake2b': ['.blake2b', '.b2'],
+}
+# Manifests list the checksums for every file in their directory, one per line.
+CHECKSUM_MANIFEST_FILENAMES = {
+    'md5': ['md5sums.txt', 'md5sum.txt', 'MD5SUMS', 'checksums.md5'],
+    'sha1': ['sha1sums.txt', 'SHA1SUMS', 'checksums.sha1'],
+    'sha256': ['sha256sums.txt', 'SHA256SUMS', 'checksums.sha256'],
+    'blake2b': ['b2sums.txt', 'B2SUMS', 'checksums.blake2b'],
+}
+# The tags used by `md5sum --tag`, `sha256sum --tag`, `b2sum --tag` etc.
+CHECKSUM_TAGS = {
+    'MD5': 'md5',
+    'SHA1': 'sha1',
+    'SHA256': 'sha256',
+    'BLAKE2b': 'blake2b',
+}
+# "<checksum>  <filename>" or "<checksum> *<filename>", as written by `md5sum` and friends
+CHECKSUM_LINE_REGEX = re.compile(r'^\\?(?P<checksum>[0-9a-fA-F]+) [ *](?P<filename>.+)$')
+# "<TAG> (<filename>) = <checksum>", as written with `--tag`
+CHECKSUM_TAG_LINE_REGEX = re.compile(r'^\\?(?P<tag>[A-Za-z0-9-]+) \((?P<filename>.+)\) = (?P<checksum>[0-9a-fA-F]+)$')
+
+
+def _is_valid_checksum(checksum: str, hash_algorithm: str) -> bool:
+    """
+    Check that a checksum is a hex string of the right length for its hash algorithm.
+    """
+    digest_size = fastq_stats_engine.HASH_ALGORITHM_DIGEST_SIZES[hash_algorithm]
+
+    return len(checksum) == 2 * digest_size and re.fullmatch(r'[0-9a-fA-F]+', checksum) is not None
+
+
+def parse_checksum_lines(lines: list[str], hash_algorithm: str) -> dict[str, str]:
+    """
+    Parse checksum lines, in the formats written by `md5sum` and related tools, with or without `--tag`.
+
+    Lines that are for a different hash algorithm, or that aren't valid checksums, are skipped.
+
+    :param lines: Lines from a checksum sidecar or manifest
+    :type lines: list[str]
+    :param hash_algorithm: Hash algorithm that the checksums were made with
+    :type hash_algorithm: str
+    :return: Checksums (lowercase hex), indexed by file name. A checksum with no file name is indexed by ''.
+    :rtype: dict[str, str]
+    """
+    checksums_by_filename = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        tag_line_match = CHECKSUM_TAG_LINE_REGEX.match(line)
+        line_match = CHECKSUM_LINE_REGEX.match(line)
+        if tag_line_match:
+            if CHECKSUM_TAGS.get(tag_line_match.group('tag'), None) != hash_algorithm:
+                continue
+            checksum = tag_line_match.group('checksum')
+            filename = tag_line_match.group('filename')
+        elif line_match:
+            checksum = line_match.group('checksum')
+            filename = line_match.group('filename')
+        else:
+            # A sidecar may hold just the checksum.
+            checksum = line.split()[0]
+            filename = ''
+        if not _is_valid_checksum(checksum, hash_algorithm):
+            continue
+        checksums_by_filename[os.path.basename(filename)] = checksum.lower()
+
+    return checksums_by_filename
+
+
+@functools.lru_cache(maxsize=64)
+def _load_checksum_manifest(manifest_path: str, mtime_ns: int, hash_algorithm: str) -> dict[str, str]:
+    """
+    Load a checksum manifest. Results are cached by path and mtime, since every FASTQ file in a directory shares one manifest.
+    """
+    with open(manifest_path, 'r', errors='replace') as f:
+        checksums_by_filename = parse_checksum_lines(f.readlines(), hash_algorithm)
+
+    return checksums_by_filename
+
+
+def find_existing_checksum(fastq_path: Path, hash_algorithm: str = fastq_stats_engine.DEFAULT_HASH_ALGORITHM) -> Optional[dict[str, str]]:
+    """
+    Find a checksum for a FASTQ file that has already been calculated, for example by the upload tooling.
+
+    A sidecar file next to the FASTQ file (e.g. `sample_S1_L001_R1_001.fastq.gz.md5`) is checked first,
+    then a checksum manifest in the same directory (e.g. `md5sums.txt`). Sidecars and manifests that are
+    older than the FASTQ file are ignored. Only checksums made with `hash_algorithm` are used, so that a file with
+    a checksum made with some other algorithm is still hashed with the configured one (e.g. md5, for `fastq_md5_r1`).
+
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: Path
+    :param hash_algorithm: Hash algorithm
+    :type hash_algorithm: str
+    :return: Checksum, or None if there is no usable existing checksum. Keys: ['checksum', 'checksum_algorithm', 'checksum_source', 'checksum_path']
+    :rtype: Optional[dict[str, str]]
+    """
+    try:
+        fastq_mtime_ns = os.stat(fastq_path).st_mtime_ns
+    except OSError as e:
+        return None
+
+    fastq_dir = os.path.dirname(os.path.abspath(fastq_path))
+    fastq_filename = os.path.basename(fastq_path)
+    for extension in CHECKSUM_SIDECAR_EXTENSIONS.get(hash_algorithm, []):
+        sidecar_path = os.path.abspath(fastq_path) + extension
+        try:
+            if os.stat(sidecar_path).st_mtime_ns < fastq_mtime_ns:
+                logging.debug(json.dumps({'event_type': 'fastq_checksum_sidecar_out_of_date', 'checksum_path': sidecar_path}))
+                continue
+            with open(sidecar_path, 'r', errors='replace') as f:
+                checksums_by_filename = parse_checksum_lines(f.readlines(), hash_algorithm)
+        except OSError as e:
+            continue
+        checksum = checksums_by_filename.get(fastq_filename, checksums_by_filename.get('', None))
+        if checksum is not None:
+            return {
+                'checksum': checksum,
+                'checksum_algorithm': hash_algorithm,
+                'checksum_source': 'sidecar',
+                'checksum_path': sidecar_path,
+            }
+
+    for manifest_filename in CHECKSUM_MANIFEST_FILENAMES.get(hash_algorithm, []):
+        manifest_path = os.path.join(fastq_dir, manifest_filename)
+        try:
+            manifest_mtime_ns = os.stat(manifest_path).st_mtime_ns
+            if manifest_mtime_ns < fastq_mtime_ns:
+                logging.debug(json.dumps({'event_type': 'fastq_checksum_manifest_out_of_date', 'checksum_path': manifest_path}))
+                continue
+            checksums_by_filename = _load_checksum_manifest(manifest_path, manifest_mtime_ns, hash_algorithm)
+        except OSError as e:
+            continue
+        checksum = checksums_by_filename.get(fastq_filename, None)
+        if checksum is not None:
+            return {
+                'checksum': checksum,
+                'checksum_algorithm': hash_algorithm,
+                'checksum_source': 'manifest',
+                'checksum_path': manifest_path,
+            }
+
+    return None
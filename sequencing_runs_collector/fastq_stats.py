@@ -0,0 +1,1385 @@
+import collections
+import hashlib
+import itertools
+import operator
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+import numpy as np
+
+# Optional faster gzip decompressors. Both are drop-in replacements for the stdlib zlib module.
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    zlib_ng = None
+try:
+    import pyfastx
+except ImportError:
+    pyfastx = None
+
+
+PHRED_OFFSET = 33
+Q30_THRESHOLD = 30
+NUM_LAST_BASES = 25
+# Phred+33 quality scores run from 0 ('!') to 93 ('~').
+MAX_PHRED_QUALITY = 93
+DEFAULT_BATCH_SIZE = 10000
+READ_CHUNK_SIZE_BYTES = 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+DEFAULT_CHUNK_SIZE_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_CHUNKS_IN_FLIGHT = 16
+BGZF_HEADER_SIZE_BYTES = 18
+DEFAULT_SAMPLE_NUM_READS = 100000
+DEFAULT_SAMPLE_NUM_WINDOWS = 32
+SAMPLE_BLOCK_NUM_READS = 100
+SAMPLE_MEMBER_SEARCH_BYTES = 4 * 1024 * 1024
+SAMPLE_READ_CHUNK_SIZE_BYTES = 64 * 1024
+SAMPLE_MEMBER_CHECK_BYTES = 16 * 1024
+CONFIDENCE_LEVEL = 0.95
+CONFIDENCE_INTERVAL_Z = 1.96
+DEFAULT_READER_BACKEND = 'zlib'
+# Decompressed chunks that the 'threaded' reader backend may hold while the parser catches up.
+THREADED_READER_MAX_QUEUED_CHUNKS = 16
+PYFASTX_READER_BATCH_SIZE = 10000
+# Hash algorithms that can be used for the 'checksum' metric. md5 is the default, for compatibility
+# with existing checksums. blake2b is usually faster on 64-bit machines.
+HASH_ALGORITHMS = ['md5', 'sha1', 'sha256', 'blake2b']
+DEFAULT_HASH_ALGORITHM = 'md5'
+HASH_ALGORITHM_DIGEST_SIZES = {hash_algorithm: hashlib.new(hash_algorithm).digest_size for hash_algorithm in HASH_ALGORITHMS}
+# Read lengths below this each get their own histogram bin. Longer reads are binned
+# on a log scale, with this many bins per doubling of read length, so the relative
+# width of each bin is at most 1/64. The histogram covers reads up to 2^40 bases.
+READ_LENGTH_HISTOGRAM_NUM_EXACT_BINS = 1024
+READ_LENGTH_HISTOGRAM_BINS_PER_DOUBLING = 64
+READ_LENGTH_HISTOGRAM_MAX_LOG2_LENGTH = 40
+_READ_LENGTH_HISTOGRAM_MIN_LOG2_LENGTH = READ_LENGTH_HISTOGRAM_NUM_EXACT_BINS.bit_length() - 1
+READ_LENGTH_HISTOGRAM_NUM_BINS = READ_LENGTH_HISTOGRAM_NUM_EXACT_BINS + (READ_LENGTH_HISTOGRAM_MAX_LOG2_LENGTH - _READ_LENGTH_HISTOGRAM_MIN_LOG2_LENGTH) * READ_LENGTH_HISTOGRAM_BINS_PER_DOUBLING
+# GC and N content histograms have one bin per whole percent, 0-100.
+CONTENT_HISTOGRAM_NUM_BINS = 101
+_GC_BASES = np.zeros(256, dtype=np.uint8)
+_GC_BASES[list(b'GCgc')] = 1
+_N_BASES = np.zeros(256, dtype=np.uint8)
+_N_BASES[list(b'Nn')] = 1
+
+# Metrics that can be requested from `collect_fastq_stats`:
+#   num_reads:  'num_reads'
+#   num_bases:  'num_bases'
+#   read_length: 'min_read_length', 'max_read_length', 'mean_read_length'
+#   q30:        'num_bases_over_q30'
+#   q30_last_n: 'num_bases_over_q30_last_n', 'num_last_bases'
+#   per_cycle_quality: 'per_cycle_quality'
+#   quality_histogram: 'quality_histogram', 'quality_histogram_last_n', 'num_last_bases'
+#   read_length_distribution: 'read_length_histogram', 'read_length_n50'
+#   base_composition: 'num_gc_bases', 'num_n_bases', 'gc_content_histogram', 'n_content_histogram'
+#   md5:        'md5'
+#   checksum:   'checksum', 'checksum_algorithm'
+#   file_size:  'file_size_bytes'
+ALL_METRICS = frozenset([
+    'num_reads',
+    'num_bases',
+    'read_length',
+    'q30',
+    'q30_last_n',
+    'per_cycle_quality',
+    'quality_histogram',
+    'read_length_distribution',
+    'base_composition',
+    'md5',
+    'checksum',
+    'file_size',
+])
+
+
+def count_quality_batch(quals: list[bytes], quality_threshold: int = Q30_THRESHOLD, num_last_bases: int = NUM_LAST_BASES, count_histograms: bool = False) -> dict[str, object]:
+    """
+    Count the bases at or above a quality threshold for a batch of reads.
+
+    The quality strings for the whole batch are joined into a single contiguous
+    byte array so that the comparison happens in one vectorized operation,
+    rather than one python-level operation per base.
+
+    If `count_histograms` is set, the number of bases at each phred quality score (0-93) is also counted,
+    and the threshold counts are taken from the histograms.
+
+    :param quals: Quality strings (phred+33 encoded), one per read
+    :type quals: list[bytes]
+    :param quality_threshold: Minimum phred quality score to count
+    :type quality_threshold: int
+    :param num_last_bases: Number of bases at the end of each read to count separately. If 0, none are counted.
+    :type num_last_bases: int
+    :param count_histograms: Whether to count the bases at each quality score
+    :type count_histograms: bool
+    :return: Base counts. Keys: ['num_bases_over_q30', 'num_bases_over_q30_last_n'],
+             plus ['quality_histogram', 'quality_histogram_last_n'] if `count_histograms` is set.
+    :rtype: dict[str, object]
+    """
+    threshold_char = quality_threshold + PHRED_OFFSET
+
+    all_quals = np.frombuffer(b''.join(quals), dtype=np.uint8)
+    if num_last_bases > 0:
+        last_bases = operator.itemgetter(slice(-num_last_bases, None))
+        last_quals = np.frombuffer(b''.join(map(last_bases, quals)), dtype=np.uint8)
+    else:
+        # slice(-0, None) would be the whole read, rather than none of it.
+        last_quals = np.empty(0, dtype=np.uint8)
+
+    if count_histograms:
+        quality_histogram = _quality_histogram(all_quals)
+        quality_histogram_last_n = _quality_histogram(last_quals)
+        counts = {
+            'num_bases_over_q30': int(quality_histogram[quality_threshold:].sum()),
+            'num_bases_over_q30_last_n': int(quality_histogram_last_n[quality_threshold:].sum()),
+            'quality_histogram': quality_histogram,
+            'quality_histogram_last_n': quality_histogram_last_n,
+        }
+    else:
+        counts = {
+            'num_bases_over_q30': int(np.count_nonzero(all_quals >= threshold_char)),
+            'num_bases_over_q30_last_n': int(np.count_nonzero(last_quals >= threshold_char)),
+        }
+
+    return counts
+
+
+def _quality_histogram(quals: np.ndarray) -> np.ndarray:
+    """
+    Count the bases at each phred quality score, from 0 to `MAX_PHRED_QUALITY`.
+    Characters outside the phred+33 range are counted in the nearest bin.
+    """
+    char_counts = np.bincount(quals, minlength=256).astype(np.int64)
+    quality_histogram = char_counts[PHRED_OFFSET:PHRED_OFFSET + MAX_PHRED_QUALITY + 1].copy()
+    quality_histogram[0] += char_counts[:PHRED_OFFSET].sum()
+    quality_histogram[-1] += char_counts[PHRED_OFFSET + MAX_PHRED_QUALITY + 1:].sum()
+
+    return quality_histogram
+
+
+def count_per_cycle_quality(quals: list[bytes], quality_threshold: int = Q30_THRESHOLD) -> dict[str, np.ndarray]:
+    """
+    Count bases, sum phred quality scores, and count bases at or above a quality threshold, at each cycle (position in the read).
+
+    The arrays are as long as the longest read, so memory use depends on read length, not on the number of reads.
+    When every read in the batch has the same length the quality strings are viewed as a 2D array and summed by column.
+    Otherwise each base is labelled with its cycle number and the counts are made with `np.bincount`.
+
+    :param quals: Quality strings (phred+33 encoded), one per read
+    :type quals: list[bytes]
+    :param quality_threshold: Minimum phred quality score to count
+    :type quality_threshold: int
+    :return: Per-cycle counts. Keys: ['num_bases', 'quality_sum', 'num_bases_over_q30']
+    :rtype: dict[str, np.ndarray]
+    """
+    threshold_char = quality_threshold + PHRED_OFFSET
+    num_reads = len(quals)
+    read_lengths = np.fromiter(map(len, quals), dtype=np.int64, count=num_reads)
+    max_read_length = int(read_lengths.max()) if num_reads > 0 else 0
+    all_quals = np.frombuffer(b''.join(quals), dtype=np.uint8)
+
+    if num_reads > 0 and np.all(read_lengths == max_read_length):
+        quals_by_cycle = all_quals.reshape(num_reads, max_read_length)
+        num_bases = np.full(max_read_length, num_reads, dtype=np.int64)
+        quality_sum = quals_by_cycle.sum(axis=0, dtype=np.int64) - PHRED_OFFSET * num_bases
+        num_bases_over_threshold = np.count_nonzero(quals_by_cycle >= threshold_char, axis=0).astype(np.int64)
+    else:
+        read_starts = np.cumsum(read_lengths) - read_lengths
+        cycles = np.arange(all_quals.size, dtype=np.int64) - np.repeat(read_starts, read_lengths)
+        num_bases = np.bincount(cycles, minlength=max_read_length).astype(np.int64)
+        quality_sum = np.bincount(cycles, weights=all_quals, minlength=max_read_length).astype(np.int64) - PHRED_OFFSET * num_bases
+        num_bases_over_threshold = np.bincount(cycles[all_quals >= threshold_char], minlength=max_read_length).astype(np.int64)
+
+    per_cycle_counts = {
+        'num_bases': num_bases,
+        'quality_sum': quality_sum,
+        'num_bases_over_q30': num_bases_over_threshold,
+    }
+
+    return per_cycle_counts
+
+
+def _add_arrays(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Add two 1D arrays, padding the shorter one with zeroes.
+    """
+    if a.size < b.size:
+        a, b = b, a
+    total = a.copy()
+    total[:b.size] += b
+
+    return total
+
+
+def iter_decompressed_chunks(fastq_path: Path, file_hash, io_stats: dict[str, object], start_offset: int = 0, end_offset: Optional[int] = None, read_chunk_size_bytes: int = READ_CHUNK_SIZE_BYTES, zlib_module=zlib) -> Iterator[bytes]:
+    """
+    Read a (optionally gzipped) FASTQ file from disk exactly once.
+
+    Every compressed chunk is added to `file_hash` before it is handed to the
+    decompressor, so the checksum of the file on disk is available as soon as
+    the last record has been parsed. Multi-member gzip files (as written by
+    bcl-convert and bcl2fastq) are supported. Uncompressed files are passed through.
+
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: Path
+    :param file_hash: Hash object (from `hashlib`) to update with the raw file contents, or None to skip hashing
+    :type file_hash: Optional[hashlib._Hash]
+    :param io_stats: Updated in-place with the number of bytes read from disk. Keys: ['bytes_read']
+    :type io_stats: dict[str, object]
+    :param start_offset: Byte offset to start reading from. For gzip files, this must be the start of a gzip member.
+    :type start_offset: int
+    :param end_offset: Byte offset to stop reading at. If given, a gzip member that is cut off there is not treated as truncated.
+    :type end_offset: Optional[int]
+    :param read_chunk_size_bytes: Number of bytes to read from disk at a time
+    :type read_chunk_size_bytes: int
+    :param zlib_module: Module to decompress with. Must have the same `decompressobj` interface as `zlib`.
+    :type zlib_module: module
+    :return: Decompressed chunks of the file
+    :rtype: Iterator[bytes]
+    :raises EOFError: If a gzip member is truncated
+    :raises zlib.error: If the file is not valid gzip data
+    """
+    io_stats['bytes_read'] = 0
+    member_in_progress = False
+    with open(fastq_path, 'rb') as f:
+        f.seek(start_offset)
+
+        def read_chunk():
+            if end_offset is None:
+                return f.read(read_chunk_size_bytes)
+            return f.read(max(0, min(read_chunk_size_bytes, end_offset - f.tell())))
+
+        chunk = read_chunk()
+        is_gzipped = chunk.startswith(GZIP_MAGIC)
+        decompressor = zlib_module.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        while chunk:
+            if file_hash is not None:
+                file_hash.update(chunk)
+            io_stats['bytes_read'] += len(chunk)
+            if not is_gzipped:
+                yield chunk
+            else:
+                while chunk:
+                    if not member_in_progress:
+                        # gzip files may be padded with zeroes after the last member
+                        chunk = chunk.lstrip(b'\x00')
+                        if not chunk:
+                            break
+                        member_in_progress = True
+                    decompressed = decompressor.decompress(chunk)
+                    if decompressed:
+                        yield decompressed
+                    if decompressor.eof:
+                        chunk = decompressor.unused_data
+                        decompressor = zlib_module.decompressobj(wbits=zlib.MAX_WBITS | 16)
+                        member_in_progress = False
+                    else:
+                        chunk = b''
+            chunk = read_chunk()
+
+    if member_in_progress and end_offset is None:
+        raise EOFError(f"Compressed file ended before the end-of-stream marker was reached: {fastq_path}")
+
+
+# Reader backends turn a FASTQ file into a stream of decompressed chunks, for `iter_record_batches`.
+# Each one is a function with the signature:
+#
+#   reader(fastq_path: Path, file_hash, io_stats: dict[str, object]) -> Iterator[bytes]
+#
+# and must update `file_hash` with the raw file contents and set `io_stats['bytes_read']`,
+# in the same way as `iter_decompressed_chunks`.
+
+def _fast_zlib_module():
+    """
+    The fastest installed gzip decompressor (python-isal, then zlib-ng), or None if neither is installed.
+    """
+    if isal_zlib is not None:
+        return isal_zlib
+    if zlib_ng is not None:
+        return zlib_ng
+
+    return None
+
+
+def read_with_zlib(fastq_path: Path, file_hash, io_stats: dict[str, object]) -> Iterator[bytes]:
+    """
+    Reader backend: read and decompress with the stdlib zlib module, in the calling thread.
+    """
+    return iter_decompressed_chunks(fastq_path, file_hash, io_stats)
+
+
+def read_with_fast_gzip(fastq_path: Path, file_hash, io_stats: dict[str, object]) -> Iterator[bytes]:
+    """
+    Reader backend: read and decompress with python-isal or zlib-ng, whichever is installed, in the calling thread.
+    Their errors are raised as `zlib.error`, like the stdlib decompressor's.
+    """
+    zlib_module = _fast_zlib_module()
+    if zlib_module is None:
+        raise ValueError("The 'fast_gzip' reader backend requires python-isal or zlib-ng to be installed")
+    try:
+        yield from iter_decompressed_chunks(fastq_path, file_hash, io_stats, zlib_module=zlib_module)
+    except zlib_module.error as e:
+        raise zlib.error(str(e)) from e
+
+
+def _iter_in_thread(chunks: Iterator[bytes], max_queued_chunks: int) -> Iterator[bytes]:
+    """
+    Pull chunks from `chunks` in a background thread, so that reading and decompression overlap
+    with whatever the caller does with each chunk. zlib and hashlib release the GIL while they work.
+    Exceptions raised in the background thread are re-raised in the caller.
+    """
+    chunk_queue = queue.Queue(maxsize=max_queued_chunks)
+    stop = threading.Event()
+    end_of_chunks = object()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                while not stop.is_set():
+                    try:
+                        chunk_queue.put(chunk, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            chunk_queue.put(end_of_chunks)
+        except BaseException as e:
+            chunk_queue.put(e)
+
+    producer = threading.Thread(target=produce, name='fastq-reader', daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = chunk_queue.get()
+            if item is end_of_chunks:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def read_with_thread(fastq_path: Path, file_hash, io_stats: dict[str, object]) -> Iterator[bytes]:
+    """
+    Reader backend: read, hash and decompress in a separate thread that feeds the parser through a bounded queue.
+    Uses python-isal or zlib-ng if installed, otherwise the stdlib zlib module.
+    """
+    zlib_module = _fast_zlib_module() or zlib
+    chunks = iter_decompressed_chunks(fastq_path, file_hash, io_stats, zlib_module=zlib_module)
+    try:
+        yield from _iter_in_thread(chunks, THREADED_READER_MAX_QUEUED_CHUNKS)
+    except zlib_module.error as e:
+        if zlib_module is zlib:
+            raise
+        raise zlib.error(str(e)) from e
+
+
+def read_with_pyfastx(fastq_path: Path, file_hash, io_stats: dict[str, object]) -> Iterator[bytes]:
+    """
+    Reader backend: parse with pyfastx, without building an index, and re-serialize the records.
+
+    pyfastx reads the file itself, so the file is read a second time if it needs to be hashed.
+    Record headers keep their full text, including any comment after the read ID.
+    """
+    if pyfastx is None:
+        raise ValueError("The 'pyfastx' reader backend requires pyfastx to be installed")
+    file_size_bytes = os.path.getsize(fastq_path)
+    io_stats['bytes_read'] = file_size_bytes
+    try:
+        records = pyfastx.Fastq(str(fastq_path), build_index=False, full_name=True)
+        batch = []
+        for name, seq, qual in records:
+            batch.append(f"@{name}\n{seq}\n+\n{qual}\n")
+            if len(batch) >= PYFASTX_READER_BATCH_SIZE:
+                yield ''.join(batch).encode()
+                batch = []
+        if batch:
+            yield ''.join(batch).encode()
+    except RuntimeError as e:
+        raise ValueError(f"pyfastx could not read {fastq_path}: {e}") from e
+
+    if file_hash is not None:
+        with open(fastq_path, 'rb') as f:
+            while chunk := f.read(READ_CHUNK_SIZE_BYTES):
+                file_hash.update(chunk)
+                io_stats['bytes_read'] += len(chunk)
+
+
+READER_BACKENDS = {
+    'zlib': read_with_zlib,
+    'fast_gzip': read_with_fast_gzip,
+    'threaded': read_with_thread,
+    'pyfastx': read_with_pyfastx,
+}
+
+
+def available_reader_backends() -> list[str]:
+    """
+    Get the names of the reader backends whose dependencies are installed.
+
+    :return: Reader backend names. See `READER_BACKENDS`.
+    :rtype: list[str]
+    """
+    available = ['zlib', 'threaded']
+    if _fast_zlib_module() is not None:
+        available.append('fast_gzip')
+    if pyfastx is not None:
+        available.append('pyfastx')
+
+    return [name for name in READER_BACKENDS if name in available]
+
+
+def get_reader_backend(reader_backend: str) -> Callable[..., Iterator[bytes]]:
+    """
+    Look up a reader backend by name.
+
+    :param reader_backend: Reader backend name. See `READER_BACKENDS`.
+    :type reader_backend: str
+    :return: Reader backend function
+    :rtype: Callable[..., Iterator[bytes]]
+    :raises ValueError: If the backend is unknown, or its dependencies aren't installed
+    """
+    if reader_backend not in READER_BACKENDS:
+        raise ValueError(f"Unknown FASTQ reader backend: {reader_backend}. Supported: {list(READER_BACKENDS)}")
+    if reader_backend not in available_reader_backends():
+        raise ValueError(f"FASTQ reader backend '{reader_backend}' is not available. Available: {available_reader_backends()}")
+
+    return READER_BACKENDS[reader_backend]
+
+
+def iter_record_batches(chunks: Iterable[bytes], batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[list[bytes]]:
+    """
+    Split a stream of decompressed FASTQ data into batches of whole records.
+
+    Each batch is a flat list of lines (without line endings), four lines per
+    record, holding at most `batch_size` records.
+
+    :param chunks: Decompressed FASTQ data
+    :type chunks: Iterable[bytes]
+    :param batch_size: Maximum number of records per batch
+    :type batch_size: int
+    :return: Batches of FASTQ lines
+    :rtype: Iterator[list[bytes]]
+    :raises ValueError: If the data is not valid four-line FASTQ
+    """
+    num_lines_per_batch = 4 * batch_size
+    lines = []
+    partial_line = b''
+    for chunk in chunks:
+        if b'\r' in chunk:
+            chunk = chunk.replace(b'\r', b'')
+        chunk_lines = (partial_line + chunk).split(b'\n')
+        partial_line = chunk_lines.pop()
+        lines.extend(chunk_lines)
+        if len(lines) >= num_lines_per_batch:
+            num_complete_lines = len(lines) - len(lines) % num_lines_per_batch
+            for batch_start in range(0, num_complete_lines, num_lines_per_batch):
+                batch = lines[batch_start:batch_start + num_lines_per_batch]
+                _check_record_headers(batch)
+                yield batch
+            lines = lines[num_complete_lines:]
+
+    if partial_line:
+        lines.append(partial_line)
+    while lines and lines[-1] == b'':
+        lines.pop()
+    if len(lines) % 4 != 0:
+        raise ValueError(f"Truncated FASTQ record: expected a multiple of 4 lines, found {len(lines)} trailing lines")
+    if lines:
+        _check_record_headers(lines)
+        yield lines
+
+
+def _check_record_headers(lines: list[bytes]):
+    """
+    Check that every record in a batch starts with '@' and has a '+' separator line.
+    """
+    headers = b''.join(map(operator.itemgetter(slice(0, 1)), lines[0::4]))
+    separators = b''.join(map(operator.itemgetter(slice(0, 1)), lines[2::4]))
+    num_records = len(lines) // 4
+    if headers.count(b'@') != num_records or separators.count(b'+') != num_records:
+        raise ValueError("Malformed FASTQ record: expected '@' header and '+' separator lines")
+
+
+def count_record_batch(lines: list[bytes], num_last_bases: int = NUM_LAST_BASES, metrics: Iterable[str] = ALL_METRICS) -> dict[str, object]:
+    """
+    Count reads, bases and high-quality bases for a batch of FASTQ records.
+
+    This is the hot loop for all FASTQ statistics. Everything is done with
+    whole-batch operations, never per-base python code.
+
+    :param lines: FASTQ lines, four per record
+    :type lines: list[bytes]
+    :param num_last_bases: Number of bases at the end of each read to count separately
+    :type num_last_bases: int
+    :param metrics: Metrics that the counts will be used for. See `ALL_METRICS`. Counts that none of them need are skipped.
+    :type metrics: Iterable[str]
+    :return: Counts. Keys: ['num_reads', 'num_bases', 'min_read_length', 'max_read_length', 'num_bases_over_q30', 'num_bases_over_q30_last_n'],
+             plus ['per_cycle_quality'], ['quality_histogram', 'quality_histogram_last_n'],
+             ['read_length_histogram_num_reads', 'read_length_histogram_num_bases'] and
+             ['num_gc_bases', 'num_n_bases', 'gc_content_histogram', 'n_content_histogram'] for the metrics that need them.
+    :rtype: dict[str, object]
+    """
+    seqs = lines[1::4]
+    read_lengths = list(map(len, seqs))
+    counts = _empty_counts()
+    counts['num_reads'] = len(read_lengths)
+    counts['num_bases'] = sum(read_lengths)
+    if read_lengths:
+        counts['min_read_length'] = min(read_lengths)
+        counts['max_read_length'] = max(read_lengths)
+    count_histograms = 'quality_histogram' in metrics
+    if 'q30' in metrics or 'q30_last_n' in metrics or count_histograms:
+        quals = lines[3::4]
+        counts.update(count_quality_batch(quals, num_last_bases=num_last_bases, count_histograms=count_histograms))
+    if 'per_cycle_quality' in metrics:
+        counts['per_cycle_quality'] = count_per_cycle_quality(lines[3::4])
+    if 'read_length_distribution' in metrics:
+        counts.update(count_read_length_histogram(np.array(read_lengths, dtype=np.int64)))
+    if 'base_composition' in metrics:
+        counts.update(count_base_composition(seqs))
+
+    return counts
+
+
+def read_length_histogram_bins(read_lengths: np.ndarray) -> np.ndarray:
+    """
+    Find the read length histogram bin for each read length.
+
+    Lengths below `READ_LENGTH_HISTOGRAM_NUM_EXACT_BINS` each have their own bin. Above that, each
+    doubling of length is split into `READ_LENGTH_HISTOGRAM_BINS_PER_DOUBLING` equal-width bins.
+    Lengths beyond the last bin are counted in the last bin.
+
+    :param read_lengths: Read lengths
+    :type read_lengths: np.ndarray
+    :return: Bin index for each read length
+    :rtype: np.ndarray
+    """
+    read_lengths = np.asarray(read_lengths, dtype=np.int64)
+    bins = read_lengths.copy()
+    is_long = read_lengths >= READ_LENGTH_HISTOGRAM_NUM_EXACT_BINS
+    if np.any(is_long):
+        long_read_lengths = read_lengths[is_long]
+        log2_lengths = np.floor(np.log2(long_read_lengths)).astype(np.int64)
+        # Correct for floating-point rounding just below a power of two.
+        log2_lengths -= (np.left_shift(1, log2_lengths) > long_read_lengths)
+        log2_lengths += (np.left_shift(1, log2_lengths + 1) <= long_read_lengths)
+        sub_bin_shift = log2_lengths - READ_LENGTH_HISTOGRAM_BINS_PER_DOUBLING.bit_length() + 1
+        sub_bins = np.right_shift(long_read_lengths - np.left_shift(1, log2_lengths), sub_bin_shift)
+        bins[is_long] = READ_LENGTH_HISTOGRAM_NUM_EXACT_BINS + (log2_lengths - _READ_LENGTH_HISTOGRAM_MIN_LOG2_LENGTH) * READ_LENGTH_HISTOGRAM_BINS_PER_DOUBLING + sub_bins
+    bins = np.minimum(bins, READ_LENGTH_HISTOGRAM_NUM_BINS - 1)
+
+    return bins
+
+
+def read_length_histogram_bin_range(bin_index: int) -> tuple[int, int]:
+    """
+    Get the range of read lengths counted in a read length histogram bin.
+
+    :param bin_index: Bin index
+    :type bin_index: int
+    :return: Minimum and maximum read length in the bin (inclusive)
+    :rtype: tuple[int, int]
+    """
+    if bin_index < READ_LENGTH_HISTOGRAM_NUM_EXACT_BINS:
+        return bin_index, bin_index
+    log2_length, sub_bin = divmod(bin_index - READ_LENGTH_HISTOGRAM_NUM_EXACT_BINS, READ_LENGTH_HISTOGRAM_BINS_PER_DOUBLING)
+    log2_length += _READ_LENGTH_HISTOGRAM_MIN_LOG2_LENGTH
+    bin_width = (1 << log2_length) // READ_LENGTH_HISTOGRAM_BINS_PER_DOUBLING
+    min_length = (1 << log2_length) + sub_bin * bin_width
+
+    return min_length, min_length + bin_width - 1
+
+
+def count_read_length_histogram(read_lengths: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    Count the reads and bases in each read length histogram bin (see `read_length_histogram_bins`).
+
+    The histogram has a fixed number of bins, so its size doesn't depend on the number of reads.
+    The number of bases in each bin is kept so that the N50 can be calculated from the histogram.
+
+    :param read_lengths: Read lengths
+    :type read_lengths: np.ndarray
+    :return: Counts. Keys: ['read_length_histogram_num_reads', 'read_length_histogram_num_bases']
+    :rtype: dict[str, np.ndarray]
+    """
+    bins = read_length_histogram_bins(read_lengths)
+    counts = {
+        'read_length_histogram_num_reads': np.bincount(bins, minlength=READ_LENGTH_HISTOGRAM_NUM_BINS).astype(np.int64),
+        'read_length_histogram_num_bases': np.bincount(bins, weights=read_lengths, minlength=READ_LENGTH_HISTOGRAM_NUM_BINS).astype(np.int64),
+    }
+
+    return counts
+
+
+def read_length_n50(num_reads_by_bin: np.ndarray, num_bases_by_bin: np.ndarray) -> Optional[int]:
+    """
+    Calculate the read length N50 from a read length histogram: the length L such that reads of length L
+    or longer contain at least half of all bases.
+
+    The N50 is exact when it falls in a single-length bin. Otherwise it is the mean length of the reads in
+    its bin, which is within the bin's width (at most 1/64 of the length) of the exact value.
+
+    :param num_reads_by_bin: Number of reads in each bin
+    :type num_reads_by_bin: np.ndarray
+    :param num_bases_by_bin: Number of bases in each bin
+    :type num_bases_by_bin: np.ndarray
+    :return: Read length N50, or None if there are no bases.
+    :rtype: Optional[int]
+    """
+    num_reads_by_bin = np.asarray(num_reads_by_bin, dtype=np.int64)
+    num_bases_by_bin = np.asarray(num_bases_by_bin, dtype=np.int64)
+    total_num_bases = int(num_bases_by_bin.sum())
+    if total_num_bases == 0:
+        return None
+    # Bases in bins at or above each bin, longest first.
+    num_bases_at_or_above = np.cumsum(num_bases_by_bin[::-1])[::-1]
+    n50_bin = int(np.flatnonzero(2 * num_bases_at_or_above >= total_num_bases)[-1])
+    min_length, max_length = read_length_histogram_bin_range(n50_bin)
+    if min_length == max_length:
+        return min_length
+
+    return int(round(num_bases_by_bin[n50_bin] / num_reads_by_bin[n50_bin]))
+
+
+def _content_percent_histogram(num_matching_bases: np.ndarray, num_bases: np.ndarray) -> np.ndarray:
+    """
+    Count the reads with each whole percent (rounded half up) of matching bases. Reads with no bases are left out.
+    """
+    has_bases = num_bases > 0
+    percents = (200 * num_matching_bases[has_bases] + num_bases[has_bases]) // (2 * num_bases[has_bases])
+
+    return np.bincount(percents, minlength=CONTENT_HISTOGRAM_NUM_BINS).astype(np.int64)
+
+
+def count_base_composition(seqs: list[bytes]) -> dict[str, object]:
+    """
+    Count the G/C and N bases in a batch of reads, and the distribution of GC and N content per read.
+
+    Per-read GC content is the percent of the read's called (non-N) bases that are G or C.
+    Per-read N content is the percent of all of the read's bases that are N.
+
+    :param seqs: Sequences, one per read
+    :type seqs: list[bytes]
+    :return: Counts. Keys: ['num_gc_bases', 'num_n_bases', 'gc_content_histogram', 'n_content_histogram']
+    :rtype: dict[str, object]
+    """
+    all_bases = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+    read_ends = np.cumsum(np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs)))
+    read_starts = read_ends - np.diff(read_ends, prepend=0)
+    # Per-read counts are differences of running totals, which also handles empty reads.
+    cumulative_gc = np.concatenate([[0], np.cumsum(_GC_BASES[all_bases], dtype=np.int64)])
+    cumulative_n = np.concatenate([[0], np.cumsum(_N_BASES[all_bases], dtype=np.int64)])
+    num_gc_bases_per_read = cumulative_gc[read_ends] - cumulative_gc[read_starts]
+    num_n_bases_per_read = cumulative_n[read_ends] - cumulative_n[read_starts]
+    read_lengths = read_ends - read_starts
+
+    counts = {
+        'num_gc_bases': int(cumulative_gc[-1]),
+        'num_n_bases': int(cumulative_n[-1]),
+        'gc_content_histogram': _content_percent_histogram(num_gc_bases_per_read, read_lengths - num_n_bases_per_read),
+        'n_content_histogram': _content_percent_histogram(num_n_bases_per_read, read_lengths),
+    }
+
+    return counts
+
+
+def _empty_counts() -> dict[str, object]:
+    """
+    Counts for a file (or part of a file) with no records.
+    """
+    counts = {
+        'num_reads': 0,
+        'num_bases': 0,
+        'min_read_length': None,
+        'max_read_length': 0,
+        'num_bases_over_q30': 0,
+        'num_bases_over_q30_last_n': 0,
+    }
+
+    return counts
+
+
+def _merge_counts(counts: dict[str, object], other_counts: dict[str, object]):
+    """
+    Merge `other_counts` into `counts`, in-place.
+    """
+    for key, count in other_counts.items():
+        if key == 'min_read_length':
+            if count is not None and (counts[key] is None or count < counts[key]):
+                counts[key] = count
+        elif key == 'max_read_length':
+            counts[key] = max(counts[key], count)
+        elif key == 'per_cycle_quality':
+            if key not in counts:
+                counts[key] = count
+            else:
+                counts[key] = {name: _add_arrays(counts[key][name], count[name]) for name in count}
+        elif key in counts:
+            counts[key] = counts[key] + count
+        else:
+            counts[key] = count
+
+
+def is_bgzf(fastq_path: Path) -> bool:
+    """
+    Check whether a file is BGZF-compressed (blocked gzip, as written by htslib and some demultiplexers).
+    BGZF files are made up of independent gzip members, each of which records its own compressed size.
+
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: Path
+    :return: True if the file starts with a BGZF block header
+    :rtype: bool
+    """
+    with open(fastq_path, 'rb') as f:
+        header = f.read(BGZF_HEADER_SIZE_BYTES)
+
+    return _bgzf_block_size(header, 0) is not None
+
+
+def _bgzf_block_size(data: bytes, offset: int) -> Optional[int]:
+    """
+    Get the total size of the BGZF block starting at `offset`, or None if there isn't a BGZF block header there.
+    """
+    header = data[offset:offset + BGZF_HEADER_SIZE_BYTES]
+    if len(header) < BGZF_HEADER_SIZE_BYTES:
+        return None
+    # magic, deflate, FEXTRA flag, XLEN == 6, 'BC' subfield with length 2
+    if header[0:4] != b'\x1f\x8b\x08\x04' or header[10:16] != b'\x06\x00BC\x02\x00':
+        return None
+    block_size = struct.unpack('<H', header[16:18])[0] + 1
+
+    return block_size
+
+
+def _iter_bgzf_chunks(fastq_path: Path, file_hash, io_stats: dict[str, object], chunk_size_bytes: int) -> Iterator[bytes]:
+    """
+    Read a BGZF file from disk once, yielding runs of whole (still-compressed) BGZF blocks
+    of roughly `chunk_size_bytes` each.
+    """
+    io_stats['bytes_read'] = 0
+    buffer = b''
+    with open(fastq_path, 'rb') as f:
+        while raw_chunk := f.read(READ_CHUNK_SIZE_BYTES):
+            if file_hash is not None:
+                file_hash.update(raw_chunk)
+            io_stats['bytes_read'] += len(raw_chunk)
+            buffer += raw_chunk
+            if len(buffer) < chunk_size_bytes:
+                continue
+            offset = 0
+            while (block_size := _bgzf_block_size(buffer, offset)) is not None and offset + block_size <= len(buffer):
+                offset += block_size
+            if offset == 0:
+                raise ValueError(f"Invalid BGZF block header: {fastq_path}")
+            yield buffer[:offset]
+            buffer = buffer[offset:]
+
+    if buffer:
+        yield buffer
+
+
+def _iter_decompressed_fixed_size_chunks(fastq_path: Path, file_hash, io_stats: dict[str, object], chunk_size_bytes: int) -> Iterator[bytes]:
+    """
+    Regroup the output of `iter_decompressed_chunks` into chunks of at least `chunk_size_bytes`.
+    """
+    pending_chunks = []
+    pending_size_bytes = 0
+    for chunk in iter_decompressed_chunks(fastq_path, file_hash, io_stats):
+        pending_chunks.append(chunk)
+        pending_size_bytes += len(chunk)
+        if pending_size_bytes >= chunk_size_bytes:
+            yield b''.join(pending_chunks)
+            pending_chunks = []
+            pending_size_bytes = 0
+
+    if pending_chunks:
+        yield b''.join(pending_chunks)
+
+
+def _decompress_gzip_members(data: bytes) -> bytes:
+    """
+    Decompress a run of complete gzip members.
+    """
+    decompressed = []
+    while data:
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        decompressed.append(decompressor.decompress(data))
+        if not decompressor.eof:
+            raise EOFError("Compressed data ended before the end-of-stream marker was reached")
+        data = decompressor.unused_data.lstrip(b'\x00')
+
+    return b''.join(decompressed)
+
+
+def count_fastq_chunk(data: bytes, is_compressed: bool = False, num_last_bases: int = NUM_LAST_BASES, metrics: Iterable[str] = ALL_METRICS) -> dict[str, object]:
+    """
+    Count the complete FASTQ records in an arbitrary slice of a FASTQ file.
+
+    The slice may start and end part-way through a record. The first record start
+    is found by looking for a line starting with '@' whose second-next line starts
+    with '+'. In four-line FASTQ only a header line satisfies both conditions (a quality
+    line may start with '@', but two lines later is a sequence line).
+
+    The bytes before the first record start (`head`) and after the last complete
+    record (`tail`) are returned so that the caller can stitch them together with the
+    neighbouring slices. If no record start is found, `tail` is None and the whole
+    slice is returned as `head`.
+
+    :param data: Slice of a FASTQ file
+    :type data: bytes
+    :param is_compressed: Whether `data` is a run of complete gzip members that needs to be decompressed first
+    :type is_compressed: bool
+    :param num_last_bases: Number of bases at the end of each read to count separately
+    :type num_last_bases: int
+    :param metrics: Metrics that the counts will be used for. See `count_record_batch`.
+    :type metrics: Iterable[str]
+    :return: Counts for the complete records, plus the leftover fragments and the time spent in the worker. Keys: ['counts', 'head', 'tail', 'duration_seconds']
+    :rtype: dict[str, object]
+    """
+    start = time.perf_counter()
+    if is_compressed:
+        data = _decompress_gzip_members(data)
+    if b'\r' in data:
+        data = data.replace(b'\r', b'')
+
+    lines = data.split(b'\n')
+    # The first element may be the end of a line that started in the previous slice,
+    # and the last element is always treated as incomplete.
+    last_complete_line_index = len(lines) - 2
+    first_record_index = None
+    for line_index in range(1, last_complete_line_index - 1):
+        if lines[line_index][:1] == b'@' and lines[line_index + 2][:1] == b'+':
+            first_record_index = line_index
+            break
+
+    if first_record_index is None:
+        fragments = {
+            'counts': _empty_counts(),
+            'head': data,
+            'tail': None,
+            'duration_seconds': time.perf_counter() - start,
+        }
+        return fragments
+
+    complete_lines = lines[first_record_index:last_complete_line_index + 1]
+    num_complete_record_lines = len(complete_lines) - len(complete_lines) % 4
+    records = complete_lines[:num_complete_record_lines]
+    counts = _empty_counts()
+    if records:
+        _check_record_headers(records)
+        counts = count_record_batch(records, num_last_bases, metrics)
+
+    fragments = {
+        'counts': counts,
+        'head': b'\n'.join(lines[:first_record_index]) + b'\n',
+        'tail': b'\n'.join(complete_lines[num_complete_record_lines:] + [lines[-1]]),
+        'duration_seconds': time.perf_counter() - start,
+    }
+
+    return fragments
+
+
+def _collect_counts_chunked(fastq_path: Path, file_hash, io_stats: dict[str, object], pool, num_last_bases: int, chunk_size_bytes: int, max_chunks_in_flight: int, metrics: Iterable[str] = ALL_METRICS) -> dict[str, object]:
+    """
+    Count the records in a single FASTQ file by fanning slices of it out to a process pool.
+
+    The file is still read exactly once, by the calling process. BGZF files are split on
+    block boundaries and decompressed by the workers. Other gzip files are decompressed
+    by the calling process and the workers parse and count. Fragments of records that
+    span two slices are stitched back together and counted here, so the totals are
+    identical to a sequential pass. The time the workers spent on the file is recorded in
+    `io_stats['chunk_worker_seconds']`.
+    """
+    io_stats['chunk_worker_seconds'] = 0.0
+    if is_bgzf(fastq_path):
+        chunks = _iter_bgzf_chunks(fastq_path, file_hash, io_stats, chunk_size_bytes // 4)
+        is_compressed = True
+    else:
+        chunks = _iter_decompressed_fixed_size_chunks(fastq_path, file_hash, io_stats, chunk_size_bytes)
+        is_compressed = False
+
+    counts = _empty_counts()
+    pending_fragment = b''
+    in_flight = collections.deque()
+
+    def consume_oldest_result():
+        nonlocal pending_fragment
+        fragments = in_flight.popleft().get()
+        io_stats['chunk_worker_seconds'] += fragments['duration_seconds']
+        pending_fragment += fragments['head']
+        if fragments['tail'] is None:
+            return
+        for batch in iter_record_batches([pending_fragment]):
+            _merge_counts(counts, count_record_batch(batch, num_last_bases, metrics))
+        _merge_counts(counts, fragments['counts'])
+        pending_fragment = fragments['tail']
+
+    for chunk in chunks:
+        in_flight.append(pool.apply_async(count_fastq_chunk, (chunk, is_compressed, num_last_bases, metrics)))
+        if len(in_flight) >= max_chunks_in_flight:
+            consume_oldest_result()
+    while in_flight:
+        consume_oldest_result()
+
+    for batch in iter_record_batches([pending_fragment]):
+        _merge_counts(counts, count_record_batch(batch, num_last_bases, metrics))
+
+    return counts
+
+
+def collect_fastq_stats(fastq_path: Path, metrics: Iterable[str] = ALL_METRICS, num_last_bases: int = NUM_LAST_BASES, batch_size: int = DEFAULT_BATCH_SIZE, pool=None, chunk_size_bytes: int = DEFAULT_CHUNK_SIZE_BYTES, max_chunks_in_flight: int = DEFAULT_MAX_CHUNKS_IN_FLIGHT, hash_algorithm: str = DEFAULT_HASH_ALGORITHM, reader_backend: str = DEFAULT_READER_BACKEND) -> dict[str, object]:
+    """
+    Collect statistics for a FASTQ file, reading it from disk only once.
+
+    This is the one place where FASTQ files are read for statistics. The collector
+    (`illumina.get_fastq_stats`), `parsers.fastq.collect_fastq_stats` and
+    `scripts/collect_fastq_metrics.py` all call it.
+
+    If a `pool` is provided, the work for this one file is split into chunks and
+    spread across the pool's workers (see `count_fastq_chunk`). The results are identical
+    to a sequential pass. This can't be called from inside a pool worker.
+
+    :param fastq_path: Path to FASTQ file (gzipped or uncompressed)
+    :type fastq_path: Path
+    :param metrics: Metrics to include in the result. See `ALL_METRICS`.
+    :type metrics: Iterable[str]
+    :param num_last_bases: Number of bases at the end of each read to use for the 'q30_last_n' metric
+    :type num_last_bases: int
+    :param batch_size: Number of records to count at a time
+    :type batch_size: int
+    :param pool: Process pool to spread the work for this file across
+    :type pool: Optional[multiprocessing.pool.Pool]
+    :param chunk_size_bytes: Approximate (uncompressed) size of each chunk sent to the pool
+    :type chunk_size_bytes: int
+    :param max_chunks_in_flight: Maximum number of chunks held in memory waiting for the pool
+    :type max_chunks_in_flight: int
+    :param hash_algorithm: Hash algorithm for the 'checksum' metric. See `HASH_ALGORITHMS`.
+                           Only 'md5' can be used if the 'md5' metric is also requested.
+    :type hash_algorithm: str
+    :param reader_backend: How to read and decompress the file. See `READER_BACKENDS`. Not used when a pool is provided.
+    :type reader_backend: str
+    :return: FASTQ statistics. Keys: the keys for the requested `metrics`, plus ['bytes_read', 'duration_seconds'].
+             When a pool is used, also ['chunk_worker_seconds'].
+    :rtype: dict[str, object]
+    :raises OSError: If the file can't be read
+    :raises EOFError: If the file is truncated
+    :raises zlib.error: If the file is not valid gzip data
+    :raises ValueError: If the file is not valid FASTQ, or an unknown metric, hash algorithm or reader backend is requested
+    """
+    metrics = _check_metrics(metrics)
+    read_fastq = get_reader_backend(reader_backend)
+    start = time.perf_counter()
+    file_hash = _new_file_hash(metrics, hash_algorithm)
+    io_stats = {}
+    if pool is not None:
+        counts = _collect_counts_chunked(fastq_path, file_hash, io_stats, pool, num_last_bases, chunk_size_bytes, max_chunks_in_flight, metrics)
+    else:
+        counts = _empty_counts()
+        chunks = read_fastq(fastq_path, file_hash, io_stats)
+        for batch in iter_record_batches(chunks, batch_size):
+            _merge_counts(counts, count_record_batch(batch, num_last_bases, metrics))
+
+    stats = _select_metrics(fastq_path, counts, metrics, num_last_bases, file_hash, io_stats, start)
+
+    return stats
+
+
+def _new_file_hash(metrics: set[str], hash_algorithm: str):
+    """
+    Create the hash object for the 'md5' or 'checksum' metric, or None if neither was requested.
+    """
+    if hash_algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm: {hash_algorithm}. Supported: {HASH_ALGORITHMS}")
+    if 'md5' in metrics and 'checksum' in metrics and hash_algorithm != 'md5':
+        raise ValueError(f"The 'md5' metric can't be combined with a '{hash_algorithm}' checksum")
+    if 'checksum' in metrics:
+        return hashlib.new(hash_algorithm)
+    if 'md5' in metrics:
+        return hashlib.md5()
+
+    return None
+
+
+def _check_metrics(metrics: Iterable[str]) -> set[str]:
+    """
+    Check that all requested metrics are known.
+    """
+    metrics = set(metrics)
+    unknown_metrics = metrics - ALL_METRICS
+    if unknown_metrics:
+        raise ValueError(f"Unknown FASTQ metrics: {sorted(unknown_metrics)}")
+
+    return metrics
+
+
+def _select_metrics(fastq_path: Path, counts: dict[str, object], metrics: set[str], num_last_bases: int, file_hash, io_stats: dict[str, object], start: float) -> dict[str, object]:
+    """
+    Build the result of `collect_fastq_stats` from the accumulated counts, including only the requested metrics.
+    """
+    stats = {}
+    if 'num_reads' in metrics:
+        stats['num_reads'] = counts['num_reads']
+    if 'num_bases' in metrics:
+        stats['num_bases'] = counts['num_bases']
+    if 'read_length' in metrics:
+        stats['min_read_length'] = counts['min_read_length']
+        stats['max_read_length'] = counts['max_read_length']
+        stats['mean_read_length'] = counts['num_bases'] / counts['num_reads'] if counts['num_reads'] > 0 else None
+    if 'q30' in metrics:
+        stats['num_bases_over_q30'] = counts['num_bases_over_q30']
+    if 'q30_last_n' in metrics:
+        stats['num_bases_over_q30_last_n'] = counts['num_bases_over_q30_last_n']
+        stats['num_last_bases'] = num_last_bases
+    if 'per_cycle_quality' in metrics:
+        per_cycle_quality = counts.get('per_cycle_quality', {})
+        stats['per_cycle_quality'] = {
+            'num_bases': per_cycle_quality['num_bases'].tolist() if per_cycle_quality else [],
+            'quality_sum': per_cycle_quality['quality_sum'].tolist() if per_cycle_quality else [],
+            'num_bases_over_q30': per_cycle_quality['num_bases_over_q30'].tolist() if per_cycle_quality else [],
+        }
+    if 'quality_histogram' in metrics:
+        empty_histogram = np.zeros(MAX_PHRED_QUALITY + 1, dtype=np.int64)
+        stats['quality_histogram'] = counts.get('quality_histogram', empty_histogram).tolist()
+        stats['quality_histogram_last_n'] = counts.get('quality_histogram_last_n', empty_histogram).tolist()
+        stats['num_last_bases'] = num_last_bases
+    if 'read_length_distribution' in metrics:
+        num_reads_by_bin = counts.get('read_length_histogram_num_reads', np.zeros(READ_LENGTH_HISTOGRAM_NUM_BINS, dtype=np.int64))
+        num_bases_by_bin = counts.get('read_length_histogram_num_bases', np.zeros(READ_LENGTH_HISTOGRAM_NUM_BINS, dtype=np.int64))
+        # Only the bins with reads are included, as [min_length, max_length, num_reads, num_bases].
+        stats['read_length_histogram'] = [
+            [*read_length_histogram_bin_range(int(bin_index)), int(num_reads_by_bin[bin_index]), int(num_bases_by_bin[bin_index])]
+            for bin_index in np.flatnonzero(num_reads_by_bin)
+        ]
+        stats['read_length_n50'] = read_length_n50(num_reads_by_bin, num_bases_by_bin)
+    if 'base_composition' in metrics:
+        empty_histogram = np.zeros(CONTENT_HISTOGRAM_NUM_BINS, dtype=np.int64)
+        stats['num_gc_bases'] = counts.get('num_gc_bases', 0)
+        stats['num_n_bases'] = counts.get('num_n_bases', 0)
+        stats['gc_content_histogram'] = counts.get('gc_content_histogram', empty_histogram).tolist()
+        stats['n_content_histogram'] = counts.get('n_content_histogram', empty_histogram).tolist()
+    if 'md5' in metrics:
+        stats['md5'] = file_hash.hexdigest()
+    if 'checksum' in metrics:
+        stats['checksum'] = file_hash.hexdigest()
+        stats['checksum_algorithm'] = file_hash.name
+    if 'file_size' in metrics:
+        stats['file_size_bytes'] = os.path.getsize(fastq_path)
+    stats['bytes_read'] = io_stats['bytes_read']
+    stats['duration_seconds'] = round(time.perf_counter() - start, 4)
+    if 'chunk_worker_seconds' in io_stats:
+        stats['chunk_worker_seconds'] = round(io_stats['chunk_worker_seconds'], 4)
+
+    return stats
+
+
+def _read_ids(headers: list[bytes]) -> list[bytes]:
+    """
+    Get the read IDs (the part of the header line before any whitespace) for a batch of records.
+    """
+    read_ids = list(map(operator.itemgetter(0), map(bytes.split, headers)))
+
+    return read_ids
+
+
+def _check_read_ids_match(headers_r1: list[bytes], headers_r2: list[bytes]):
+    """
+    Check that a batch of R1 records and the corresponding batch of R2 records are from the same clusters.
+
+    Older FASTQ files mark the read number with a '/1' or '/2' suffix on the read ID.
+    That suffix is only stripped if the IDs don't already match, since it is rare.
+    """
+    read_ids_r1 = _read_ids(headers_r1)
+    read_ids_r2 = _read_ids(headers_r2)
+    if read_ids_r1 == read_ids_r2:
+        return
+
+    for read_id_r1, read_id_r2 in zip(read_ids_r1, read_ids_r2):
+        if read_id_r1 == read_id_r2:
+            continue
+        if read_id_r1[-2:] == b'/1' and read_id_r2[-2:] == b'/2' and read_id_r1[:-2] == read_id_r2[:-2]:
+            continue
+        raise ValueError(f"R1 and R2 read IDs don't match: {read_id_r1.decode(errors='replace')} != {read_id_r2.decode(errors='replace')}")
+
+
+def collect_paired_fastq_stats(fastq_path_r1: Path, fastq_path_r2: Path, metrics: Iterable[str] = ALL_METRICS, num_last_bases: int = NUM_LAST_BASES, batch_size: int = DEFAULT_BATCH_SIZE, hash_algorithm: str = DEFAULT_HASH_ALGORITHM, reader_backend: str = DEFAULT_READER_BACKEND) -> dict[str, dict[str, object]]:
+    """
+    Collect statistics for the R1 and R2 FASTQ files of a paired-end library in one pass.
+
+    The two files are streamed side by side, one batch of records from each at a time,
+    and every pair of records is checked to come from the same cluster. Each file is
+    still read from disk exactly once.
+
+    :param fastq_path_r1: Path to R1 FASTQ file
+    :type fastq_path_r1: Path
+    :param fastq_path_r2: Path to R2 FASTQ file
+    :type fastq_path_r2: Path
+    :param metrics: Metrics to include in the result. See `ALL_METRICS`.
+    :type metrics: Iterable[str]
+    :param num_last_bases: Number of bases at the end of each read to use for the 'q30_last_n' metric
+    :type num_last_bases: int
+    :param batch_size: Number of records to count at a time
+    :type batch_size: int
+    :param hash_algorithm: Hash algorithm for the 'checksum' metric. See `HASH_ALGORITHMS`.
+    :type hash_algorithm: str
+    :param reader_backend: How to read and decompress the files. See `READER_BACKENDS`.
+    :type reader_backend: str
+    :return: FASTQ statistics for each file, as returned by `collect_fastq_stats`. Keys: ['r1', 'r2']
+    :rtype: dict[str, dict[str, object]]
+    :raises OSError: If either file can't be read
+    :raises EOFError: If either file is truncated
+    :raises zlib.error: If either file is not valid gzip data
+    :raises ValueError: If either file is not valid FASTQ, or the files have different numbers of reads or mismatched read IDs
+    """
+    metrics = _check_metrics(metrics)
+    read_fastq = get_reader_backend(reader_backend)
+    start = time.perf_counter()
+    file_hash_r1 = _new_file_hash(metrics, hash_algorithm)
+    file_hash_r2 = _new_file_hash(metrics, hash_algorithm)
+    io_stats_r1 = {}
+    io_stats_r2 = {}
+    counts_r1 = _empty_counts()
+    counts_r2 = _empty_counts()
+    batches_r1 = iter_record_batches(read_fastq(fastq_path_r1, file_hash_r1, io_stats_r1), batch_size)
+    batches_r2 = iter_record_batches(read_fastq(fastq_path_r2, file_hash_r2, io_stats_r2), batch_size)
+    for batch_r1, batch_r2 in itertools.zip_longest(batches_r1, batches_r2):
+        if batch_r1 is None or batch_r2 is None or len(batch_r1) != len(batch_r2):
+            raise ValueError(f"R1 and R2 have different numbers of reads: {fastq_path_r1}, {fastq_path_r2}")
+        _check_read_ids_match(batch_r1[0::4], batch_r2[0::4])
+        _merge_counts(counts_r1, count_record_batch(batch_r1, num_last_bases, metrics))
+        _merge_counts(counts_r2, count_record_batch(batch_r2, num_last_bases, metrics))
+
+    paired_stats = {
+        'r1': _select_metrics(fastq_path_r1, counts_r1, metrics, num_last_bases, file_hash_r1, io_stats_r1, start),
+        'r2': _select_metrics(fastq_path_r2, counts_r2, metrics, num_last_bases, file_hash_r2, io_stats_r2, start),
+    }
+
+    return paired_stats
+
+
+def count_fastq_reads(fastq_path: Path, hash_algorithm: Optional[str] = DEFAULT_HASH_ALGORITHM) -> dict[str, object]:
+    """
+    Count the reads in a FASTQ file and checksum it, without parsing the records.
+
+    This still reads and decompresses the whole file, but only counts line endings,
+    so it is much cheaper than `collect_fastq_stats`.
+
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: Path
+    :param hash_algorithm: Hash algorithm for the checksum (see `HASH_ALGORITHMS`), or None to skip the checksum.
+    :type hash_algorithm: Optional[str]
+    :return: Read count and checksum. Keys: ['num_reads', 'checksum', 'checksum_algorithm', 'bytes_read', 'duration_seconds']
+    :rtype: dict[str, object]
+    :raises EOFError: If a gzip member is truncated
+    :raises zlib.error: If the file is not valid gzip data
+    """
+    start = time.perf_counter()
+    file_hash = None if hash_algorithm is None else _new_file_hash({'checksum'}, hash_algorithm)
+    io_stats = {}
+    num_lines = 0
+    last_byte = b'\n'
+    for chunk in iter_decompressed_chunks(fastq_path, file_hash, io_stats):
+        num_lines += chunk.count(b'\n')
+        last_byte = chunk[-1:]
+    if last_byte != b'\n':
+        num_lines += 1
+
+    read_count = {
+        'num_reads': num_lines // 4,
+        'checksum': None if file_hash is None else file_hash.hexdigest(),
+        'checksum_algorithm': hash_algorithm,
+        'bytes_read': io_stats['bytes_read'],
+        'duration_seconds': round(time.perf_counter() - start, 4),
+    }
+
+    return read_count
+
+
+def _find_gzip_member_start(fastq_path: Path, start_offset: int, end_offset: int, io_stats: dict[str, object]) -> Optional[int]:
+    """
+    Find the first offset in [start_offset, end_offset) where a gzip member starts.
+
+    Candidates are positions holding the gzip magic bytes. A candidate is only accepted
+    if decompression can start there, since the same bytes can occur by chance inside
+    compressed data. The range is searched a piece at a time, so finding a member near
+    `start_offset` only reads a little of the file.
+    """
+    with open(fastq_path, 'rb') as f:
+        for search_offset in range(start_offset, end_offset, SAMPLE_READ_CHUNK_SIZE_BYTES):
+            f.seek(search_offset)
+            # Read past the end of this piece, so that a candidate near the end can be checked.
+            data = f.read(SAMPLE_READ_CHUNK_SIZE_BYTES + SAMPLE_MEMBER_CHECK_BYTES)
+            io_stats['bytes_read'] += len(data)
+            search_end = min(SAMPLE_READ_CHUNK_SIZE_BYTES, end_offset - search_offset)
+            candidate = data.find(GZIP_MAGIC + b'\x08')
+            while 0 <= candidate < search_end:
+                try:
+                    decompressed = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16).decompress(data[candidate:candidate + SAMPLE_MEMBER_CHECK_BYTES])
+                    if b'\n' in decompressed:
+                        return search_offset + candidate
+                except zlib.error as e:
+                    pass
+                candidate = data.find(GZIP_MAGIC + b'\x08', candidate + 1)
+
+    return None
+
+
+def _sample_window(fastq_path: Path, start_offset: int, end_offset: int, num_reads: int, io_stats: dict[str, object]) -> list[bytes]:
+    """
+    Take up to `num_reads` consecutive records from the data between two offsets.
+
+    Unless the window starts at the beginning of the file, it may start part-way through
+    a record, so the leading lines are skipped up to the first line that starts with '@'
+    and is followed two lines later by a line starting with '+'.
+    """
+    window_io_stats = {}
+    data = b''
+    num_lines_needed = 4 * num_reads + 8
+    for chunk in iter_decompressed_chunks(fastq_path, None, window_io_stats, start_offset=start_offset, end_offset=end_offset, read_chunk_size_bytes=SAMPLE_READ_CHUNK_SIZE_BYTES):
+        data += chunk
+        if data.count(b'\n') >= num_lines_needed:
+            break
+    io_stats['bytes_read'] += window_io_stats.get('bytes_read', 0)
+    if b'\r' in data:
+        data = data.replace(b'\r', b'')
+
+    # The last element is always treated as incomplete.
+    lines = data.split(b'\n')[:-1]
+    first_record_index = 0 if start_offset == 0 else 1
+    while first_record_index < len(lines) - 2:
+        if lines[first_record_index][:1] == b'@' and lines[first_record_index + 2][:1] == b'+':
+            break
+        first_record_index += 1
+    records = lines[first_record_index:]
+    num_complete_records = min(num_reads, len(records) // 4)
+    records = records[:4 * num_complete_records]
+    if records:
+        _check_record_headers(records)
+
+    return records
+
+
+def _ratio_estimate(numerators: list[int], denominators: list[int]) -> dict[str, Optional[float]]:
+    """
+    Estimate a ratio from per-block totals, with a normal-approximation confidence interval.
+
+    The blocks are treated as clusters, so that correlation between neighbouring reads
+    (e.g. reads from the same tile) widens the interval instead of being ignored.
+    """
+    num_blocks = len(numerators)
+    total_denominator = sum(denominators)
+    estimate = {
+        'estimate': None,
+        'standard_error': None,
+        'ci_lower': None,
+        'ci_upper': None,
+    }
+    if total_denominator == 0:
+        return estimate
+
+    ratio = sum(numerators) / total_denominator
+    estimate['estimate'] = ratio
+    if num_blocks < 2:
+        return estimate
+
+    numerators = np.array(numerators, dtype=np.float64)
+    denominators = np.array(denominators, dtype=np.float64)
+    residuals = numerators - ratio * denominators
+    mean_denominator = total_denominator / num_blocks
+    standard_error = float(np.sqrt(np.sum(residuals ** 2) / (num_blocks * (num_blocks - 1)))) / mean_denominator
+    estimate['standard_error'] = standard_error
+    estimate['ci_lower'] = ratio - CONFIDENCE_INTERVAL_Z * standard_error
+    estimate['ci_upper'] = ratio + CONFIDENCE_INTERVAL_Z * standard_error
+
+    return estimate
+
+
+def sample_fastq_stats(fastq_path: Path, num_reads: int = DEFAULT_SAMPLE_NUM_READS, num_windows: int = DEFAULT_SAMPLE_NUM_WINDOWS, num_last_bases: int = NUM_LAST_BASES) -> dict[str, object]:
+    """
+    Estimate the quality statistics for a FASTQ file from a deterministic sample of its reads.
+
+    The file is divided into `num_windows` equal byte ranges, and a run of consecutive reads is
+    taken from the start of each one. Gzip files can only be entered at the start of a gzip member,
+    which works well for multi-member and BGZF files (as written by bcl-convert and bcl2fastq).
+    If no member starts close enough to a window's offset, that window is skipped. If that happens for
+    the second window, the file is assumed to be a single gzip member and only the first window is read.
+    `sampling_method` is 'head' when only the first window could be read.
+    The same file always gives the same sample.
+
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: Path
+    :param num_reads: Number of reads to sample, across all windows
+    :type num_reads: int
+    :param num_windows: Number of places in the file to sample from. Small files are sampled from fewer places.
+    :type num_windows: int
+    :param num_last_bases: Number of bases at the end of each read to count separately
+    :type num_last_bases: int
+    :return: Estimates, each a dict with keys ['estimate', 'standard_error', 'ci_lower', 'ci_upper'], for
+             ['q30_fraction', 'q30_last_n_fraction', 'mean_read_length'], plus
+             ['num_last_bases', 'num_reads_sampled', 'num_bases_sampled', 'num_windows', 'num_windows_sampled',
+              'sampling_method', 'confidence_level', 'file_size_bytes', 'bytes_read', 'duration_seconds']
+    :rtype: dict[str, object]
+    :raises ValueError: If the sampled data is not valid four-line FASTQ
+    :raises zlib.error: If the file is not valid gzip data
+    """
+    start = time.perf_counter()
+    file_size_bytes = os.path.getsize(fastq_path)
+    with open(fastq_path, 'rb') as f:
+        is_gzipped = f.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+    # Small files get fewer windows, so that each window can hold some complete records.
+    num_windows = max(1, min(num_windows, file_size_bytes // SAMPLE_READ_CHUNK_SIZE_BYTES))
+    window_offsets = [window_num * file_size_bytes // num_windows for window_num in range(num_windows)] + [file_size_bytes]
+    num_reads_per_window = max(1, -(-num_reads // num_windows))
+    io_stats = {'bytes_read': 0}
+    blocks = []
+    num_windows_sampled = 0
+    for window_num in range(num_windows):
+        window_start, window_end = window_offsets[window_num], window_offsets[window_num + 1]
+        if window_start >= window_end:
+            continue
+        if is_gzipped and window_start > 0:
+            search_end = min(window_start + SAMPLE_MEMBER_SEARCH_BYTES, window_end)
+            window_start = _find_gzip_member_start(fastq_path, window_start, search_end, io_stats)
+            if window_start is None and window_num == 1:
+                break
+            if window_start is None:
+                continue
+        records = _sample_window(fastq_path, window_start, window_end, num_reads_per_window, io_stats)
+        if not records:
+            continue
+        num_windows_sampled += 1
+        num_block_lines = 4 * SAMPLE_BLOCK_NUM_READS
+        for block_start in range(0, len(records), num_block_lines):
+            blocks.append(count_record_batch(records[block_start:block_start + num_block_lines], num_last_bases, metrics=['q30', 'q30_last_n']))
+
+    reads_per_block = [block['num_reads'] for block in blocks]
+    bases_per_block = [block['num_bases'] for block in blocks]
+    sampled_stats = {
+        'q30_fraction': _ratio_estimate([block['num_bases_over_q30'] for block in blocks], bases_per_block),
+        'q30_last_n_fraction': _ratio_estimate([block['num_bases_over_q30_last_n'] for block in blocks], [num_last_bases * n for n in reads_per_block]),
+        'mean_read_length': _ratio_estimate(bases_per_block, reads_per_block),
+        'num_last_bases': num_last_bases,
+        'num_reads_sampled': sum(reads_per_block),
+        'num_bases_sampled': sum(bases_per_block),
+        'num_windows': num_windows,
+        'num_windows_sampled': num_windows_sampled,
+        'sampling_method': 'head' if num_windows_sampled <= 1 and num_windows > 1 else 'windows',
+        'confidence_level': CONFIDENCE_LEVEL,
+        'file_size_bytes': file_size_bytes,
+        'bytes_read': io_stats['bytes_read'],
+        'duration_seconds': round(time.perf_counter() - start, 4),
+    }
+
+    return sampled_stats
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from pathlib import Path
+from typing import Optional
+
+import sequencing_runs_collector.config
+
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def open_cache(cache_path: Path) -> sqlite3.Connection:
+    """
+    Open (and create, if needed) the FASTQ statistics cache.
+
+    The cache should be kept on local disk. SQLite locking is unreliable on network filesystems.
+
+    :param cache_path: Path to the SQLite cache file
+    :type cache_path: Path
+    :return: Connection to the cache
+    :rtype: sqlite3.Connection
+    """
+    conn = sqlite3.connect(cache_path, timeout=30)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fastq_stats (
+            fastq_path TEXT PRIMARY KEY,
+            file_size_bytes INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            sequencing_run_id TEXT,
+            fastq_stats_summary TEXT NOT NULL,
+            timestamp_created REAL NOT NULL,
+            timestamp_last_accessed REAL NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS fastq_stats_sequencing_run_id ON fastq_stats (sequencing_run_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS fastq_stats_last_accessed ON fastq_stats (timestamp_last_accessed)")
+    conn.commit()
+
+    return conn
+
+
+def get_file_identity(fastq_path: Path) -> dict[str, object]:
+    """
+    Get the properties of a file that are used to decide whether a cache entry is still valid.
+
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: Path
+    :return: File identity. Keys: ['fastq_path', 'file_size_bytes', 'mtime_ns', 'inode']
+    :rtype: dict[str, object]
+    """
+    stat = os.stat(fastq_path)
+    file_identity = {
+        'fastq_path': os.path.abspath(fastq_path),
+        'file_size_bytes': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'inode': stat.st_ino,
+    }
+
+    return file_identity
+
+
+def lookup(conn: sqlite3.Connection, fastq_path: Path) -> Optional[dict[str, object]]:
+    """
+    Look up the cached statistics for a FASTQ file.
+
+    An entry is only returned if the file's absolute path, size, mtime and inode
+    all match what was recorded when the entry was stored.
+
+    :param conn: Connection to the cache
+    :type conn: sqlite3.Connection
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: Path
+    :return: Cached FASTQ stats summary (as returned by `illumina.get_fastq_stats`), or None if there is no valid entry.
+    :rtype: Optional[dict[str, object]]
+    """
+    try:
+        file_identity = get_file_identity(fastq_path)
+    except OSError as e:
+        return None
+
+    row = conn.execute(
+        "SELECT fastq_stats_summary FROM fastq_stats WHERE fastq_path = ? AND file_size_bytes = ? AND mtime_ns = ? AND inode = ?",
+        (file_identity['fastq_path'], file_identity['file_size_bytes'], file_identity['mtime_ns'], file_identity['inode']),
+    ).fetchone()
+    if row is None:
+        return None
+
+    conn.execute(
+        "UPDATE fastq_stats SET timestamp_last_accessed = ? WHERE fastq_path = ?",
+        (time.time(), file_identity['fastq_path']),
+    )
+    conn.commit()
+
+    return json.loads(row[0])
+
+
+def store(conn: sqlite3.Connection, fastq_path: Path, sequencing_run_id: Optional[str], fastq_stats_summary: dict[str, object]):
+    """
+    Store the statistics for a FASTQ file, replacing any existing entry for the same path.
+
+    :param conn: Connection to the cache
+    :type conn: sqlite3.Connection
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: Path
+    :param sequencing_run_id: Sequencing run that the FASTQ file belongs to
+    :type sequencing_run_id: Optional[str]
+    :param fastq_stats_summary: FASTQ stats summary, as returned by `illumina.get_fastq_stats`
+    :type fastq_stats_summary: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    file_identity = get_file_identity(fastq_path)
+    now = time.time()
+    conn.execute(
+        "INSERT OR REPLACE INTO fastq_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            file_identity['fastq_path'],
+            file_identity['file_size_bytes'],
+            file_identity['mtime_ns'],
+            file_identity['inode'],
+            sequencing_run_id,
+            json.dumps(fastq_stats_summary),
+            now,
+            now,
+        ),
+    )
+    conn.commit()
+
+
+def evict(conn: sqlite3.Connection, max_entries: int = DEFAULT_MAX_ENTRIES) -> int:
+    """
+    Remove the least-recently-used entries until at most `max_entries` remain.
+
+    :param conn: Connection to the cache
+    :type conn: sqlite3.Connection
+    :param max_entries: Maximum number of entries to keep
+    :type max_entries: int
+    :return: Number of entries removed
+    :rtype: int
+    """
+    num_entries = conn.execute("SELECT COUNT(*) FROM fastq_stats").fetchone()[0]
+    num_to_remove = num_entries - max_entries
+    if num_to_remove <= 0:
+        return 0
+
+    conn.execute(
+        "DELETE FROM fastq_stats WHERE fastq_path IN (SELECT fastq_path FROM fastq_stats ORDER BY timestamp_last_accessed ASC LIMIT ?)",
+        (num_to_remove,),
+    )
+    conn.commit()
+
+    return num_to_remove
+
+
+def invalidate_run(conn: sqlite3.Connection, sequencing_run_id: str) -> int:
+    """
+    Remove all entries for a sequencing run.
+
+    :param conn: Connection to the cache
+    :type conn: sqlite3.Connection
+    :param sequencing_run_id: Sequencing run ID
+    :type sequencing_run_id: str
+    :return: Number of entries removed
+    :rtype: int
+    """
+    cursor = conn.execute("DELETE FROM fastq_stats WHERE sequencing_run_id = ?", (sequencing_run_id,))
+    conn.commit()
+
+    return cursor.rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Remove entries from the FASTQ statistics cache')
+    parser.add_argument('-c', '--config', help='Config file. The cache path is taken from `fastq_stats_cache_path`.')
+    parser.add_argument('--cache-path', help='Path to the cache file. Overrides the config.')
+    parser.add_argument('--run-id', action='append', required=True, help='Sequencing run ID to invalidate. May be repeated.')
+    parser.add_argument('--log-level')
+    args = parser.parse_args()
+
+    try:
+        log_level = getattr(logging, args.log_level.upper())
+    except AttributeError as e:
+        log_level = logging.INFO
+
+    logging.basicConfig(
+        format='{"timestamp": "%(asctime)s.%(msecs)03d", "level": "%(levelname)s", "module": "%(module)s", "function_name": "%(funcName)s", "line_num": %(lineno)d, "message": %(message)s}',
+        datefmt='%Y-%m-%dT%H:%M:%S',
+        encoding='utf-8',
+        level=log_level,
+    )
+
+    cache_path = args.cache_path
+    if cache_path is None and args.config:
+        config = sequencing_runs_collector.config.load_config(args.config)
+        cache_path = config.get('fastq_stats_cache_path', None)
+    if cache_path is None:
+        logging.error(json.dumps({"event_type": "fastq_stats_cache_path_not_provided"}))
+        exit(-1)
+    if not os.path.exists(cache_path):
+        logging.error(json.dumps({"event_type": "fastq_stats_cache_not_found", "cache_path": os.path.abspath(cache_path)}))
+        exit(-1)
+
+    conn = open_cache(cache_path)
+    for run_id in args.run_id:
+        num_entries_removed = invalidate_run(conn, run_id)
+        logging.info(json.dumps({
+            "event_type": "fastq_stats_cache_run_invalidated",
+            "sequencing_run_id": run_id,
+            "num_entries_removed": num_entries_removed,
+        }))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,25 +2,42 @@ import csv
 import datetime
 import glob
 import json
-import hashlib
 import logging
 import multiprocessing
 import os
+import math
+import queue
 import re
-
-import pyfastx
+import signal
+import time
+import xml.parsers.expat
+import zlib
 
 from pathlib import Path
 from typing import Optional
 
+import sequencing_runs_collector.fastq_checksums as fastq_checksums
+import sequencing_runs_collector.fastq_stats as fastq_stats_engine
+import sequencing_runs_collector.fastq_stats_cache as fastq_stats_cache
+import sequencing_runs_collector.metrics as metrics
+import sequencing_runs_collector.parsers.demultiplex_stats as demultiplex_stats
+import sequencing_runs_collector.parsers.generate_fastq_run_statistics as generate_fastq_run_statistics
 import sequencing_runs_collector.parsers.interop as interop
 import sequencing_runs_collector.parsers.runinfo as runinfo
 import sequencing_runs_collector.parsers.samplesheet as samplesheet_parser
+import sequencing_runs_collector.run_staging as run_staging
+import sequencing_runs_collector.tracing as tracing
 
 
 MISEQ_RUN_ID_REGEX = "\\d{6}_M\\d{5}_\\d+_\\d{9}-[A-Z0-9]{5}"
 NEXTSEQ_RUN_ID_REGEX = "\\d{6}_VH\\d{5}_\\d+_[A-Z0-9]{9}"
 
+FASTQ_STATS_METRICS = ['num_reads', 'num_bases', 'q30', 'q30_last_n', 'per_cycle_quality', 'quality_histogram', 'checksum', 'file_size']
+FASTQ_STATS_NUM_LAST_BASES = 25
+FASTQ_STATS_MODES = ['exact', 'sampled']
+# Workers are started by a fork server, rather than forked from this process (see `new_fastq_stats_pool`).
+FASTQ_STATS_POOL_START_METHOD = 'forkserver'
+
 def get_illumina_interop_summary(run_dir):
     """
     Get the interop summary for an Illumina run.
@@ -108,6 +125,86 @@ def get_demultiplexing_num(run_id, demultiplexing_output_dir, instrument_model):
     return demultiplexing_num
 
 
+def get_demultiplexing_id(run_id, demultiplexing_output_dir, instrument_model):
+    """
+    Get the ID of a demultiplexing, e.g. '240101_M00123_0001_000000000-ABCDE-DEMUX-2'.
+
+    :param run_id: Run ID
+    :type run_id: str
+    :param demultiplexing_output_dir: Demultiplexing output directory
+    :type demultiplexing_output_dir: str
+    :param instrument_model: Instrument model ("MISEQ" or "NEXTSEQ")
+    :type instrument_model: str
+    :return: Demultiplexing ID
+    :rtype: str
+    """
+    demultiplexing_num = get_demultiplexing_num(run_id, demultiplexing_output_dir, instrument_model)
+    demultiplexing_id = '-'.join([run_id, "DEMUX", str(demultiplexing_num)])
+
+    return demultiplexing_id
+
+
+def get_demultiplexing_parent_dirs_mtime_ns(run_dir, instrument_model):
+    """
+    Get the latest mtime of the directories that a new demultiplexing of a run would be added to:
+    `Analysis` for a NextSeq, and the run directory and its `Alignment_*` directories for a MiSeq.
+    If it hasn't changed, the run hasn't been demultiplexed again.
+
+    :param run_dir: Run directory
+    :type run_dir: str
+    :param instrument_model: Instrument model ("MISEQ" or "NEXTSEQ")
+    :type instrument_model: str
+    :return: Latest mtime, in nanoseconds, or None if there is nowhere for a demultiplexing to be added yet
+    :rtype: Optional[int]
+    """
+    mtime_ns = None
+    if instrument_model == 'NEXTSEQ':
+        try:
+            mtime_ns = os.stat(os.path.join(run_dir, 'Analysis')).st_mtime_ns
+        except FileNotFoundError as e:
+            pass
+    elif instrument_model == 'MISEQ':
+        mtime_ns = os.stat(run_dir).st_mtime_ns
+        with os.scandir(run_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('Alignment_') and entry.is_dir():
+                    mtime_ns = max(mtime_ns, entry.stat().st_mtime_ns)
+
+    return mtime_ns
+
+
+def find_demultiplexings(run_id, run_dir, instrument_model, settle_seconds):
+    """
+    Find the demultiplexings of a run, and whether each one looks finished (settled): it has a SampleSheet,
+    and its FASTQ directory hasn't been modified for at least `settle_seconds`.
+
+    :param run_id: Run ID
+    :type run_id: str
+    :param run_dir: Run directory
+    :type run_dir: str
+    :param instrument_model: Instrument model ("MISEQ" or "NEXTSEQ")
+    :type instrument_model: str
+    :param settle_seconds: Time since the FASTQ directory was last modified
+    :type settle_seconds: float
+    :return: Demultiplexings. Keys: ['demultiplexing_id', 'demultiplexing_output_dir', 'settled']
+    :rtype: list[dict[str, object]]
+    """
+    demultiplexings = []
+    for demultiplexing_output_dir in find_demultiplexing_output_dirs(run_dir, instrument_model):
+        settled = False
+        if find_samplesheet(demultiplexing_output_dir, instrument_model) is not None:
+            fastq_dir = find_fastq_output_dir(demultiplexing_output_dir, instrument_model)
+            if fastq_dir is not None and os.path.exists(fastq_dir):
+                settled = time.time() - os.stat(fastq_dir).st_mtime >= settle_seconds
+        demultiplexings.append({
+            'demultiplexing_id': get_demultiplexing_id(run_id, demultiplexing_output_dir, instrument_model),
+            'demultiplexing_output_dir': demultiplexing_output_dir,
+            'settled': settled,
+        })
+
+    return demultiplexings
+
+
 def get_demultiplexing_start_timestamp(run_id:str, demultiplexing_output_dir: Path, instrument_model: str) -> Optional[str]:
     """
     Get a timestamp for when the demultiplexing was started.
@@ -168,90 +265,781 @@ def find_samplesheet(demultiplexing_output_dir, instrument_model):
     return samplesheet_path
 
 
-def get_fastq_stats(fastq_path, library_id, read_type="R1"):
+def _checksum_fields(read_type, checksum):
     """
-    Get statistics for a FASTQ file.
+    Build the checksum fields for one FASTQ file.
+
+    `fastq_md5_<read_type>` is only filled in for md5 checksums, so that it always holds what its name says.
+
+    :param read_type: Read type ("R1" or "R2")
+    :type read_type: str
+    :param checksum: Checksum, or None if there isn't one. Keys: ['checksum', 'checksum_algorithm', 'checksum_source']
+    :type checksum: Optional[dict[str, str]]
+    :return: Checksum fields. Keys: ['fastq_md5_<read_type>', 'fastq_checksum_<read_type>', 'fastq_checksum_algorithm_<read_type>', 'fastq_checksum_source_<read_type>']
+    :rtype: dict[str, Optional[str]]
+    """
+    rt = read_type.lower()
+    if checksum is None:
+        checksum = {
+            'checksum': None,
+            'checksum_algorithm': None,
+            'checksum_source': None,
+        }
+    fields = {
+        'fastq_md5_' + rt: checksum['checksum'] if checksum['checksum_algorithm'] == 'md5' else None,
+        'fastq_checksum_' + rt: checksum['checksum'],
+        'fastq_checksum_algorithm_' + rt: checksum['checksum_algorithm'],
+        'fastq_checksum_source_' + rt: checksum['checksum_source'],
+    }
+
+    return fields
+
 
+def _fastq_stats_metrics(existing_checksum):
+    """
+    The metrics to collect for a FASTQ file. The file isn't hashed if it already has a checksum.
+    """
+    if existing_checksum is None:
+        return FASTQ_STATS_METRICS
+
+    return [metric for metric in FASTQ_STATS_METRICS if metric != 'checksum']
+
+
+def _build_fastq_stats_summary(collected_stats, fastq_path, library_id, read_type, existing_checksum=None):
+    """
+    Build the summary for one FASTQ file from the output of `fastq_stats.collect_fastq_stats`.
+
+    :param collected_stats: Output of `fastq_stats.collect_fastq_stats`
+    :type collected_stats: dict[str, object]
     :param fastq_path: Path to FASTQ file
     :type fastq_path: str
     :param library_id: Library ID
     :type library_id: str
-    :param read_number: Read number
+    :param read_type: Read type ("R1" or "R2")
     :type read_type: str
-    :return: FASTQ statistics keys: [num_reads, num_bases]
+    :param existing_checksum: Checksum found by `fastq_checksums.find_existing_checksum`, used instead of `collected_stats['checksum']`.
+    :type existing_checksum: Optional[dict[str, str]]
+    :return: FASTQ statistics. Keys: [library_id, read_type, fastq_stats, counts, per_cycle_quality, quality_histograms, io_stats]
     :rtype: dict[str, object]
     """
-    try:
-        fq = pyfastx.Fastq(fastq_path, build_index=False)
-    except RuntimeError as e:
-        fastq_stats_summary = {
-            'library_id': library_id,
-            'read_type': read_type,
-            'stats': {
-                'num_reads_' + read_type.lower(): None,
-                'num_bases_' + read_type.lower(): None,
-                'q30_percent_' + read_type.lower(): None,
-                'q30_percent_last_25_bases_' + read_type.lower(): None,
-                'fastq_md5_' + read_type.lower(): None,
-                'fastq_file_size_mb' + read_type.lower(): None,
-            }
-        }
-        return fastq_stats_summary
-
-    num_reads = 0
-    num_bases = 0
-    num_bases_over_q30 = 0
-    num_bases_over_q30_last_25 = 0
-    for name, seq, qual in fq:
-        for q in qual:
-            phred_quality = ord(q) - 33
-            if phred_quality >= 30:
-                num_bases_over_q30 += 1
-        for q in qual[-25:]:
-            phred_quality = ord(q) - 33
-            if phred_quality >= 30:
-                num_bases_over_q30_last_25 += 1
-            
-        num_reads += 1
-        num_bases += len(seq)
+    num_reads = collected_stats['num_reads']
+    num_bases = collected_stats['num_bases']
+    num_bases_over_q30 = collected_stats['num_bases_over_q30']
+    num_bases_over_q30_last_25 = collected_stats['num_bases_over_q30_last_n']
 
-    file_size_bytes = os.path.getsize(fastq_path)
+    file_size_bytes = collected_stats['file_size_bytes']
     try:
         file_size_mb = round(file_size_bytes / 1024 / 1024, 4)
     except (ZeroDivisionError, ValueError) as e:
         file_size_mb = None
 
-    file_hash = hashlib.md5()
-    with open(fastq_path, "rb") as f:
-        while chunk := f.read(8192):
-            file_hash.update(chunk)
-
     try:
         q30_percent = round(num_bases_over_q30 / num_bases * 100, 4)
     except (ZeroDivisionError, ValueError) as e:
         q30_percent = None
     try:
-        q30_percent_last_25_bases = round(num_bases_over_q30_last_25 / (25 * num_reads) * 100, 4)
+        q30_percent_last_25_bases = round(num_bases_over_q30_last_25 / (collected_stats['num_last_bases'] * num_reads) * 100, 4)
     except (ZeroDivisionError, ValueError) as e:
         q30_percent_last_25_bases = None
 
+    checksum = existing_checksum
+    if checksum is None:
+        checksum = {
+            'checksum': collected_stats['checksum'],
+            'checksum_algorithm': collected_stats['checksum_algorithm'],
+            'checksum_source': 'computed',
+        }
+
     fastq_stats = {
         'num_reads_' + read_type.lower(): num_reads,
         'num_bases_' + read_type.lower(): num_bases,
         'q30_percent_' + read_type.lower(): q30_percent,
         'q30_percent_last_25_bases_' + read_type.lower(): q30_percent_last_25_bases,
-        'fastq_md5_' + read_type.lower(): file_hash.hexdigest(),
+        **_checksum_fields(read_type, checksum),
         'fastq_file_size_mb_' + read_type.lower(): file_size_mb,
     }
+    # The integer counts are kept so that R1 and R2 can be combined exactly.
+    counts = {
+        'num_reads': num_reads,
+        'num_bases': num_bases,
+        'num_bases_over_q30': num_bases_over_q30,
+        'num_bases_over_q30_last_n': num_bases_over_q30_last_25,
+        'num_last_bases': collected_stats['num_last_bases'],
+    }
+    io_stats = {
+        'file_size_bytes': file_size_bytes,
+        'bytes_read': collected_stats['bytes_read'],
+        'duration_seconds': collected_stats['duration_seconds'],
+        # Time spent in pool workers. Chunked files are spread across several workers at once.
+        'worker_seconds': collected_stats.get('chunk_worker_seconds', collected_stats['duration_seconds']),
+    }
+    logging.debug(json.dumps({
+        'event_type': 'fastq_stats_collected',
+        'fastq_path': os.path.abspath(fastq_path),
+        'library_id': library_id,
+        'read_type': read_type,
+        **io_stats,
+    }))
+    fastq_stats_summary = {
+        'library_id': library_id,
+        'read_type': read_type,
+        'fastq_stats': fastq_stats,
+        'counts': counts,
+        'per_cycle_quality': collected_stats['per_cycle_quality'],
+        # Bases at each phred quality score (0-93), so that other quality thresholds can be calculated later.
+        'quality_histograms': {
+            'all_bases': collected_stats['quality_histogram'],
+            'last_25_bases': collected_stats['quality_histogram_last_n'],
+        },
+        'io_stats': io_stats,
+    }
+
+    return fastq_stats_summary
+
+
+def _build_failed_fastq_stats_summary(library_id, read_type):
+    """
+    Build the summary for a FASTQ file whose statistics couldn't be collected.
+
+    :param library_id: Library ID
+    :type library_id: str
+    :param read_type: Read type ("R1" or "R2")
+    :type read_type: str
+    :return: FASTQ statistics, all None. Keys: [library_id, read_type, fastq_stats, counts]
+    :rtype: dict[str, object]
+    """
+    fastq_stats_summary = {
+        'library_id': library_id,
+        'read_type': read_type,
+        'fastq_stats': {
+            'num_reads_' + read_type.lower(): None,
+            'num_bases_' + read_type.lower(): None,
+            'q30_percent_' + read_type.lower(): None,
+            'q30_percent_last_25_bases_' + read_type.lower(): None,
+            **_checksum_fields(read_type, None),
+            'fastq_file_size_mb_' + read_type.lower(): None,
+        },
+        'counts': None,
+    }
+
+    return fastq_stats_summary
+
+
+def get_fastq_stats(fastq_path, library_id, read_type="R1", pool=None, hash_algorithm=fastq_stats_engine.DEFAULT_HASH_ALGORITHM, reader_backend=fastq_stats_engine.DEFAULT_READER_BACKEND):
+    """
+    Get statistics for a FASTQ file.
+
+    If the file already has a checksum in a sidecar file or checksum manifest (see `fastq_checksums.find_existing_checksum`),
+    that checksum is used and the file isn't hashed.
+
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: str
+    :param library_id: Library ID
+    :type library_id: str
+    :param read_number: Read number
+    :type read_type: str
+    :param pool: If provided, split this file into chunks and spread them across the pool's workers.
+    :type pool: Optional[multiprocessing.pool.Pool]
+    :param hash_algorithm: Hash algorithm to checksum the file with, if it doesn't already have a checksum.
+    :type hash_algorithm: str
+    :param reader_backend: How to read and decompress the file (see `fastq_stats.READER_BACKENDS`). Not used when a pool is provided.
+    :type reader_backend: str
+    :return: FASTQ statistics. Keys: [library_id, read_type, fastq_stats, counts, per_cycle_quality, quality_histograms, io_stats]
+    :rtype: dict[str, object]
+    """
+    existing_checksum = fastq_checksums.find_existing_checksum(fastq_path, hash_algorithm)
+    try:
+        collected_stats = fastq_stats_engine.collect_fastq_stats(
+            fastq_path,
+            metrics=_fastq_stats_metrics(existing_checksum),
+            num_last_bases=FASTQ_STATS_NUM_LAST_BASES,
+            pool=pool,
+            hash_algorithm=hash_algorithm,
+            reader_backend=reader_backend,
+        )
+    except (OSError, EOFError, zlib.error, ValueError) as e:
+        logging.error(json.dumps({
+            'event_type': 'collect_fastq_stats_failed',
+            'fastq_path': os.path.abspath(fastq_path),
+            'error': str(e),
+        }))
+        return _build_failed_fastq_stats_summary(library_id, read_type)
+
+    fastq_stats_summary = _build_fastq_stats_summary(collected_stats, fastq_path, library_id, read_type, existing_checksum)
+
+    return fastq_stats_summary
+
+
+def get_paired_fastq_stats(fastq_path_r1, fastq_path_r2, library_id, hash_algorithm=fastq_stats_engine.DEFAULT_HASH_ALGORITHM, reader_backend=fastq_stats_engine.DEFAULT_READER_BACKEND):
+    """
+    Get statistics for the R1 and R2 FASTQ files of a paired-end library, streaming both files together.
+    Existing checksums are only used if both files have one. Otherwise both files are hashed.
+
+    If the files can't be read together (e.g. they don't have the same number of reads, their read IDs don't match, or one is truncated),
+    each file's statistics are collected on its own instead, and both summaries get a 'pairing_error' describing what went wrong.
+
+    :param fastq_path_r1: Path to R1 FASTQ file
+    :type fastq_path_r1: str
+    :param fastq_path_r2: Path to R2 FASTQ file
+    :type fastq_path_r2: str
+    :param library_id: Library ID
+    :type library_id: str
+    :param hash_algorithm: Hash algorithm to checksum the files with, if they don't already have checksums.
+    :type hash_algorithm: str
+    :param reader_backend: How to read and decompress the files (see `fastq_stats.READER_BACKENDS`)
+    :type reader_backend: str
+    :return: FASTQ statistics for R1 and R2, in that order. Each has keys: [library_id, read_type, fastq_stats, counts, io_stats],
+             and [pairing_error] if the files couldn't be read together.
+    :rtype: list[dict[str, object]]
+    """
+    existing_checksum_r1 = fastq_checksums.find_existing_checksum(fastq_path_r1, hash_algorithm)
+    existing_checksum_r2 = fastq_checksums.find_existing_checksum(fastq_path_r2, hash_algorithm)
+    if existing_checksum_r1 is None or existing_checksum_r2 is None:
+        existing_checksum_r1 = None
+        existing_checksum_r2 = None
+    try:
+        collected_stats = fastq_stats_engine.collect_paired_fastq_stats(
+            fastq_path_r1,
+            fastq_path_r2,
+            metrics=_fastq_stats_metrics(existing_checksum_r1),
+            num_last_bases=FASTQ_STATS_NUM_LAST_BASES,
+            hash_algorithm=hash_algorithm,
+            reader_backend=reader_backend,
+        )
+    except (OSError, EOFError, zlib.error, ValueError) as e:
+        logging.error(json.dumps({
+            'event_type': 'collect_paired_fastq_stats_failed',
+            'fastq_path_r1': os.path.abspath(fastq_path_r1),
+            'fastq_path_r2': os.path.abspath(fastq_path_r2),
+            'error': str(e),
+        }))
+        fastq_stats_summaries = [
+            get_fastq_stats(fastq_path_r1, library_id, "R1", hash_algorithm=hash_algorithm, reader_backend=reader_backend),
+            get_fastq_stats(fastq_path_r2, library_id, "R2", hash_algorithm=hash_algorithm, reader_backend=reader_backend),
+        ]
+        for fastq_stats_summary in fastq_stats_summaries:
+            fastq_stats_summary['pairing_error'] = str(e)
+
+        return fastq_stats_summaries
+
+    fastq_stats_summaries = [
+        _build_fastq_stats_summary(collected_stats['r1'], fastq_path_r1, library_id, "R1", existing_checksum_r1),
+        _build_fastq_stats_summary(collected_stats['r2'], fastq_path_r2, library_id, "R2", existing_checksum_r2),
+    ]
+
+    return fastq_stats_summaries
+
+
+def _percent_estimate_fields(field_name, estimate):
+    """
+    Convert an estimated fraction into a percentage with its confidence interval.
+
+    :param field_name: Name of the percentage field, e.g. 'q30_percent_r1'
+    :type field_name: str
+    :param estimate: Estimated fraction. Keys: ['estimate', 'ci_lower', 'ci_upper']
+    :type estimate: dict[str, Optional[float]]
+    :return: Fields. Keys: [field_name, field_name + '_ci_lower', field_name + '_ci_upper']
+    :rtype: dict[str, Optional[float]]
+    """
+    fields = {
+        field_name: None,
+        field_name + '_ci_lower': None,
+        field_name + '_ci_upper': None,
+    }
+    if estimate['estimate'] is not None:
+        fields[field_name] = round(estimate['estimate'] * 100, 4)
+    if estimate['ci_lower'] is not None:
+        fields[field_name + '_ci_lower'] = round(max(0.0, estimate['ci_lower']) * 100, 4)
+        fields[field_name + '_ci_upper'] = round(min(1.0, estimate['ci_upper']) * 100, 4)
+
+    return fields
+
+
+def get_sampled_fastq_stats(fastq_path, library_id, read_type="R1", num_sampled_reads=fastq_stats_engine.DEFAULT_SAMPLE_NUM_READS, num_reads=None, hash_algorithm=fastq_stats_engine.DEFAULT_HASH_ALGORITHM):
+    """
+    Estimate statistics for a FASTQ file from a sample of its reads.
+
+    The number of reads is always exact. It's taken from `num_reads` if provided (e.g. from the instrument's
+    demultiplexing report), otherwise the file is read once to count its reads and calculate its checksum.
+    An existing checksum (see `fastq_checksums.find_existing_checksum`) is used either way.
+
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: str
+    :param library_id: Library ID
+    :type library_id: str
+    :param read_type: Read type ("R1" or "R2")
+    :type read_type: str
+    :param num_sampled_reads: Number of reads to sample
+    :type num_sampled_reads: int
+    :param num_reads: Number of reads in the file, if already known.
+    :type num_reads: Optional[int]
+    :param hash_algorithm: Hash algorithm to checksum the file with, if it is read to count its reads and doesn't already have a checksum.
+    :type hash_algorithm: str
+    :return: FASTQ statistics. Keys: [library_id, read_type, fastq_stats, estimated_fields, estimates, counts, io_stats]
+    :rtype: dict[str, object]
+    """
+    rt = read_type.lower()
+    checksum = fastq_checksums.find_existing_checksum(fastq_path, hash_algorithm)
+    try:
+        sampled_stats = fastq_stats_engine.sample_fastq_stats(fastq_path, num_reads=num_sampled_reads, num_last_bases=FASTQ_STATS_NUM_LAST_BASES)
+        read_count = {
+            'num_reads': num_reads,
+            'bytes_read': 0,
+            'duration_seconds': 0,
+        }
+        num_reads_source = 'instrument'
+        if num_reads is None:
+            read_count = fastq_stats_engine.count_fastq_reads(fastq_path, hash_algorithm=hash_algorithm if checksum is None else None)
+            num_reads_source = 'fastq'
+            if checksum is None:
+                checksum = {
+                    'checksum': read_count['checksum'],
+                    'checksum_algorithm': read_count['checksum_algorithm'],
+                    'checksum_source': 'computed',
+                }
+    except (OSError, EOFError, zlib.error, ValueError) as e:
+        logging.error(json.dumps({
+            'event_type': 'sample_fastq_stats_failed',
+            'fastq_path': os.path.abspath(fastq_path),
+            'error': str(e),
+        }))
+        return _build_failed_fastq_stats_summary(library_id, read_type)
+
+    num_reads = read_count['num_reads']
+    mean_read_length = sampled_stats['mean_read_length']
+    num_bases = None
+    if mean_read_length['estimate'] is not None:
+        num_bases = round(mean_read_length['estimate'] * num_reads)
+
+    fastq_stats = {
+        'num_reads_' + rt: num_reads,
+        'num_bases_' + rt: num_bases,
+        **_percent_estimate_fields('q30_percent_' + rt, sampled_stats['q30_fraction']),
+        **_percent_estimate_fields('q30_percent_last_25_bases_' + rt, sampled_stats['q30_last_n_fraction']),
+        'mean_read_length_' + rt: None if mean_read_length['estimate'] is None else round(mean_read_length['estimate'], 4),
+        'mean_read_length_' + rt + '_ci_lower': None if mean_read_length['ci_lower'] is None else round(mean_read_length['ci_lower'], 4),
+        'mean_read_length_' + rt + '_ci_upper': None if mean_read_length['ci_upper'] is None else round(mean_read_length['ci_upper'], 4),
+        **_checksum_fields(read_type, checksum),
+        'fastq_file_size_mb_' + rt: round(sampled_stats['file_size_bytes'] / 1024 / 1024, 4),
+    }
+    estimated_fields = [
+        'num_bases_' + rt,
+        'q30_percent_' + rt,
+        'q30_percent_last_25_bases_' + rt,
+        'mean_read_length_' + rt,
+    ]
+    # Kept so that R1 and R2 can be combined into library totals.
+    estimates = {
+        'num_reads': num_reads,
+        'num_bases': num_bases,
+        'num_last_bases': sampled_stats['num_last_bases'],
+        'q30_fraction': sampled_stats['q30_fraction'],
+        'q30_last_n_fraction': sampled_stats['q30_last_n_fraction'],
+    }
+    io_stats = {
+        'file_size_bytes': sampled_stats['file_size_bytes'],
+        'bytes_read': sampled_stats['bytes_read'] + read_count['bytes_read'],
+        'duration_seconds': round(sampled_stats['duration_seconds'] + read_count['duration_seconds'], 4),
+        'worker_seconds': round(sampled_stats['duration_seconds'] + read_count['duration_seconds'], 4),
+    }
+    logging.debug(json.dumps({
+        'event_type': 'fastq_stats_sampled',
+        'fastq_path': os.path.abspath(fastq_path),
+        'library_id': library_id,
+        'read_type': read_type,
+        'num_reads_source': num_reads_source,
+        'sampling_method': sampled_stats['sampling_method'],
+        'num_windows_sampled': sampled_stats['num_windows_sampled'],
+        'num_reads_sampled': sampled_stats['num_reads_sampled'],
+        **io_stats,
+    }))
     fastq_stats_summary = {
         'library_id': library_id,
         'read_type': read_type,
         'fastq_stats': fastq_stats,
+        'estimated_fields': estimated_fields,
+        'estimates': estimates,
+        'counts': None,
+        'io_stats': io_stats,
     }
 
     return fastq_stats_summary
 
 
+def _get_worker_logging_config():
+    """
+    Get this process's logging setup, so that pool workers can log the same way.
+
+    :return: Logging config. Keys: [level, format, datefmt, filters]
+    :rtype: dict[str, object]
+    """
+    root_logger = logging.getLogger()
+    logging_config = {
+        'level': root_logger.level,
+        'format': None,
+        'datefmt': None,
+        'filters': [],
+    }
+    for handler in root_logger.handlers[:1]:
+        if handler.formatter is not None:
+            logging_config['format'] = handler.formatter._fmt
+            logging_config['datefmt'] = handler.formatter.datefmt
+        logging_config['filters'] = list(handler.filters)
+
+    return logging_config
+
+
+def _init_fastq_stats_worker(logging_config):
+    """
+    Set up a pool worker.
+
+    Workers ignore SIGINT. A Ctrl-C is delivered to the whole process group,
+    and the main process handles it by finishing the current run before exiting.
+    Workers don't inherit the main process's logging setup, so it's set up again from `logging_config`.
+
+    :param logging_config: Logging config, as returned by `_get_worker_logging_config`
+    :type logging_config: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        format=logging_config['format'],
+        datefmt=logging_config['datefmt'],
+        encoding='utf-8',
+        level=logging_config['level'],
+    )
+    for handler in logging.getLogger().handlers:
+        for logging_filter in logging_config['filters']:
+            handler.addFilter(logging_filter)
+
+
+def new_fastq_stats_pool(num_processes, max_tasks_per_worker=None):
+    """
+    Start a pool of FASTQ statistics workers.
+
+    Workers are started by a fork server, rather than forked from this process. This process runs threads
+    (e.g. for collecting runs and serving metrics), and a forked worker would inherit any locks that they held
+    at the time, with nothing left to release them. The fork server is a fresh process with this module already imported,
+    so starting a worker is still cheap.
+
+    :param num_processes: Number of worker processes
+    :type num_processes: int
+    :param max_tasks_per_worker: Replace each worker after this many tasks. If None, workers are never replaced.
+    :type max_tasks_per_worker: Optional[int]
+    :return: Pool
+    :rtype: multiprocessing.pool.Pool
+    """
+    context = multiprocessing.get_context(FASTQ_STATS_POOL_START_METHOD)
+    context.set_forkserver_preload([__name__])
+    pool = context.Pool(
+        processes=num_processes,
+        initializer=_init_fastq_stats_worker,
+        initargs=(_get_worker_logging_config(),),
+        maxtasksperchild=max_tasks_per_worker,
+    )
+
+    return pool
+
+
+def _run_fastq_stats_task(fastq_stats_task):
+    """
+    Run one FASTQ statistics task in a pool worker.
+
+    :param fastq_stats_task: Task. Keys: [task_type, library_id, ...]. 'paired' tasks also have keys [fastq_path_r1, fastq_path_r2].
+                             'single' tasks also have keys [fastq_path, read_type]. 'sampled' tasks also have keys
+                             [fastq_path, read_type, num_sampled_reads, num_reads]. All tasks have keys [hash_algorithm, reader_backend].
+                             Sampled tasks don't use the reader backend, as they only read parts of each file.
+    :type fastq_stats_task: dict[str, object]
+    :return: FASTQ statistics for each file in the task
+    :rtype: list[dict[str, object]]
+    """
+    hash_algorithm = fastq_stats_task['hash_algorithm']
+    if fastq_stats_task['task_type'] == 'paired':
+        return get_paired_fastq_stats(fastq_stats_task['fastq_path_r1'], fastq_stats_task['fastq_path_r2'], fastq_stats_task['library_id'], hash_algorithm, fastq_stats_task['reader_backend'])
+    if fastq_stats_task['task_type'] == 'sampled':
+        return [get_sampled_fastq_stats(fastq_stats_task['fastq_path'], fastq_stats_task['library_id'], fastq_stats_task['read_type'], fastq_stats_task['num_sampled_reads'], fastq_stats_task['num_reads'], hash_algorithm)]
+
+    return [get_fastq_stats(fastq_stats_task['fastq_path'], fastq_stats_task['library_id'], fastq_stats_task['read_type'], hash_algorithm=hash_algorithm, reader_backend=fastq_stats_task['reader_backend'])]
+
+
+def _imap_unordered_bounded(pool, func, tasks, max_in_flight):
+    """
+    Like `pool.imap_unordered`, but with at most `max_in_flight` tasks waiting in the pool at a time.
+
+    `imap_unordered` puts every task into the pool's queue at once. When several runs are collected at the same time
+    with one shared pool, a big run's tasks would all be queued ahead of a small run's. With a bounded number of
+    tasks in flight for each run, the runs' tasks are interleaved, and the workers are shared between them.
+
+    The first `max_in_flight` tasks are started before this returns. The rest are started as results are taken.
+    If a task raises an exception, the tasks still in the pool are waited for before it's raised, and no more are started.
+
+    :param pool: Process pool
+    :type pool: multiprocessing.pool.Pool
+    :param func: Function to call on each task
+    :type func: Callable
+    :param tasks: Tasks, started in order
+    :type tasks: list
+    :param max_in_flight: Maximum number of tasks in the pool at a time
+    :type max_in_flight: int
+    :return: Results, in the order that they finish
+    :rtype: Iterator
+    """
+    results = queue.SimpleQueue()
+    tasks_iter = iter(tasks)
+
+    def start_next_task():
+        task = next(tasks_iter, None)
+        if task is None:
+            return False
+        metrics.increment('fastq_stats_tasks_in_flight')
+        pool.apply_async(func, (task,), callback=lambda result: results.put((True, result)), error_callback=lambda e: results.put((False, e)))
+        return True
+
+    num_in_flight = 0
+    while num_in_flight < max(1, max_in_flight) and start_next_task():
+        num_in_flight += 1
+
+    def iter_results(num_in_flight):
+        try:
+            while num_in_flight > 0:
+                succeeded, result = results.get()
+                num_in_flight -= 1
+                metrics.increment('fastq_stats_tasks_in_flight', -1)
+                if not succeeded:
+                    raise result
+                if start_next_task():
+                    num_in_flight += 1
+                yield result
+        finally:
+            # If a task failed, or the caller stopped taking results, no more tasks are started. The ones already in the pool
+            # are waited for, so that `fastq_stats_tasks_in_flight` goes back down by the number that were started.
+            while num_in_flight > 0:
+                results.get()
+                num_in_flight -= 1
+                metrics.increment('fastq_stats_tasks_in_flight', -1)
+
+    return iter_results(num_in_flight)
+
+
+def _log_fastq_stats_task_progress(task_fastq_stats, task_file_size_bytes, progress, num_tasks, total_file_size_bytes, timestamp_start):
+    """
+    Record a finished FASTQ statistics task and log overall progress.
+
+    :param task_fastq_stats: FASTQ statistics for each file in the task
+    :type task_fastq_stats: list[dict[str, object]]
+    :param task_file_size_bytes: Total size of the task's FASTQ files
+    :type task_file_size_bytes: int
+    :param progress: Progress so far, updated in place. Keys: ['num_tasks_complete', 'file_size_bytes_complete', 'task_duration_seconds', 'task_worker_seconds']
+    :type progress: dict[str, object]
+    :param num_tasks: Total number of tasks
+    :type num_tasks: int
+    :param total_file_size_bytes: Total size of the FASTQ files across all tasks
+    :type total_file_size_bytes: int
+    :param timestamp_start: When the first task was started
+    :type timestamp_start: datetime.datetime
+    :return: None
+    :rtype: NoneType
+    """
+    # Both files in a paired task share a start time, so the longest of them is the task's duration.
+    task_duration_seconds = max((fastq_stat.get('io_stats', {}).get('duration_seconds', 0) for fastq_stat in task_fastq_stats), default=0)
+    task_worker_seconds = max((fastq_stat.get('io_stats', {}).get('worker_seconds', 0) for fastq_stat in task_fastq_stats), default=0)
+    progress['num_tasks_complete'] += 1
+    progress['file_size_bytes_complete'] += task_file_size_bytes
+    progress['task_duration_seconds'].append(task_duration_seconds)
+    progress['task_worker_seconds'].append(task_worker_seconds)
+    logging.info(json.dumps({
+        'event_type': 'fastq_stats_task_complete',
+        'library_id': task_fastq_stats[0]['library_id'],
+        'read_types': [fastq_stat['read_type'] for fastq_stat in task_fastq_stats],
+        'task_file_size_bytes': task_file_size_bytes,
+        'task_duration_seconds': round(task_duration_seconds, 4),
+        'num_tasks_complete': progress['num_tasks_complete'],
+        'num_tasks': num_tasks,
+        'file_size_bytes_complete': progress['file_size_bytes_complete'],
+        'total_file_size_bytes': total_file_size_bytes,
+        'elapsed_seconds': round((datetime.datetime.now() - timestamp_start).total_seconds(), 4),
+    }))
+
+
+def _get_quality_histograms(fastq_stat):
+    """
+    Get the quality histograms for a FASTQ file, with its read count, so that the last-25-bases percentages
+    can be recalculated from them the same way as they were collected (over 25 bases per read, however long the reads are).
+    """
+    quality_histograms = fastq_stat.get('quality_histograms', None)
+    counts = fastq_stat.get('counts', None)
+    if quality_histograms is None or counts is None:
+        return None
+
+    return {**quality_histograms, 'num_reads': counts['num_reads']}
+
+
+def combine_paired_fastq_stats(counts_r1, counts_r2):
+    """
+    Combine the R1 and R2 counts for a library into whole-library statistics.
+    The percentages are calculated from the integer counts, so no precision is lost.
+
+    :param counts_r1: R1 counts. Keys: [num_reads, num_bases, num_bases_over_q30, num_bases_over_q30_last_n, num_last_bases]
+    :type counts_r1: dict[str, int]
+    :param counts_r2: R2 counts. Keys: [num_reads, num_bases, num_bases_over_q30, num_bases_over_q30_last_n, num_last_bases]
+    :type counts_r2: dict[str, int]
+    :return: Combined statistics. Keys: [num_reads, num_bases, q30_percent, q30_percent_last_25_bases]
+    :rtype: dict[str, object]
+    """
+    num_reads_total = counts_r1['num_reads'] + counts_r2['num_reads']
+    num_bases_total = counts_r1['num_bases'] + counts_r2['num_bases']
+    num_q30_bases_total = counts_r1['num_bases_over_q30'] + counts_r2['num_bases_over_q30']
+    num_bases_last_25_total = counts_r1['num_reads'] * counts_r1['num_last_bases'] + counts_r2['num_reads'] * counts_r2['num_last_bases']
+    num_q30_bases_last_25_total = counts_r1['num_bases_over_q30_last_n'] + counts_r2['num_bases_over_q30_last_n']
+    try:
+        q30_percent_total = round(num_q30_bases_total / num_bases_total * 100, 4)
+    except ZeroDivisionError as e:
+        q30_percent_total = None
+    try:
+        q30_percent_last_25_bases_total = round(num_q30_bases_last_25_total / num_bases_last_25_total * 100, 4)
+    except ZeroDivisionError as e:
+        q30_percent_last_25_bases_total = None
+
+    combined_stats = {
+        'num_reads': num_reads_total,
+        'num_bases': num_bases_total,
+        'q30_percent': q30_percent_total,
+        'q30_percent_last_25_bases': q30_percent_last_25_bases_total,
+    }
+
+    return combined_stats
+
+
+def _fastq_stats_estimates_from_counts(counts):
+    """
+    Express exact counts in the same form as the estimates from `get_sampled_fastq_stats`, with no uncertainty.
+
+    :param counts: Counts. Keys: [num_reads, num_bases, num_bases_over_q30, num_bases_over_q30_last_n, num_last_bases]
+    :type counts: dict[str, int]
+    :return: Estimates. Keys: [num_reads, num_bases, num_last_bases, q30_fraction, q30_last_n_fraction]
+    :rtype: dict[str, object]
+    """
+    def exact(numerator, denominator):
+        fraction = numerator / denominator if denominator > 0 else None
+        return {
+            'estimate': fraction,
+            'standard_error': None if fraction is None else 0.0,
+            'ci_lower': fraction,
+            'ci_upper': fraction,
+        }
+
+    estimates = {
+        'num_reads': counts['num_reads'],
+        'num_bases': counts['num_bases'],
+        'num_last_bases': counts['num_last_bases'],
+        'q30_fraction': exact(counts['num_bases_over_q30'], counts['num_bases']),
+        'q30_last_n_fraction': exact(counts['num_bases_over_q30_last_n'], counts['num_last_bases'] * counts['num_reads']),
+    }
+
+    return estimates
+
+
+def combine_sampled_fastq_stats(estimates_r1, estimates_r2):
+    """
+    Combine the R1 and R2 estimates for a library into whole-library statistics.
+    Each read's fraction is weighted by the number of bases it covers. The two estimates are independent,
+    so their standard errors are combined in quadrature.
+
+    :param estimates_r1: R1 estimates. Keys: [num_reads, num_bases, num_last_bases, q30_fraction, q30_last_n_fraction]
+    :type estimates_r1: dict[str, object]
+    :param estimates_r2: R2 estimates. Keys: [num_reads, num_bases, num_last_bases, q30_fraction, q30_last_n_fraction]
+    :type estimates_r2: dict[str, object]
+    :return: Combined statistics. Keys: [num_reads, num_bases, q30_percent, q30_percent_last_25_bases], plus '_ci_lower' and '_ci_upper' for each percentage.
+    :rtype: dict[str, object]
+    """
+    def combine(fraction_r1, weight_r1, fraction_r2, weight_r2):
+        combined = {
+            'estimate': None,
+            'ci_lower': None,
+            'ci_upper': None,
+        }
+        total_weight = weight_r1 + weight_r2
+        if fraction_r1['estimate'] is None or fraction_r2['estimate'] is None or total_weight == 0:
+            return combined
+        combined['estimate'] = (fraction_r1['estimate'] * weight_r1 + fraction_r2['estimate'] * weight_r2) / total_weight
+        if fraction_r1['standard_error'] is not None and fraction_r2['standard_error'] is not None:
+            standard_error = math.sqrt((weight_r1 * fraction_r1['standard_error']) ** 2 + (weight_r2 * fraction_r2['standard_error']) ** 2) / total_weight
+            combined['ci_lower'] = combined['estimate'] - fastq_stats_engine.CONFIDENCE_INTERVAL_Z * standard_error
+            combined['ci_upper'] = combined['estimate'] + fastq_stats_engine.CONFIDENCE_INTERVAL_Z * standard_error
+
+        return combined
+
+    num_bases_r1 = estimates_r1['num_bases'] or 0
+    num_bases_r2 = estimates_r2['num_bases'] or 0
+    q30_fraction = combine(estimates_r1['q30_fraction'], num_bases_r1, estimates_r2['q30_fraction'], num_bases_r2)
+    q30_last_n_fraction = combine(
+        estimates_r1['q30_last_n_fraction'], estimates_r1['num_last_bases'] * estimates_r1['num_reads'],
+        estimates_r2['q30_last_n_fraction'], estimates_r2['num_last_bases'] * estimates_r2['num_reads'],
+    )
+
+    combined_stats = {
+        'num_reads': estimates_r1['num_reads'] + estimates_r2['num_reads'],
+        'num_bases': None if estimates_r1['num_bases'] is None or estimates_r2['num_bases'] is None else num_bases_r1 + num_bases_r2,
+        **_percent_estimate_fields('q30_percent', q30_fraction),
+        **_percent_estimate_fields('q30_percent_last_25_bases', q30_last_n_fraction),
+    }
+
+    return combined_stats
+
+
+def get_instrument_fastq_read_counts(demultiplexing_output_dir, instrument_model):
+    """
+    Get the number of reads per library from the reports written by the instrument's demultiplexing software.
+    These are used in place of counting the reads in the FASTQ files when FASTQ statistics are sampled.
+
+    NextSeq: Data/Reports/Demultiplex_Stats.csv (summed across lanes).
+    MiSeq: GenerateFASTQRunStatistics.xml (number of clusters passing filter).
+
+    :param demultiplexing_output_dir: Demultiplexing output directory
+    :type demultiplexing_output_dir: str
+    :param instrument_model: Instrument model ("MISEQ" or "NEXTSEQ")
+    :type instrument_model: str
+    :return: Number of reads in each of the library's FASTQ files, indexed by library ID. Empty if the report isn't available.
+    :rtype: dict[str, int]
+    """
+    read_counts_by_library_id = {}
+    try:
+        if instrument_model == 'NEXTSEQ':
+            demultiplex_stats_path = os.path.join(demultiplexing_output_dir, 'Data', 'Reports', 'Demultiplex_Stats.csv')
+            if os.path.exists(demultiplex_stats_path):
+                libraries_with_missing_counts = set()
+                for record in demultiplex_stats.parse_demultiplex_stats(demultiplex_stats_path):
+                    library_id = record['library_id']
+                    if record['num_reads'] is None:
+                        libraries_with_missing_counts.add(library_id)
+                        continue
+                    read_counts_by_library_id[library_id] = read_counts_by_library_id.get(library_id, 0) + record['num_reads']
+                for library_id in libraries_with_missing_counts:
+                    read_counts_by_library_id.pop(library_id, None)
+        elif instrument_model == 'MISEQ':
+            if os.path.basename(demultiplexing_output_dir) == 'BaseCalls':
+                # The 'old' MiSeq output directory structure writes this to the top of the run directory.
+                generate_fastq_run_statistics_path = os.path.join(demultiplexing_output_dir, os.pardir, os.pardir, os.pardir, 'GenerateFASTQRunStatistics.xml')
+            else:
+                generate_fastq_run_statistics_path = os.path.join(demultiplexing_output_dir, 'GenerateFASTQRunStatistics.xml')
+            if os.path.exists(generate_fastq_run_statistics_path):
+                parsed_statistics = generate_fastq_run_statistics.parse_generate_fastq_run_statistics(generate_fastq_run_statistics_path)
+                for sample_stats in parsed_statistics.get('sample_stats', []):
+                    library_id = sample_stats['sample_id'] or sample_stats['sample_name']
+                    if library_id is not None and sample_stats['num_clusters_passed_filter'] is not None:
+                        read_counts_by_library_id[library_id] = sample_stats['num_clusters_passed_filter']
+    except (OSError, KeyError, TypeError, ValueError, xml.parsers.expat.ExpatError) as e:
+        logging.warning(json.dumps({
+            'event_type': 'parse_instrument_read_counts_failed',
+            'demultiplexing_output_dir': os.path.abspath(demultiplexing_output_dir),
+            'error': str(e),
+        }))
+        return {}
+
+    return read_counts_by_library_id
+
+
 def find_fastq_output_dir(demultiplexing_output_dir, instrument_model):
     """
     Find the FASTQ output directory for a demultiplexing output directory.
@@ -275,10 +1063,376 @@ def find_fastq_output_dir(demultiplexing_output_dir, instrument_model):
     return fastq_dir
 
 
-def get_sequenced_libraries_from_samplesheet(samplesheet, instrument_model, demultiplexing_output_dir, project_id_translation, collect_fastq_stats=False, num_fastq_stats_processes=1):
+def estimate_run_fastq_bytes(run_dir, instrument_model):
+    """
+    Estimate how much FASTQ data a run has, from the sizes of the FASTQ files in each of its FASTQ output directories.
+
+    :param run_dir: Run directory
+    :type run_dir: str
+    :param instrument_model: Instrument model ("MISEQ" or "NEXTSEQ")
+    :type instrument_model: str
+    :return: Total size of the run's FASTQ files, in bytes
+    :rtype: int
+    """
+    total_fastq_bytes = 0
+    for demultiplexing_output_dir in find_demultiplexing_output_dirs(run_dir, instrument_model):
+        fastq_dir = find_fastq_output_dir(demultiplexing_output_dir, instrument_model)
+        if fastq_dir is None or not os.path.isdir(fastq_dir):
+            continue
+        with os.scandir(fastq_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(('.fastq.gz', '.fastq')) and entry.is_file():
+                    total_fastq_bytes += entry.stat().st_size
+
+    return total_fastq_bytes
+
+
+def _is_usable_cached_fastq_stat(cached_fastq_stat, read_type, fastq_checksum_algorithm):
+    """
+    Check whether a FASTQ stats cache entry can be used in place of reading the file.
+
+    Entries written before the integer counts, per-cycle quality, quality histograms or checksum fields were kept can't be used.
+    Nor can entries whose checksum was calculated with a different hash algorithm than the one that's now configured.
+    Checksums taken from sidecar files or manifests are used whatever their algorithm, as they would be if the file was read again.
+
+    :param cached_fastq_stat: Cache entry, as returned by `fastq_stats_cache.lookup`
+    :type cached_fastq_stat: Optional[dict[str, object]]
+    :param read_type: Read type ("R1" or "R2")
+    :type read_type: str
+    :param fastq_checksum_algorithm: Hash algorithm that FASTQ files are checksummed with
+    :type fastq_checksum_algorithm: str
+    :return: True if the entry can be used
+    :rtype: bool
+    """
+    if cached_fastq_stat is None or cached_fastq_stat.get('counts', None) is None:
+        return False
+    if 'per_cycle_quality' not in cached_fastq_stat or 'quality_histograms' not in cached_fastq_stat:
+        return False
+    rt = read_type.lower()
+    fastq_stats = cached_fastq_stat.get('fastq_stats', {})
+    if fastq_stats.get('fastq_checksum_' + rt, None) is None:
+        return False
+    if fastq_stats.get('fastq_checksum_source_' + rt, None) == 'computed' and fastq_stats.get('fastq_checksum_algorithm_' + rt, None) != fastq_checksum_algorithm:
+        return False
+
+    return True
+
+
+def collect_fastq_stats_for_libraries(libraries_by_library_id, fastq_dir, num_fastq_stats_processes=1, chunked_fastq_stats_min_file_size_mb=None, fastq_stats_cache_path=None, fastq_stats_cache_max_entries=fastq_stats_cache.DEFAULT_MAX_ENTRIES, sequencing_run_id=None, pool=None, fastq_stats_mode='exact', fastq_stats_sample_num_reads=fastq_stats_engine.DEFAULT_SAMPLE_NUM_READS, instrument_read_counts=None, fastq_checksum_algorithm=fastq_stats_engine.DEFAULT_HASH_ALGORITHM, fastq_reader_backend=fastq_stats_engine.DEFAULT_READER_BACKEND, fastq_stats_checkpoint_dir=None):
+    """
+    Collect FASTQ statistics for a set of libraries, in parallel.
+
+    When both the R1 and R2 files of a library need to be read, they are read together by a single worker
+    so that the two files are checked against each other and the library totals can be calculated exactly.
+
+    In 'sampled' mode, quality statistics are estimated from a sample of each file's reads instead (see `get_sampled_fastq_stats`).
+    Cached exact statistics are still used where available. Sampled statistics are never cached.
+
+    :param libraries_by_library_id: Libraries, indexed by library ID. Each library may have keys ['fastq_filename_r1', 'fastq_filename_r2']
+    :type libraries_by_library_id: dict[str, dict[str, object]]
+    :param fastq_dir: Directory containing the FASTQ files
+    :type fastq_dir: str
+    :param num_fastq_stats_processes: Number of FASTQ statistics processes
+    :type num_fastq_stats_processes: int
+    :param chunked_fastq_stats_min_file_size_mb: FASTQ files at least this large are split into chunks and spread across all processes. If None, each file is handled by a single process.
+    :type chunked_fastq_stats_min_file_size_mb: Optional[float]
+    :param fastq_stats_cache_path: Path to the FASTQ statistics cache. If None, statistics are always recomputed.
+    :type fastq_stats_cache_path: Optional[str]
+    :param fastq_stats_cache_max_entries: Maximum number of entries to keep in the FASTQ statistics cache
+    :type fastq_stats_cache_max_entries: int
+    :param sequencing_run_id: Sequencing run ID, recorded with cache entries so that they can be invalidated by run.
+    :type sequencing_run_id: Optional[str]
+    :param pool: Worker pool to use, with `num_fastq_stats_processes` workers. It is left open for the caller to reuse.
+                 If None, a pool is created for this call and closed afterwards.
+    :type pool: Optional[multiprocessing.pool.Pool]
+    :param fastq_stats_mode: 'exact' or 'sampled'
+    :type fastq_stats_mode: str
+    :param fastq_stats_sample_num_reads: Number of reads to sample from each file, in 'sampled' mode
+    :type fastq_stats_sample_num_reads: int
+    :param instrument_read_counts: Number of reads in each library's FASTQ files, from the instrument's reports, indexed by library ID.
+                                   In 'sampled' mode, files for libraries that aren't listed here are read once to count their reads.
+    :type instrument_read_counts: Optional[dict[str, int]]
+    :param fastq_checksum_algorithm: Hash algorithm to checksum FASTQ files with, when they don't already have a checksum.
+    :type fastq_checksum_algorithm: str
+    :param fastq_reader_backend: How to read and decompress whole FASTQ files (see `fastq_stats.READER_BACKENDS`)
+    :type fastq_reader_backend: str
+    :param fastq_stats_checkpoint_dir: Run's checkpoint directory. Each file's statistics are checkpointed there as soon as they are collected,
+                                       and reused if the run is collected again (see `run_staging.load_fastq_stats_checkpoint`).
+    :type fastq_stats_checkpoint_dir: Optional[str]
+    :return: FASTQ statistics, indexed by library ID. Keys: ['num_reads_r1', 'q30_percent_r1', ..., 'num_reads', 'num_bases', 'q30_percent', 'q30_percent_last_25_bases'],
+             plus ['per_cycle_quality_r1', 'per_cycle_quality_r2', 'quality_histograms_r1', 'quality_histograms_r2'] (None if not collected),
+             and ['pairing_error'], describing why the R1 and R2 files didn't pair up (None if they did, or if there is only one).
+             In 'sampled' mode, also ['fastq_stats_mode', 'estimated_fields'] and confidence intervals ('..._ci_lower', '..._ci_upper') for each estimated percentage.
+    :rtype: dict[str, dict[str, object]]
+    """
+    get_fastq_stats_inputs = []
+    for library_id, library in libraries_by_library_id.items():
+        for read_type in ["R1", "R2"]:
+            fastq_filename = library.get('fastq_filename_' + read_type.lower(), None)
+            if fastq_filename is None:
+                continue
+            fastq_path = os.path.join(fastq_dir, fastq_filename)
+            if os.path.exists(fastq_path):
+                get_fastq_stats_input = {
+                    'fastq_path': fastq_path,
+                    'library_id': library_id,
+                    'read_type': read_type,
+                }
+                get_fastq_stats_inputs.append(get_fastq_stats_input)
+
+    timestamp_collect_fastq_stats_start = datetime.datetime.now()
+    logging.info(json.dumps({
+        'event_type': 'collect_fastq_stats_start',
+        'fastq_dir': os.path.abspath(fastq_dir),
+        'num_fastq_stats_inputs': len(get_fastq_stats_inputs)
+    }))
+
+    # Files that haven't changed since their stats were cached don't need to be read again.
+    # Files whose stats were checkpointed by an earlier attempt at collecting this run are treated the same way.
+    fastq_stats_cached = []
+    fastq_stats_cache_conn = None
+    if fastq_stats_cache_path is not None:
+        fastq_stats_cache_conn = fastq_stats_cache.open_cache(fastq_stats_cache_path)
+    if fastq_stats_cache_conn is not None or fastq_stats_checkpoint_dir is not None:
+        get_fastq_stats_inputs_uncached = []
+        num_checkpoint_hits = 0
+        for input in get_fastq_stats_inputs:
+            cached_fastq_stat = None
+            if fastq_stats_cache_conn is not None:
+                cached_fastq_stat = fastq_stats_cache.lookup(fastq_stats_cache_conn, input['fastq_path'])
+            if fastq_stats_checkpoint_dir is not None and not _is_usable_cached_fastq_stat(cached_fastq_stat, input['read_type'], fastq_checksum_algorithm):
+                cached_fastq_stat = run_staging.load_fastq_stats_checkpoint(fastq_stats_checkpoint_dir, input['fastq_path'])
+                if _is_usable_cached_fastq_stat(cached_fastq_stat, input['read_type'], fastq_checksum_algorithm):
+                    num_checkpoint_hits += 1
+            if not _is_usable_cached_fastq_stat(cached_fastq_stat, input['read_type'], fastq_checksum_algorithm):
+                get_fastq_stats_inputs_uncached.append(input)
+                continue
+            cached_fastq_stat['library_id'] = input['library_id']
+            cached_fastq_stat['read_type'] = input['read_type']
+            cached_fastq_stat['io_stats'] = {
+                'file_size_bytes': cached_fastq_stat.get('io_stats', {}).get('file_size_bytes', 0),
+                'bytes_read': 0,
+                'duration_seconds': 0,
+            }
+            fastq_stats_cached.append(cached_fastq_stat)
+        logging.info(json.dumps({
+            'event_type': 'fastq_stats_cache_lookup_complete',
+            'fastq_dir': os.path.abspath(fastq_dir),
+            'num_cache_hits': len(fastq_stats_cached) - num_checkpoint_hits,
+            'num_checkpoint_hits': num_checkpoint_hits,
+            'num_cache_misses': len(get_fastq_stats_inputs_uncached),
+        }))
+        get_fastq_stats_inputs = get_fastq_stats_inputs_uncached
+
+    # Very large files would otherwise leave one worker running long after the others
+    # have finished, so they are split into chunks that are spread across the pool.
+    # Their chunks are queued behind the whole-file tasks.
+    get_fastq_stats_inputs_whole_file_by_library_id = {}
+    get_fastq_stats_inputs_chunked = []
+    for input in get_fastq_stats_inputs:
+        input['file_size_bytes'] = os.path.getsize(input['fastq_path'])
+        if fastq_stats_mode == 'sampled':
+            continue
+        if chunked_fastq_stats_min_file_size_mb is not None and input['file_size_bytes'] >= chunked_fastq_stats_min_file_size_mb * 1024 * 1024:
+            get_fastq_stats_inputs_chunked.append(input)
+        else:
+            get_fastq_stats_inputs_whole_file_by_library_id.setdefault(input['library_id'], []).append(input)
+
+    fastq_stats_tasks = []
+    if fastq_stats_mode == 'sampled':
+        if instrument_read_counts is None:
+            instrument_read_counts = {}
+        for input in get_fastq_stats_inputs:
+            fastq_stats_tasks.append({
+                'task_type': 'sampled',
+                'num_sampled_reads': fastq_stats_sample_num_reads,
+                'num_reads': instrument_read_counts.get(input['library_id'], None),
+                'hash_algorithm': fastq_checksum_algorithm,
+                'reader_backend': fastq_reader_backend,
+                **input,
+            })
+    for library_id, inputs in get_fastq_stats_inputs_whole_file_by_library_id.items():
+        inputs_by_read_type = {input['read_type']: input for input in inputs}
+        if 'R1' in inputs_by_read_type and 'R2' in inputs_by_read_type:
+            fastq_stats_tasks.append({
+                'task_type': 'paired',
+                'library_id': library_id,
+                'fastq_path_r1': inputs_by_read_type['R1']['fastq_path'],
+                'fastq_path_r2': inputs_by_read_type['R2']['fastq_path'],
+                'file_size_bytes': inputs_by_read_type['R1']['file_size_bytes'] + inputs_by_read_type['R2']['file_size_bytes'],
+                'hash_algorithm': fastq_checksum_algorithm,
+                'reader_backend': fastq_reader_backend,
+            })
+        else:
+            for input in inputs:
+                fastq_stats_tasks.append({'task_type': 'single', 'hash_algorithm': fastq_checksum_algorithm, 'reader_backend': fastq_reader_backend, **input})
+
+    # Largest first, so that a big library at the end of the samplesheet
+    # doesn't start after the other workers have run out of work.
+    fastq_stats_tasks.sort(key=lambda task: task['file_size_bytes'], reverse=True)
+    get_fastq_stats_inputs_chunked.sort(key=lambda input: input['file_size_bytes'], reverse=True)
+    num_fastq_stats_tasks = len(fastq_stats_tasks) + len(get_fastq_stats_inputs_chunked)
+    total_task_file_size_bytes = sum(task['file_size_bytes'] for task in fastq_stats_tasks) + sum(input['file_size_bytes'] for input in get_fastq_stats_inputs_chunked)
+    progress = {
+        'num_tasks_complete': 0,
+        'file_size_bytes_complete': 0,
+        'task_duration_seconds': [],
+        'task_worker_seconds': [],
+    }
+
+    # Each file's stats are stored as soon as they are collected, so that they aren't lost if collection is interrupted.
+    # Each file also gets a span in the run's trace, timed by the pool worker that read it.
+    fastq_paths_by_library_id_and_read_type = {(input['library_id'], input['read_type']): input['fastq_path'] for input in get_fastq_stats_inputs}
+    def store_fastq_stats(task_fastq_stats):
+        for fastq_stat in task_fastq_stats:
+            io_stats = fastq_stat.get('io_stats', {})
+            tracing.add_span(
+                'get_fastq_stats',
+                io_stats.get('duration_seconds', None),
+                io_stats.get('bytes_read', None),
+                library_id=fastq_stat['library_id'],
+                read_type=fastq_stat['read_type'],
+                fastq_filename=os.path.basename(fastq_paths_by_library_id_and_read_type[(fastq_stat['library_id'], fastq_stat['read_type'])]),
+                file_size_bytes=io_stats.get('file_size_bytes', None),
+            )
+            metrics.increment('fastq_files_processed_total')
+            metrics.increment('fastq_bytes_read_total', io_stats.get('bytes_read', 0))
+            metrics.increment('fastq_reads_processed_total', (fastq_stat.get('counts', None) or {}).get('num_reads', 0))
+            # Failed attempts aren't stored, so they will be retried next time.
+            if fastq_stat.get('counts', None) is None:
+                continue
+            fastq_path = fastq_paths_by_library_id_and_read_type[(fastq_stat['library_id'], fastq_stat['read_type'])]
+            if fastq_stats_cache_conn is not None:
+                fastq_stats_cache.store(fastq_stats_cache_conn, fastq_path, sequencing_run_id, fastq_stat)
+            if fastq_stats_checkpoint_dir is not None:
+                run_staging.store_fastq_stats_checkpoint(fastq_stats_checkpoint_dir, fastq_path, fastq_stat)
+
+    timestamp_fastq_stats_tasks_start = datetime.datetime.now()
+    pool_is_owned = pool is None
+    if pool_is_owned:
+        pool = new_fastq_stats_pool(num_fastq_stats_processes)
+    fastq_stats_whole_file_results = _imap_unordered_bounded(pool, _run_fastq_stats_task, fastq_stats_tasks, num_fastq_stats_processes)
+    fastq_stats = []
+    for input in get_fastq_stats_inputs_chunked:
+        logging.info(json.dumps({
+            'event_type': 'collect_fastq_stats_chunked_start',
+            'fastq_path': os.path.abspath(input['fastq_path']),
+        }))
+        fastq_stat = get_fastq_stats(input['fastq_path'], input['library_id'], input['read_type'], pool=pool, hash_algorithm=fastq_checksum_algorithm)
+        _log_fastq_stats_task_progress([fastq_stat], input['file_size_bytes'], progress, num_fastq_stats_tasks, total_task_file_size_bytes, timestamp_fastq_stats_tasks_start)
+        store_fastq_stats([fastq_stat])
+        fastq_stats.append(fastq_stat)
+    for task_fastq_stats in fastq_stats_whole_file_results:
+        task_file_size_bytes = sum(fastq_stat.get('io_stats', {}).get('file_size_bytes', 0) for fastq_stat in task_fastq_stats)
+        _log_fastq_stats_task_progress(task_fastq_stats, task_file_size_bytes, progress, num_fastq_stats_tasks, total_task_file_size_bytes, timestamp_fastq_stats_tasks_start)
+        store_fastq_stats(task_fastq_stats)
+        fastq_stats.extend(task_fastq_stats)
+    if pool_is_owned:
+        pool.close()
+        pool.join()
+    timestamp_fastq_stats_tasks_complete = datetime.datetime.now()
+
+    # The ideal makespan assumes the work could be split evenly across every worker.
+    makespan_seconds = (timestamp_fastq_stats_tasks_complete - timestamp_fastq_stats_tasks_start).total_seconds()
+    total_task_duration_seconds = sum(progress['task_duration_seconds'])
+    ideal_makespan_seconds = sum(progress['task_worker_seconds']) / num_fastq_stats_processes
+    logging.info(json.dumps({
+        'event_type': 'fastq_stats_tasks_complete',
+        'fastq_dir': os.path.abspath(fastq_dir),
+        'num_tasks': num_fastq_stats_tasks,
+        'num_processes': num_fastq_stats_processes,
+        'makespan_seconds': round(makespan_seconds, 4),
+        'ideal_makespan_seconds': round(ideal_makespan_seconds, 4),
+        'longest_task_seconds': round(max(progress['task_duration_seconds'], default=0), 4),
+        'total_task_duration_seconds': round(total_task_duration_seconds, 4),
+        'scheduling_efficiency': round(ideal_makespan_seconds / makespan_seconds, 4) if makespan_seconds > 0 else None,
+    }))
+    if num_fastq_stats_tasks > 0 and makespan_seconds > 0:
+        fastq_stats_computed = [fastq_stat for fastq_stat in fastq_stats if fastq_stat.get('io_stats', None) is not None]
+        metrics.set_gauge('fastq_bytes_per_second', round(sum(fastq_stat['io_stats'].get('bytes_read', 0) for fastq_stat in fastq_stats_computed) / makespan_seconds))
+        metrics.set_gauge('fastq_reads_per_second', round(sum((fastq_stat.get('counts', None) or {}).get('num_reads', 0) for fastq_stat in fastq_stats_computed) / makespan_seconds))
+        metrics.set_gauge('fastq_stats_pool_utilization', round(ideal_makespan_seconds / makespan_seconds, 4))
+
+    if fastq_stats_cache_conn is not None:
+        fastq_stats_cache.evict(fastq_stats_cache_conn, fastq_stats_cache_max_entries)
+        fastq_stats_cache_conn.close()
+    fastq_stats = fastq_stats + fastq_stats_cached
+    timestamp_collect_fastq_stats_complete = datetime.datetime.now()
+    total_fastq_file_size_bytes = sum(fastq_stat.get('io_stats', {}).get('file_size_bytes', 0) for fastq_stat in fastq_stats)
+    total_fastq_bytes_read = sum(fastq_stat.get('io_stats', {}).get('bytes_read', 0) for fastq_stat in fastq_stats)
+    logging.info(json.dumps({
+        'event_type': 'collect_fastq_stats_complete',
+        'fastq_dir': os.path.abspath(fastq_dir),
+        'fastq_files_stats_collected': len(fastq_stats),
+        'fastq_file_size_bytes': total_fastq_file_size_bytes,
+        'fastq_bytes_read': total_fastq_bytes_read,
+        'collect_fastq_stats_duration_seconds': (timestamp_collect_fastq_stats_complete - timestamp_collect_fastq_stats_start).total_seconds()
+    }))
+
+    fastq_stats_by_library_id = {}
+    fastq_stats_by_library_id_and_read_type = {}
+    for fastq_stat in fastq_stats:
+        library_id = fastq_stat['library_id']
+        read_type = fastq_stat['read_type']
+        if library_id not in fastq_stats_by_library_id:
+            fastq_stats_by_library_id[library_id] = {}
+            fastq_stats_by_library_id_and_read_type[library_id] = {}
+        fastq_stats_by_library_id[library_id].update(fastq_stat.get('fastq_stats', {}).copy())
+        fastq_stats_by_library_id_and_read_type[library_id][read_type] = fastq_stat
+
+    for library_id, fastq_stats_by_read_type in fastq_stats_by_library_id_and_read_type.items():
+        fastq_stat_r1 = fastq_stats_by_read_type.get('R1', {})
+        fastq_stat_r2 = fastq_stats_by_read_type.get('R2', {})
+        counts_r1 = fastq_stat_r1.get('counts', None)
+        counts_r2 = fastq_stat_r2.get('counts', None)
+        estimated_fields = fastq_stat_r1.get('estimated_fields', []) + fastq_stat_r2.get('estimated_fields', [])
+        estimates_r1 = fastq_stat_r1.get('estimates', None)
+        if estimates_r1 is None and counts_r1 is not None:
+            estimates_r1 = _fastq_stats_estimates_from_counts(counts_r1)
+        estimates_r2 = fastq_stat_r2.get('estimates', None)
+        if estimates_r2 is None and counts_r2 is not None:
+            estimates_r2 = _fastq_stats_estimates_from_counts(counts_r2)
+        combined_stats = None
+        # The files' own stats are kept when they don't pair up, but there are no combined stats for the library.
+        pairing_error = fastq_stat_r1.get('pairing_error', None) or fastq_stat_r2.get('pairing_error', None)
+        if pairing_error is None and estimates_r1 is not None and estimates_r2 is not None:
+            if estimates_r1['num_reads'] != estimates_r2['num_reads']:
+                pairing_error = f"R1 and R2 have different numbers of reads: {estimates_r1['num_reads']}, {estimates_r2['num_reads']}"
+                # Only possible for files that weren't read together, e.g. one was cached, chunked or sampled.
+                logging.error(json.dumps({
+                    'event_type': 'paired_fastq_num_reads_mismatch',
+                    'library_id': library_id,
+                    'num_reads_r1': estimates_r1['num_reads'],
+                    'num_reads_r2': estimates_r2['num_reads'],
+                }))
+            elif counts_r1 is not None and counts_r2 is not None:
+                combined_stats = combine_paired_fastq_stats(counts_r1, counts_r2)
+            else:
+                combined_stats = combine_sampled_fastq_stats(estimates_r1, estimates_r2)
+                estimated_fields += ['num_bases', 'q30_percent', 'q30_percent_last_25_bases']
+        if combined_stats is None:
+            combined_stats = {
+                'num_reads': None,
+                'num_bases': None,
+                'q30_percent': None,
+                'q30_percent_last_25_bases': None,
+            }
+        fastq_stats_by_library_id[library_id].update(combined_stats)
+        fastq_stats_by_library_id[library_id]['pairing_error'] = pairing_error
+        fastq_stats_by_library_id[library_id]['per_cycle_quality_r1'] = fastq_stat_r1.get('per_cycle_quality', None)
+        fastq_stats_by_library_id[library_id]['per_cycle_quality_r2'] = fastq_stat_r2.get('per_cycle_quality', None)
+        fastq_stats_by_library_id[library_id]['quality_histograms_r1'] = _get_quality_histograms(fastq_stat_r1)
+        fastq_stats_by_library_id[library_id]['quality_histograms_r2'] = _get_quality_histograms(fastq_stat_r2)
+        if fastq_stats_mode == 'sampled':
+            fastq_stats_by_library_id[library_id]['fastq_stats_mode'] = fastq_stats_mode
+            fastq_stats_by_library_id[library_id]['estimated_fields'] = ';'.join(estimated_fields)
+
+    return fastq_stats_by_library_id
+
+
+def get_sequenced_libraries_from_samplesheet(samplesheet, instrument_model, demultiplexing_output_dir, project_id_translation, collect_fastq_stats=False, num_fastq_stats_processes=1, chunked_fastq_stats_min_file_size_mb=None, fastq_stats_cache_path=None, fastq_stats_cache_max_entries=fastq_stats_cache.DEFAULT_MAX_ENTRIES, sequencing_run_id=None, fastq_stats_pool=None, fastq_stats_mode='exact', fastq_stats_sample_num_reads=fastq_stats_engine.DEFAULT_SAMPLE_NUM_READS, fastq_checksum_algorithm=fastq_stats_engine.DEFAULT_HASH_ALGORITHM, fastq_reader_backend=fastq_stats_engine.DEFAULT_READER_BACKEND, fastq_stats_checkpoint_dir=None):
     """
     Get the sequenced libraries from a samplesheet.
-    TODO: Separate out the FASTQ statistics collection more cleanly.
 
     :param samplesheet: Samplesheet
     :type samplesheet: dict[str, object]
@@ -292,6 +1446,26 @@ def get_sequenced_libraries_from_samplesheet(samplesheet, instrument_model, demu
     :type collect_fastq_stats: bool
     :param num_fastq_stats_processes: Number of FASTQ statistics processes
     :type num_fastq_stats_processes: int
+    :param chunked_fastq_stats_min_file_size_mb: FASTQ files at least this large are split into chunks and spread across all processes. If None, each file is handled by a single process.
+    :type chunked_fastq_stats_min_file_size_mb: Optional[float]
+    :param fastq_stats_cache_path: Path to the FASTQ statistics cache. If None, statistics are always recomputed.
+    :type fastq_stats_cache_path: Optional[str]
+    :param fastq_stats_cache_max_entries: Maximum number of entries to keep in the FASTQ statistics cache
+    :type fastq_stats_cache_max_entries: int
+    :param sequencing_run_id: Sequencing run ID, recorded with cache entries so that they can be invalidated by run.
+    :type sequencing_run_id: Optional[str]
+    :param fastq_stats_pool: Long-lived worker pool to collect FASTQ statistics with. If None, a pool is created for this call.
+    :type fastq_stats_pool: Optional[multiprocessing.pool.Pool]
+    :param fastq_stats_mode: 'exact' to read every FASTQ record, or 'sampled' to estimate quality statistics from a sample of reads.
+    :type fastq_stats_mode: str
+    :param fastq_stats_sample_num_reads: Number of reads to sample from each FASTQ file, in 'sampled' mode
+    :type fastq_stats_sample_num_reads: int
+    :param fastq_checksum_algorithm: Hash algorithm to checksum FASTQ files with (see `fastq_stats.HASH_ALGORITHMS`), when they don't already have a checksum.
+    :type fastq_checksum_algorithm: str
+    :param fastq_reader_backend: How to read and decompress whole FASTQ files (see `fastq_stats.READER_BACKENDS`).
+    :type fastq_reader_backend: str
+    :param fastq_stats_checkpoint_dir: Run's checkpoint directory, to checkpoint each FASTQ file's statistics in. If None, they aren't checkpointed.
+    :type fastq_stats_checkpoint_dir: Optional[str]
     :return: Sequenced libraries. Each library is a dictionary with keys: ['library_id', 'project_id_samplesheet', 'project_id_translated',
                                                                            'index', 'index2', 'fastq_filename_r1', 'fastq_filaname_r2', ...]
     :rtype: list[dict[str, object]]
@@ -307,132 +1481,77 @@ def get_sequenced_libraries_from_samplesheet(samplesheet, instrument_model, demu
         library['project_id_translated'] = project_id_translation.get(library['project_id_samplesheet'], library['project_id_samplesheet']) 
         libraries_by_library_id[library_id] = library
 
-    if fastq_dir is not None and os.path.exists(fastq_dir):
-        for library_id in libraries_by_library_id.keys():
-            sample_number = None
-            fastq_path_r1 = None
-            fastq_filename_r1 = None
-            fastq_path_r2 = None
-            fastq_filename_r2 = None
-
-            fastq_paths_r1 = glob.glob(os.path.join(fastq_dir, f"{library_id}_*_R1_*.fastq.gz"))
-            if len(fastq_paths_r1) > 0:
-                fastq_path_r1 = fastq_paths_r1[0]
-                fastq_filename_r1 = os.path.basename(fastq_path_r1)
-                sample_number_match = re.search(r'_S(\d+)_', fastq_filename_r1)
-                if sample_number_match:
-                    try:
-                        sample_number = int(sample_number_match.group(1).replace('S', '').lstrip('0'))
-                    except ValueError as e:
-                        pass
-                libraries_by_library_id[library_id]['fastq_filename_r1'] = fastq_filename_r1
-
-            fastq_paths_r2 = glob.glob(os.path.join(fastq_dir, f"{library_id}_*_R2_*.fastq.gz"))
-            if len(fastq_paths_r2) > 0:
-                fastq_path_r2 = fastq_paths_r2[0]
-                fastq_filename_r2 = os.path.basename(fastq_path_r2)
-                libraries_by_library_id[library_id]['fastq_filename_r2'] = fastq_filename_r2
-    
-            libraries_by_library_id[library_id]['sample_number'] = sample_number
+    with tracing.span('find_fastq_files'):
+        if fastq_dir is not None and os.path.exists(fastq_dir):
+            for library_id in libraries_by_library_id.keys():
+                sample_number = None
+                fastq_path_r1 = None
+                fastq_filename_r1 = None
+                fastq_path_r2 = None
+                fastq_filename_r2 = None
 
-    # Collect fastq stats in parallel
-    # TODO: This part should be factored out into a separate function.
-    if collect_fastq_stats:
-        pool = multiprocessing.Pool(processes=num_fastq_stats_processes)
-        get_fastq_stats_inputs = []
-        for library_id, library in libraries_by_library_id.items():
-            if 'fastq_filename_r1' in library and library['fastq_filename_r1'] is not None:
-                fastq_path_r1 = os.path.join(fastq_dir, library['fastq_filename_r1'])
-                if os.path.exists(fastq_path_r1):
-                    get_fastq_stats_input = {
-                        'fastq_path': fastq_path_r1,
-                        'library_id': library_id,
-                        'read_type': "R1"
-                    }
-                    get_fastq_stats_inputs.append(get_fastq_stats_input)
-            if 'fastq_filename_r2' in library and library['fastq_filename_r2'] is not None:
-                fastq_path_r2 = os.path.join(fastq_dir, library['fastq_filename_r2'])
-                if os.path.exists(fastq_path_r2):
-                    get_fastq_stats_input = {
-                        'fastq_path': fastq_path_r2,
-                        'library_id': library_id,
-                        'read_type': "R2"
-                    }
-                    get_fastq_stats_inputs.append(get_fastq_stats_input)
-
-        timestamp_collect_fastq_stats_start = datetime.datetime.now()
-        logging.info(json.dumps({
-            'event_type': 'collect_fastq_stats_start',
-            'fastq_dir': os.path.abspath(fastq_dir),
-            'num_fastq_stats_inputs': len(get_fastq_stats_inputs)
-        }))
-        fastq_stats = pool.starmap(get_fastq_stats, [(input['fastq_path'], input['library_id'], input['read_type']) for input in get_fastq_stats_inputs])
-        pool.close()
-        pool.join()
-        timestamp_collect_fastq_stats_complete = datetime.datetime.now()
-        logging.info(json.dumps({
-            'event_type': 'collect_fastq_stats_complete',
-            'fastq_dir': os.path.abspath(fastq_dir),
-            'fastq_files_stats_collected': len(fastq_stats),
-            'collect_fastq_stats_duration_seconds': (timestamp_collect_fastq_stats_complete - timestamp_collect_fastq_stats_start).total_seconds()
-        }))
+                fastq_paths_r1 = glob.glob(os.path.join(fastq_dir, f"{library_id}_*_R1_*.fastq.gz"))
+                if len(fastq_paths_r1) > 0:
+                    fastq_path_r1 = fastq_paths_r1[0]
+                    fastq_filename_r1 = os.path.basename(fastq_path_r1)
+                    sample_number_match = re.search(r'_S(\d+)_', fastq_filename_r1)
+                    if sample_number_match:
+                        try:
+                            sample_number = int(sample_number_match.group(1).replace('S', '').lstrip('0'))
+                        except ValueError as e:
+                            pass
+                    libraries_by_library_id[library_id]['fastq_filename_r1'] = fastq_filename_r1
 
-        fastq_stats_by_library_id = {}
-        for fastq_stat in fastq_stats:
-            library_id = fastq_stat['library_id']
-            read_type = fastq_stat['read_type']
-            if library_id not in fastq_stats_by_library_id:
-                fastq_stats_by_library_id[library_id] = {}
-            fastq_stats_by_library_id[library_id].update(fastq_stat.get('fastq_stats', {}).copy())
-
-        for library_id, fastq_stats in fastq_stats_by_library_id.items():
-            required_keys = [
-                'num_reads_r1',
-                'num_reads_r2',
-                'num_bases_r1',
-                'num_bases_r2',
-                'q30_percent_r1',
-                'q30_percent_r2',
-                'q30_percent_last_25_bases_r1',
-                'q30_percent_last_25_bases_r2',
-            ]
-            all_keys_present = all(key in fastq_stats for key in required_keys)
-            
-            if all_keys_present:
-                all_keys_have_values = all(fastq_stats[key] is not None for key in required_keys)
-                if all_keys_have_values:
-                    num_bases_total = fastq_stats['num_bases_r1'] + fastq_stats['num_bases_r2']
-                    num_reads_total = fastq_stats['num_reads_r1'] + fastq_stats['num_reads_r2']
-                    q30_percent_r1 = fastq_stats['q30_percent_r1']
-                    q30_percent_r2 = fastq_stats['q30_percent_r2']
-                    num_q30_bases_r1 = round(fastq_stats['num_bases_r1'] * q30_percent_r1 / 100)
-                    num_q30_bases_r2 = round(fastq_stats['num_bases_r2'] * q30_percent_r2 / 100)
-                    num_q30_bases_total = num_q30_bases_r1 + num_q30_bases_r2
-                    q30_percent_total = round(num_q30_bases_total / num_bases_total * 100, 4)
-                    q30_percent_last_25_bases_r1 = fastq_stats['q30_percent_last_25_bases_r1']
-                    q30_percent_last_25_bases_r2 = fastq_stats['q30_percent_last_25_bases_r2']
-                    num_bases_last_25_r1 = fastq_stats['num_reads_r1'] * 25
-                    num_bases_last_25_r2 = fastq_stats['num_reads_r2'] * 25
-                    num_bases_last_25_total = num_bases_last_25_r1 + num_bases_last_25_r2
-                    num_q30_bases_last_25_r1 = round(num_bases_last_25_r1 * q30_percent_last_25_bases_r1 / 100)
-                    num_q30_bases_last_25_r2 = round(num_bases_last_25_r2 * q30_percent_last_25_bases_r2 / 100)
-                    num_q30_bases_last_25_total = num_q30_bases_last_25_r1 + num_q30_bases_last_25_r2
-                    q30_percent_last_25_bases_total = round(num_q30_bases_last_25_total / num_bases_last_25_total * 100, 4)
-                else:
-                    num_reads_total = None
-                    num_bases_total = None
-                    q30_percent_total = None
-                    q30_percent_last_25_bases_total = None
-            else:
-                num_reads_total = None
-                num_bases_total = None
-                q30_percent_total = None
-                q30_percent_last_25_bases_total = None
-            fastq_stats_by_library_id[library_id]['num_reads'] = num_reads_total
-            fastq_stats_by_library_id[library_id]['num_bases'] = num_bases_total
-            fastq_stats_by_library_id[library_id]['q30_percent'] = q30_percent_total
-            fastq_stats_by_library_id[library_id]['q30_percent_last_25_bases'] = q30_percent_last_25_bases_total
+                fastq_paths_r2 = glob.glob(os.path.join(fastq_dir, f"{library_id}_*_R2_*.fastq.gz"))
+                if len(fastq_paths_r2) > 0:
+                    fastq_path_r2 = fastq_paths_r2[0]
+                    fastq_filename_r2 = os.path.basename(fastq_path_r2)
+                    libraries_by_library_id[library_id]['fastq_filename_r2'] = fastq_filename_r2
+    
+                libraries_by_library_id[library_id]['sample_number'] = sample_number
 
+    if collect_fastq_stats:
+        if fastq_stats_mode not in FASTQ_STATS_MODES:
+            logging.error(json.dumps({
+                'event_type': 'invalid_fastq_stats_mode',
+                'fastq_stats_mode': fastq_stats_mode,
+                'valid_fastq_stats_modes': FASTQ_STATS_MODES,
+            }))
+            fastq_stats_mode = 'exact'
+        if fastq_checksum_algorithm not in fastq_stats_engine.HASH_ALGORITHMS:
+            logging.error(json.dumps({
+                'event_type': 'invalid_fastq_checksum_algorithm',
+                'fastq_checksum_algorithm': fastq_checksum_algorithm,
+                'valid_fastq_checksum_algorithms': fastq_stats_engine.HASH_ALGORITHMS,
+            }))
+            fastq_checksum_algorithm = fastq_stats_engine.DEFAULT_HASH_ALGORITHM
+        if fastq_reader_backend not in fastq_stats_engine.available_reader_backends():
+            logging.error(json.dumps({
+                'event_type': 'invalid_fastq_reader_backend',
+                'fastq_reader_backend': fastq_reader_backend,
+                'available_fastq_reader_backends': fastq_stats_engine.available_reader_backends(),
+            }))
+            fastq_reader_backend = fastq_stats_engine.DEFAULT_READER_BACKEND
+        instrument_read_counts = None
+        if fastq_stats_mode == 'sampled':
+            instrument_read_counts = get_instrument_fastq_read_counts(demultiplexing_output_dir, instrument_model)
+        with tracing.span('collect_fastq_stats', fastq_stats_mode=fastq_stats_mode):
+            fastq_stats_by_library_id = collect_fastq_stats_for_libraries(
+                libraries_by_library_id,
+                fastq_dir,
+                num_fastq_stats_processes,
+                chunked_fastq_stats_min_file_size_mb,
+                fastq_stats_cache_path,
+                fastq_stats_cache_max_entries,
+                sequencing_run_id,
+                fastq_stats_pool,
+                fastq_stats_mode,
+                fastq_stats_sample_num_reads,
+                instrument_read_counts,
+                fastq_checksum_algorithm,
+                fastq_reader_backend,
+                fastq_stats_checkpoint_dir,
+            )
         for library_id, library in libraries_by_library_id.items():
             if library_id in fastq_stats_by_library_id:
                 library.update(fastq_stats_by_library_id[library_id])
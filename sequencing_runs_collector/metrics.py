@@ -0,0 +1,179 @@
+import http.server
+import json
+import logging
+import threading
+
+from typing import Optional
+
+DEFAULT_METRICS_HOST = '127.0.0.1'
+METRIC_NAME_PREFIX = 'sequencing_runs_collector_'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Metric type and help text, indexed by metric name (without the prefix).
+METRICS = {
+    'scan_duration_seconds': ('gauge', 'Duration of the most recent scan for runs.'),
+    'last_successful_scan_timestamp_seconds': ('gauge', 'Unix time that the most recent scan for runs finished.'),
+    'runs_discovered_total': ('counter', 'Runs found in the run parent directories.'),
+    'runs_queued': ('gauge', 'Runs waiting to be collected, as of the most recent scan.'),
+    'oldest_queued_run_age_seconds': ('gauge', 'Time that the longest-waiting run had been waiting to be collected, as of the most recent scan.'),
+    'runs_in_progress': ('gauge', 'Runs being collected.'),
+    'runs_collected_total': ('counter', 'Runs collected.'),
+    'runs_failed_total': ('counter', 'Runs that failed to be collected.'),
+    'demultiplexings_collected_total': ('counter', 'Illumina demultiplexings collected.'),
+    'fastq_files_processed_total': ('counter', 'FASTQ files read to collect statistics.'),
+    'fastq_bytes_read_total': ('counter', 'Bytes read from FASTQ files to collect statistics.'),
+    'fastq_reads_processed_total': ('counter', 'Reads in FASTQ files whose statistics were collected exactly.'),
+    'fastq_bytes_per_second': ('gauge', 'FASTQ bytes read per second, in the most recent collection of FASTQ statistics.'),
+    'fastq_reads_per_second': ('gauge', 'FASTQ reads processed per second, in the most recent collection of FASTQ statistics.'),
+    'fastq_stats_pool_processes': ('gauge', 'Worker processes in the FASTQ statistics pool.'),
+    'fastq_stats_tasks_in_flight': ('gauge', 'FASTQ statistics tasks running or waiting in the pool.'),
+    'fastq_stats_pool_utilization': ('gauge', 'Fraction of the pool\'s worker time that was used, in the most recent collection of FASTQ statistics.'),
+}
+
+# Updated from the main thread, the run collection threads and the pool's result handler thread.
+_metric_values = {}
+_metric_values_lock = threading.Lock()
+
+
+def increment(metric_name: str, value: float = 1):
+    """
+    Add to a counter, or to a gauge (use a negative value to subtract).
+
+    :param metric_name: Metric name, from `METRICS`
+    :type metric_name: str
+    :param value: Amount to add
+    :type value: float
+    :return: None
+    :rtype: NoneType
+    """
+    with _metric_values_lock:
+        _metric_values[metric_name] = _metric_values.get(metric_name, 0) + value
+
+
+def set_gauge(metric_name: str, value: Optional[float]):
+    """
+    Set a gauge. A gauge set to None isn't reported.
+
+    :param metric_name: Metric name, from `METRICS`
+    :type metric_name: str
+    :param value: Value
+    :type value: Optional[float]
+    :return: None
+    :rtype: NoneType
+    """
+    with _metric_values_lock:
+        _metric_values[metric_name] = value
+
+
+def render_metrics() -> str:
+    """
+    Render the current value of every metric, in the Prometheus text exposition format.
+    Counters that haven't been incremented yet are reported as 0.
+
+    :return: Metrics
+    :rtype: str
+    """
+    with _metric_values_lock:
+        metric_values = dict(_metric_values)
+
+    lines = []
+    for metric_name, (metric_type, metric_help) in METRICS.items():
+        value = metric_values.get(metric_name, 0 if metric_type == 'counter' else None)
+        if value is None:
+            continue
+        prefixed_metric_name = METRIC_NAME_PREFIX + metric_name
+        lines.append(f"# HELP {prefixed_metric_name} {metric_help}")
+        lines.append(f"# TYPE {prefixed_metric_name} {metric_type}")
+        # Full precision, so that large counters and timestamps aren't rounded.
+        lines.append(f"{prefixed_metric_name} {value if isinstance(value, int) else repr(float(value))}")
+
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the metrics at `/metrics`.
+    """
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Requests would otherwise be written to stderr, outside of the JSON logs.
+        logging.debug(json.dumps({'event_type': 'metrics_request', 'request': format % args}))
+
+
+def update_metrics_server(metrics_server: Optional[dict[str, object]], config: dict[str, object]) -> Optional[dict[str, object]]:
+    """
+    Make sure the metrics server matches the config. The server is only started if `metrics_port` is set,
+    and is only replaced when `metrics_port` or `metrics_host` change. It serves `/metrics` from its own thread.
+
+    :param metrics_server: Current server, as returned by a previous call. Keys: [server, thread, host, port]
+    :type metrics_server: Optional[dict[str, object]]
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Server matching the config, or None if there is no `metrics_port`. If the server couldn't be started (e.g. the port is in use),
+             its `server` is None, and it isn't tried again until the config changes.
+    :rtype: Optional[dict[str, object]]
+    """
+    port = config.get('metrics_port', None)
+    host = config.get('metrics_host', DEFAULT_METRICS_HOST)
+    if metrics_server is not None:
+        if metrics_server['port'] == port and metrics_server['host'] == host:
+            return metrics_server
+        close_metrics_server(metrics_server)
+    if port is None:
+        return None
+
+    try:
+        server = http.server.ThreadingHTTPServer((host, int(port)), _MetricsRequestHandler)
+    except (OSError, ValueError) as e:
+        logging.error(json.dumps({
+            'event_type': 'metrics_server_start_failed',
+            'metrics_host': host,
+            'metrics_port': port,
+            'error': str(e),
+        }))
+        return {'server': None, 'thread': None, 'host': host, 'port': port}
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics_server', daemon=True)
+    thread.start()
+    metrics_server = {
+        'server': server,
+        'thread': thread,
+        'host': host,
+        'port': port,
+    }
+    logging.info(json.dumps({
+        'event_type': 'metrics_server_started',
+        'metrics_host': host,
+        'metrics_port': int(port),
+    }))
+
+    return metrics_server
+
+
+def close_metrics_server(metrics_server: Optional[dict[str, object]]):
+    """
+    Stop the metrics server.
+
+    :param metrics_server: Server, as returned by `update_metrics_server`
+    :type metrics_server: Optional[dict[str, object]]
+    :return: None
+    :rtype: NoneType
+    """
+    if metrics_server is None or metrics_server['server'] is None:
+        return
+    metrics_server['server'].shutdown()
+    metrics_server['server'].server_close()
+    logging.info(json.dumps({
+        'event_type': 'metrics_server_closed',
+        'metrics_host': metrics_server['host'],
+        'metrics_port': metrics_server['port'],
+    }))
@@ -1,41 +1,38 @@
-import pyfastx
+import sequencing_runs_collector.fastq_stats as fastq_stats_engine
 
 def collect_fastq_stats(fastq_path):
     """
     Collect a set of statistics from a fastq file.
 
+    The read length, GC content and N content distributions are histograms with a fixed number of bins
+    (see `fastq_stats.count_read_length_histogram` and `fastq_stats.count_base_composition`),
+    so memory use doesn't depend on the number of reads. The read length N50 is calculated from the histogram.
+
     :param fastq_path:
     :type fastq_path: str
     :return:
     :rtype: dict[str, object]
     """
-    total_reads = 0
-    total_bases = 0
-    num_bases_greater_or_equal_to_q30 = 0
-    min_read_length = None
-    max_read_length = 0
-
-    fq = pyfastx.Fastx(fastq_path)
-    for name, seq, qual, comment in fq:
-        read_length = len(seq)
-        if min_read_length is None or read_length < min_read_length:
-            min_read_length = read_length
-        if read_length > max_read_length:
-            max_read_length = read_length
-        total_reads += 1
-        total_bases += read_length
-        for q in qual:
-            phred = ord(q) - 33
-            if phred >= 30:
-                num_bases_greater_or_equal_to_q30 += 1
+    collected_stats = fastq_stats_engine.collect_fastq_stats(
+        fastq_path,
+        metrics=['num_reads', 'num_bases', 'read_length', 'q30', 'read_length_distribution', 'base_composition'],
+    )
 
+    total_bases = collected_stats['num_bases']
+    num_called_bases = total_bases - collected_stats['num_n_bases']
     stats = {
-        'total_reads': total_reads,
+        'total_reads': collected_stats['num_reads'],
         'total_bases': total_bases,
-        'num_bases_greater_or_equal_to_q30': num_bases_greater_or_equal_to_q30,
-        'mean_read_length': total_bases / total_reads,
-        'max_read_length': max_read_length,
-        'min_read_length': min_read_length,
+        'num_bases_greater_or_equal_to_q30': collected_stats['num_bases_over_q30'],
+        'mean_read_length': collected_stats['mean_read_length'],
+        'max_read_length': collected_stats['max_read_length'],
+        'min_read_length': collected_stats['min_read_length'],
+        'read_length_n50': collected_stats['read_length_n50'],
+        'read_length_histogram': collected_stats['read_length_histogram'],
+        'gc_percent': round(collected_stats['num_gc_bases'] / num_called_bases * 100, 4) if num_called_bases > 0 else None,
+        'n_percent': round(collected_stats['num_n_bases'] / total_bases * 100, 4) if total_bases > 0 else None,
+        'gc_content_histogram': collected_stats['gc_content_histogram'],
+        'n_content_histogram': collected_stats['n_content_histogram'],
     }
 
     return stats
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import glob
+import json
+import logging
+import os
+import sys
+
+from pathlib import Path
+from typing import Optional
+
+import sequencing_runs_collector.config
+
+DEFAULT_QUALITY_THRESHOLDS = [30]
+# The number of bases at the end of each read that the 'last_25_bases' histograms cover.
+NUM_LAST_BASES = 25
+
+
+def find_quality_histograms_files(run_output_dir: Path) -> list[str]:
+    """
+    Find the quality histograms files written for each demultiplexing of a collected run.
+
+    :param run_output_dir: Output directory for the run, as written by `core.write_collected_illumina_run`
+    :type run_output_dir: Path
+    :return: Paths to quality histograms files, sorted.
+    :rtype: list[str]
+    """
+    quality_histograms_glob = os.path.join(run_output_dir, 'demultiplexings', '*', '*_quality_histograms.csv')
+    quality_histograms_paths = sorted(glob.glob(quality_histograms_glob))
+
+    return quality_histograms_paths
+
+
+def load_quality_histograms(quality_histograms_path: Path) -> dict[str, dict[str, dict[str, object]]]:
+    """
+    Load quality histograms, as written by `core.write_quality_histograms`.
+
+    :param quality_histograms_path: Path to a quality histograms file
+    :type quality_histograms_path: Path
+    :return: Histograms indexed by library ID, then read type ("R1" or "R2"), then bases ("all_bases" or "last_25_bases").
+             Each histogram is the number of bases at each phred quality score. The number of reads in each FASTQ file
+             is under 'num_reads', or None for files written before it was recorded.
+    :rtype: dict[str, dict[str, dict[str, object]]]
+    """
+    quality_histograms_by_library_id = {}
+    with open(quality_histograms_path, 'r') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            quality = int(row['quality'])
+            histograms_by_read_type = quality_histograms_by_library_id.setdefault(row['library_id'], {})
+            histograms_by_bases = histograms_by_read_type.setdefault(row['read_type'], {'all_bases': [], 'last_25_bases': [], 'num_reads': None})
+            if row.get('num_reads', None):
+                histograms_by_bases['num_reads'] = int(row['num_reads'])
+            histogram = histograms_by_bases[row['bases']]
+            if len(histogram) <= quality:
+                histogram.extend([0] * (quality + 1 - len(histogram)))
+            histogram[quality] += int(row['num_bases'])
+
+    return quality_histograms_by_library_id
+
+
+def percent_at_or_above(histogram: list[int], quality_threshold: int, num_bases: Optional[int] = None) -> Optional[float]:
+    """
+    Calculate the percent of bases at or above a quality threshold.
+
+    :param histogram: Number of bases at each phred quality score
+    :type histogram: list[int]
+    :param quality_threshold: Minimum phred quality score
+    :type quality_threshold: int
+    :param num_bases: Number of bases to calculate the percent of. Defaults to the number of bases in the histogram.
+    :type num_bases: Optional[int]
+    :return: Percent of bases at or above `quality_threshold`, or None if there are no bases.
+    :rtype: Optional[float]
+    """
+    if num_bases is None:
+        num_bases = sum(histogram)
+    if num_bases == 0:
+        return None
+    num_bases_at_or_above = sum(histogram[quality_threshold:])
+
+    return round(num_bases_at_or_above / num_bases * 100, 4)
+
+
+def _add_histograms(histogram: list[int], other_histogram: list[int]) -> list[int]:
+    """
+    Add two histograms, padding the shorter one with zeroes.
+    """
+    length = max(len(histogram), len(other_histogram))
+    padded = histogram + [0] * (length - len(histogram))
+    other_padded = other_histogram + [0] * (length - len(other_histogram))
+
+    return [a + b for a, b in zip(padded, other_padded)]
+
+
+def _get_num_last_bases(*histograms_by_bases: dict[str, object]) -> Optional[int]:
+    """
+    The number of bases that the collector calculated the last-25-bases percentages over: 25 for every read, even reads shorter than 25 bases.
+    None if a read count is missing, in which case the bases in the histograms are used.
+    """
+    if any(histograms['num_reads'] is None for histograms in histograms_by_bases):
+        return None
+
+    return NUM_LAST_BASES * sum(histograms['num_reads'] for histograms in histograms_by_bases)
+
+
+def recompute_quality_metrics(quality_histograms_by_library_id: dict[str, dict[str, dict[str, object]]], quality_thresholds: list[int]) -> list[dict[str, object]]:
+    """
+    Calculate threshold-based quality metrics for each library from its quality histograms.
+
+    For each threshold T, the fields are named like the Q30 fields of the sequenced libraries output:
+    ['qT_percent_r1', 'qT_percent_last_25_bases_r1', 'qT_percent_r2', 'qT_percent_last_25_bases_r2', 'qT_percent', 'qT_percent_last_25_bases'].
+    As when they were collected, the last-25-bases percentages are taken over 25 bases for every read, so for `-t 30`
+    they match the collected values even when some reads are shorter than 25 bases. Histograms written before read counts
+    were recorded don't have them, so for those, the percentages are taken over the bases in the histograms.
+
+    :param quality_histograms_by_library_id: Quality histograms, as returned by `load_quality_histograms`
+    :type quality_histograms_by_library_id: dict[str, dict[str, dict[str, object]]]
+    :param quality_thresholds: Phred quality thresholds
+    :type quality_thresholds: list[int]
+    :return: Quality metrics, one dict per library, with key 'library_id'.
+    :rtype: list[dict[str, object]]
+    """
+    quality_metrics = []
+    for library_id, histograms_by_read_type in quality_histograms_by_library_id.items():
+        library_quality_metrics = {'library_id': library_id}
+        combined_histograms = None
+        if 'R1' in histograms_by_read_type and 'R2' in histograms_by_read_type:
+            combined_histograms = {
+                bases: _add_histograms(histograms_by_read_type['R1'][bases], histograms_by_read_type['R2'][bases])
+                for bases in ['all_bases', 'last_25_bases']
+            }
+            combined_histograms['num_last_bases'] = _get_num_last_bases(histograms_by_read_type['R1'], histograms_by_read_type['R2'])
+        for quality_threshold in quality_thresholds:
+            prefix = f"q{quality_threshold}_percent"
+            for read_type in ['R1', 'R2']:
+                histograms = histograms_by_read_type.get(read_type, None)
+                library_quality_metrics[f"{prefix}_{read_type.lower()}"] = percent_at_or_above(histograms['all_bases'], quality_threshold) if histograms else None
+                library_quality_metrics[f"{prefix}_last_25_bases_{read_type.lower()}"] = percent_at_or_above(histograms['last_25_bases'], quality_threshold, _get_num_last_bases(histograms)) if histograms else None
+            library_quality_metrics[prefix] = percent_at_or_above(combined_histograms['all_bases'], quality_threshold) if combined_histograms else None
+            library_quality_metrics[f"{prefix}_last_25_bases"] = percent_at_or_above(combined_histograms['last_25_bases'], quality_threshold, combined_histograms['num_last_bases']) if combined_histograms else None
+        quality_metrics.append(library_quality_metrics)
+
+    return quality_metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute threshold-based quality metrics for collected runs from their stored quality histograms, without reading any FASTQ files')
+    parser.add_argument('-c', '--config', help='Config file. Runs given with --run-id are looked up under `output_directory`.')
+    parser.add_argument('--run-id', action='append', default=[], help='Sequencing run ID. May be repeated.')
+    parser.add_argument('--run-output-dir', action='append', default=[], help='Output directory for a collected run. May be repeated.')
+    parser.add_argument('-t', '--threshold', type=int, action='append', help='Phred quality threshold. May be repeated. (default: 30)')
+    parser.add_argument('-o', '--output', help='Output file. (default: stdout)')
+    parser.add_argument('--log-level')
+    args = parser.parse_args()
+
+    try:
+        log_level = getattr(logging, args.log_level.upper())
+    except AttributeError as e:
+        log_level = logging.INFO
+
+    logging.basicConfig(
+        format='{"timestamp": "%(asctime)s.%(msecs)03d", "level": "%(levelname)s", "module": "%(module)s", "function_name": "%(funcName)s", "line_num": %(lineno)d, "message": %(message)s}',
+        datefmt='%Y-%m-%dT%H:%M:%S',
+        encoding='utf-8',
+        level=log_level,
+    )
+
+    quality_thresholds = args.threshold if args.threshold else DEFAULT_QUALITY_THRESHOLDS
+
+    run_output_dirs = list(args.run_output_dir)
+    if args.run_id:
+        if not args.config:
+            logging.error(json.dumps({"event_type": "config_required_for_run_id"}))
+            exit(-1)
+        config = sequencing_runs_collector.config.load_config(args.config)
+        for run_id in args.run_id:
+            run_output_dirs.append(os.path.join(str(config['output_directory']), 'illumina', run_id))
+    if not run_output_dirs:
+        logging.error(json.dumps({"event_type": "no_runs_provided"}))
+        exit(-1)
+
+    output_fieldnames = ['sequencing_run_id', 'demultiplexing_id', 'library_id']
+    for quality_threshold in quality_thresholds:
+        prefix = f"q{quality_threshold}_percent"
+        output_fieldnames += [
+            f"{prefix}_r1",
+            f"{prefix}_last_25_bases_r1",
+            f"{prefix}_r2",
+            f"{prefix}_last_25_bases_r2",
+            prefix,
+            f"{prefix}_last_25_bases",
+        ]
+
+    output_file = open(args.output, 'w') if args.output else sys.stdout
+    writer = csv.DictWriter(output_file, fieldnames=output_fieldnames, quoting=csv.QUOTE_MINIMAL)
+    writer.writeheader()
+    for run_output_dir in run_output_dirs:
+        sequencing_run_id = os.path.basename(os.path.abspath(run_output_dir))
+        quality_histograms_paths = find_quality_histograms_files(run_output_dir)
+        if not quality_histograms_paths:
+            logging.warning(json.dumps({"event_type": "quality_histograms_not_found", "run_output_dir": os.path.abspath(run_output_dir)}))
+            continue
+        for quality_histograms_path in quality_histograms_paths:
+            demultiplexing_id = os.path.basename(os.path.dirname(quality_histograms_path))
+            quality_histograms_by_library_id = load_quality_histograms(quality_histograms_path)
+            for library_quality_metrics in recompute_quality_metrics(quality_histograms_by_library_id, quality_thresholds):
+                library_quality_metrics['sequencing_run_id'] = sequencing_run_id
+                library_quality_metrics['demultiplexing_id'] = demultiplexing_id
+                writer.writerow(library_quality_metrics)
+            logging.info(json.dumps({
+                "event_type": "quality_metrics_recomputed",
+                "sequencing_run_id": sequencing_run_id,
+                "demultiplexing_id": demultiplexing_id,
+                "num_libraries": len(quality_histograms_by_library_id),
+            }))
+    if args.output:
+        output_file.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from typing import Iterable, Optional
+
+import sequencing_runs_collector.illumina as illumina
+import sequencing_runs_collector.run_state as run_state
+from sequencing_runs_collector.run_watcher import UPLOAD_COMPLETE_FILENAME
+
+DEFAULT_RUN_PARENT_DIR_SCAN_TIMEOUT_SECONDS = 30
+# A run parent directory that times out is skipped for this long, doubling on each consecutive timeout, up to the maximum.
+RUN_PARENT_DIR_RETRY_BACKOFF_SECONDS = 60
+MAX_RUN_PARENT_DIR_RETRY_BACKOFF_SECONDS = 3600
+# A new demultiplexing of a collected run is only collected once its FASTQ directory has been left alone for this long.
+DEMULTIPLEXING_SETTLE_SECONDS = 600
+# Collected runs are only checked for new demultiplexings in the first part of a scan's deadline, so that finding new runs
+# isn't held up by them. Runs that aren't checked in time are checked on a later scan.
+DEMULTIPLEXING_CHECK_DEADLINE_FRACTION = 0.5
+
+
+def new_scanner() -> dict[str, object]:
+    """
+    Create the state that is kept between scans of the run parent directories, for use with `scan_run_parent_dirs`.
+
+    :return: Scanner. Keys: [scans_in_progress, degraded_run_parent_dirs, scan_duration_seconds_by_run_parent_dir]
+    :rtype: dict[str, object]
+    """
+    scanner = {
+        # Scans that didn't finish before their deadline. A thread that is stuck in a filesystem call
+        # can't be stopped, so no new scan of that directory is started until it finishes.
+        'scans_in_progress': {},
+        'degraded_run_parent_dirs': {},
+        'scan_duration_seconds_by_run_parent_dir': {},
+    }
+
+    return scanner
+
+
+def _check_for_demultiplexings(run: dict[str, object], timestamp_check_ns: int) -> Optional[dict[str, object]]:
+    """
+    Check a collected run for demultiplexings, unless its demultiplexing parent directories are unchanged since it was last checked.
+    Returns None if the run wasn't checked, otherwise: [demultiplexings, demultiplexing_parent_dirs_mtime_ns]. Only settled demultiplexings
+    are included. `demultiplexing_parent_dirs_mtime_ns` is None if the run should be checked again on the next scan, because one of its
+    demultiplexings hasn't settled yet, or because its directories were modified too recently to tell whether they have changed since.
+    """
+    mtime_ns = illumina.get_demultiplexing_parent_dirs_mtime_ns(run['run_dir'], run['instrument_model'])
+    if mtime_ns is None or mtime_ns == run['demultiplexing_parent_dirs_mtime_ns']:
+        return None
+    demultiplexings = illumina.find_demultiplexings(run['run_id'], run['run_dir'], run['instrument_model'], DEMULTIPLEXING_SETTLE_SECONDS)
+    all_settled = all(demultiplexing['settled'] for demultiplexing in demultiplexings)
+    demultiplexing_check = {
+        'demultiplexings': [demultiplexing for demultiplexing in demultiplexings if demultiplexing['settled']],
+        'demultiplexing_parent_dirs_mtime_ns': mtime_ns if all_settled and timestamp_check_ns - mtime_ns >= run_state.PARENT_DIR_MTIME_RESOLUTION_NS else None,
+    }
+
+    return demultiplexing_check
+
+
+def _scan_run_parent_dir(run_parent_dir: str, scan_inputs: dict[str, object], demultiplexing_check_deadline: float, result: dict[str, object]):
+    """
+    Do all of the filesystem access needed to scan one run parent directory. Runs in its own thread.
+
+    The directory is only listed if it has changed since its `last_scan`. Sub-directories that aren't in `known_run_ids`,
+    and each of the `pending_run_dirs`, are checked for `upload_complete.json`. The `collected_runs` are then checked for demultiplexings
+    (see `_check_for_demultiplexings`), until `demultiplexing_check_deadline` (`time.monotonic()`) passes.
+    `result` is filled in with: [mtime_ns, timestamp_scan_start_ns, entries, upload_complete_run_dirs, demultiplexing_checks_by_run_id,
+    num_demultiplexing_checks_deferred, error, scan_duration_seconds]. `entries` is None if the directory is unchanged.
+    """
+    timestamp_start = time.monotonic()
+    known_run_ids = scan_inputs['known_run_ids']
+    result['entries'] = None
+    result['upload_complete_run_dirs'] = []
+    result['demultiplexing_checks_by_run_id'] = {}
+    result['num_demultiplexing_checks_deferred'] = 0
+    result['error'] = None
+    try:
+        result['timestamp_scan_start_ns'] = time.time_ns()
+        result['mtime_ns'] = os.stat(run_parent_dir).st_mtime_ns
+        if not run_state.parent_dir_unchanged(scan_inputs['last_scan'], result['mtime_ns']):
+            entries = []
+            with os.scandir(run_parent_dir) as subdirs:
+                for subdir in subdirs:
+                    is_dir = subdir.is_dir()
+                    is_new_dir = is_dir and subdir.name not in known_run_ids
+                    entries.append({
+                        'name': subdir.name,
+                        'path': subdir.path,
+                        'is_dir': is_dir,
+                        'upload_complete': is_new_dir and os.path.exists(os.path.join(subdir.path, UPLOAD_COMPLETE_FILENAME)),
+                    })
+            result['entries'] = entries
+        result['upload_complete_run_dirs'] = [
+            run_dir for run_dir in scan_inputs['pending_run_dirs']
+            if os.path.exists(os.path.join(run_dir, UPLOAD_COMPLETE_FILENAME))
+        ]
+        for run_num, run in enumerate(scan_inputs['collected_runs']):
+            if time.monotonic() >= demultiplexing_check_deadline:
+                result['num_demultiplexing_checks_deferred'] = len(scan_inputs['collected_runs']) - run_num
+                break
+            try:
+                demultiplexing_check = _check_for_demultiplexings(run, time.time_ns())
+            except OSError as e:
+                # e.g. the run directory is being removed
+                continue
+            if demultiplexing_check is not None:
+                result['demultiplexing_checks_by_run_id'][run['run_id']] = demultiplexing_check
+    except OSError as e:
+        result['error'] = str(e)
+    result['scan_duration_seconds'] = round(time.monotonic() - timestamp_start, 3)
+
+
+def _mark_degraded(scanner: dict[str, object], run_parent_dir: str, reason: str):
+    """
+    Record that a run parent directory couldn't be scanned in time, and back off before scanning it again.
+    """
+    degraded = scanner['degraded_run_parent_dirs'].setdefault(run_parent_dir, {'consecutive_timeouts': 0})
+    degraded['consecutive_timeouts'] += 1
+    retry_backoff_seconds = min(
+        RUN_PARENT_DIR_RETRY_BACKOFF_SECONDS * 2 ** (degraded['consecutive_timeouts'] - 1),
+        MAX_RUN_PARENT_DIR_RETRY_BACKOFF_SECONDS,
+    )
+    degraded['retry_at'] = time.monotonic() + retry_backoff_seconds
+    logging.warning(json.dumps({
+        "event_type": "run_parent_dir_degraded",
+        "run_parent_dir": run_parent_dir,
+        "reason": reason,
+        "consecutive_timeouts": degraded['consecutive_timeouts'],
+        "retry_backoff_seconds": retry_backoff_seconds,
+    }))
+
+
+def scan_run_parent_dirs(scanner: dict[str, object], run_parent_dirs: Iterable[str], scan_inputs_by_run_parent_dir: dict[str, dict[str, object]], timeout_seconds: float) -> dict[str, dict[str, object]]:
+    """
+    Scan the run parent directories at the same time, each in its own thread, so that one slow or hung
+    filesystem (e.g. an NFS export that stops responding) doesn't hold up the others.
+
+    A directory whose scan isn't finished within `timeout_seconds` is marked as degraded, and skipped until
+    its backoff has passed (see `RUN_PARENT_DIR_RETRY_BACKOFF_SECONDS`). Its scan is left running in the background.
+    If it is still running when the directory is due to be retried, the directory stays degraded.
+
+    :param scanner: Scanner, as returned by `new_scanner`. Updated in place.
+    :type scanner: dict[str, object]
+    :param run_parent_dirs: Absolute paths to run parent directories
+    :type run_parent_dirs: Iterable[str]
+    :param scan_inputs_by_run_parent_dir: What is already known about each run parent directory, from the run state store. Keys:
+        last_scan: Last scan of the directory, as returned by `run_state.get_parent_dir_scan`
+        known_run_ids: IDs of the runs already in the run state store
+        pending_run_dirs: Directories of runs whose uploads weren't complete
+        collected_runs: Illumina runs to check for new demultiplexings, most recently collected first.
+                        Keys: [run_id, run_dir, instrument_model, demultiplexing_parent_dirs_mtime_ns]
+    :type scan_inputs_by_run_parent_dir: dict[str, dict[str, object]]
+    :param timeout_seconds: Time allowed for all of the directories to be scanned
+    :type timeout_seconds: float
+    :return: Scan results (see `_scan_run_parent_dir`) for the directories that were scanned in time, indexed by run parent directory.
+    :rtype: dict[str, dict[str, object]]
+    """
+    run_parent_dirs = list(run_parent_dirs)
+    for state_key in ['degraded_run_parent_dirs', 'scan_duration_seconds_by_run_parent_dir']:
+        for run_parent_dir in list(scanner[state_key]):
+            if run_parent_dir not in run_parent_dirs:
+                del scanner[state_key][run_parent_dir]
+
+    timestamp_start = time.monotonic()
+    deadline = timestamp_start + timeout_seconds
+    demultiplexing_check_deadline = timestamp_start + timeout_seconds * DEMULTIPLEXING_CHECK_DEADLINE_FRACTION
+    scans = {}
+    skipped_run_parent_dirs = []
+    for run_parent_dir in run_parent_dirs:
+        degraded = scanner['degraded_run_parent_dirs'].get(run_parent_dir, None)
+        if degraded is not None and timestamp_start < degraded['retry_at']:
+            skipped_run_parent_dirs.append(run_parent_dir)
+            continue
+        scan_in_progress = scanner['scans_in_progress'].get(run_parent_dir, None)
+        if scan_in_progress is not None:
+            if scan_in_progress['thread'].is_alive():
+                _mark_degraded(scanner, run_parent_dir, 'previous_scan_still_running')
+                skipped_run_parent_dirs.append(run_parent_dir)
+                continue
+            del scanner['scans_in_progress'][run_parent_dir]
+        result = {}
+        # Daemon threads, so that a scan that never returns doesn't stop the collector from exiting.
+        thread = threading.Thread(
+            target=_scan_run_parent_dir,
+            args=(run_parent_dir, scan_inputs_by_run_parent_dir[run_parent_dir], demultiplexing_check_deadline, result),
+            name='scan_run_parent_dir',
+            daemon=True,
+        )
+        thread.start()
+        scans[run_parent_dir] = {'thread': thread, 'result': result}
+
+    results = {}
+    for run_parent_dir, scan in scans.items():
+        scan['thread'].join(max(0, deadline - time.monotonic()))
+        if scan['thread'].is_alive():
+            scanner['scans_in_progress'][run_parent_dir] = scan
+            _mark_degraded(scanner, run_parent_dir, 'timeout')
+            skipped_run_parent_dirs.append(run_parent_dir)
+            continue
+        if run_parent_dir in scanner['degraded_run_parent_dirs']:
+            del scanner['degraded_run_parent_dirs'][run_parent_dir]
+            logging.info(json.dumps({"event_type": "run_parent_dir_recovered", "run_parent_dir": run_parent_dir}))
+        if scan['result']['error'] is not None:
+            logging.debug(json.dumps({"event_type": "run_parent_dir_scan_failed", "run_parent_dir": run_parent_dir, "error": scan['result']['error']}))
+        scanner['scan_duration_seconds_by_run_parent_dir'][run_parent_dir] = scan['result']['scan_duration_seconds']
+        results[run_parent_dir] = scan['result']
+
+    logging.info(json.dumps({
+        "event_type": "run_parent_dirs_scanned",
+        "scan_duration_seconds_by_run_parent_dir": {
+            run_parent_dir: results[run_parent_dir]['scan_duration_seconds'] for run_parent_dir in run_parent_dirs if run_parent_dir in results
+        },
+        "degraded_run_parent_dirs": sorted(skipped_run_parent_dirs),
+    }))
+
+    return results
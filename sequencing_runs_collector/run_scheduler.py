@@ -0,0 +1,299 @@
+import concurrent.futures
+import contextvars
+import datetime
+import json
+import logging
+import os
+import shutil
+import traceback
+import uuid
+
+from pathlib import Path
+from typing import Optional
+
+import sequencing_runs_collector.core as core
+import sequencing_runs_collector.metrics as metrics
+import sequencing_runs_collector.run_staging as run_staging
+import sequencing_runs_collector.run_state as run_state
+import sequencing_runs_collector.tracing as tracing
+
+DEFAULT_NUM_CONCURRENT_RUNS = 1
+# Set in each run collection thread. Every log record made while collecting a run carries it (see `add_correlation_id`).
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+
+def add_correlation_id(record: logging.LogRecord) -> bool:
+    """
+    Logging filter that adds the correlation ID of the run being collected (or null) to a log record,
+    as JSON, so that it can be used in a log format as `%(correlation_id)s`.
+
+    :param record: Log record
+    :type record: logging.LogRecord
+    :return: True, so that the record is always logged
+    :rtype: bool
+    """
+    record.correlation_id = json.dumps(correlation_id.get())
+
+    return True
+
+
+def update_run_executor(run_executor, config):
+    """
+    Make sure the run collection threads match the config. The executor is only replaced when
+    `num_concurrent_runs` changes. Runs that are already being collected carry on in the old executor's threads.
+
+    Runs share the FASTQ statistics worker pool, so `num_fastq_stats_collection_processes` still limits
+    the CPU used for FASTQ statistics, however many runs are collected at once.
+
+    :param run_executor: Current executor, as returned by a previous call. Keys: [executor, num_concurrent_runs]
+    :type run_executor: Optional[dict[str, object]]
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Executor matching the config
+    :rtype: dict[str, object]
+    """
+    num_concurrent_runs = max(1, int(config.get('num_concurrent_runs', DEFAULT_NUM_CONCURRENT_RUNS)))
+    if run_executor is not None:
+        if run_executor['num_concurrent_runs'] == num_concurrent_runs:
+            return run_executor
+        run_executor['executor'].shutdown(wait=False)
+
+    run_executor = {
+        'executor': concurrent.futures.ThreadPoolExecutor(max_workers=num_concurrent_runs, thread_name_prefix='collect_run'),
+        'num_concurrent_runs': num_concurrent_runs,
+    }
+    logging.info(json.dumps({
+        'event_type': 'run_executor_started',
+        'num_concurrent_runs': num_concurrent_runs,
+    }))
+
+    return run_executor
+
+
+def collect_and_write_run(config, run, fastq_stats_pool, run_correlation_id):
+    """
+    Collect a run, and write its output. Runs in a run collection thread.
+
+    Any exception is caught and logged, so that one run failing doesn't affect the others.
+
+    The run's output is written to its staging directory, and moved into place with a single rename once it is complete,
+    so a run's output directory never holds partial output. Progress is checkpointed in the staging directory,
+    so if collection is interrupted or fails, the next attempt resumes where it left off. The staging directory is
+    removed once the output is in place.
+
+    If the run already has output, only its new demultiplexings are collected, and they are added to the run's existing output.
+    Demultiplexings that are already in the output directory are treated as collected, as well as `collected_demultiplexing_ids`,
+    so that a run whose output was published just before the collector stopped, and before it was recorded as collected, isn't published twice.
+
+    Each stage of collecting and writing the run is timed (see `tracing.span`), and the timings are written
+    to `{run_id}_collection_profile.json` in the run's output directory.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run. Keys: [run_id, instrument_type, instrument_model, run_dir, collected_demultiplexing_ids]
+    :type run: dict[str, object]
+    :param fastq_stats_pool: Worker pool for FASTQ statistics, as returned by `core.update_fastq_stats_pool`
+    :type fastq_stats_pool: Optional[dict[str, object]]
+    :param run_correlation_id: Correlation ID, added to every log record made while collecting the run
+    :type run_correlation_id: str
+    :return: Outcome. Keys: [run_id, status, error, output_dir, demultiplexing_ids]. Status is 'collected' or 'failed'.
+             `demultiplexing_ids` are all of the demultiplexings in the run's output, including ones that were already there.
+    :rtype: dict[str, object]
+    """
+    correlation_id.set(run_correlation_id)
+    outcome = {
+        'run_id': run['run_id'],
+        'status': 'failed',
+        'error': None,
+        'output_dir': None,
+        'demultiplexing_ids': [],
+    }
+    timestamp_collect_run_start = datetime.datetime.now()
+    logging.info(json.dumps({
+        'event_type': 'collect_run_start',
+        'sequencing_run_id': run['run_id'],
+        'run_dir': run['run_dir']
+    }))
+    try:
+        run_output_dir = Path(os.path.join(str(config['output_directory']), run['instrument_type'].lower(), str(run['run_id'])))
+        run_staging_dir = run_staging.get_run_staging_dir(config['output_directory'], run)
+        checkpoint_dir = os.path.join(run_staging_dir, 'checkpoints')
+        staging_output_dir = os.path.join(run_staging_dir, 'output')
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        collected_demultiplexing_ids = set(run.get('collected_demultiplexing_ids', []))
+        # The output directory is only ever created complete (see `run_staging.publish_run_output`), so a run that has one has been collected.
+        is_incremental = os.path.exists(run_output_dir)
+        if is_incremental:
+            written_demultiplexing_ids = core.get_written_demultiplexing_ids(run_output_dir)
+            if not written_demultiplexing_ids <= collected_demultiplexing_ids:
+                logging.info(json.dumps({
+                    'event_type': 'unrecorded_demultiplexings_found',
+                    'sequencing_run_id': run['run_id'],
+                    'demultiplexing_ids': sorted(written_demultiplexing_ids - collected_demultiplexing_ids),
+                }))
+            collected_demultiplexing_ids |= written_demultiplexing_ids
+        collected_run = None
+        with tracing.span('collect_run', sequencing_run_id=run['run_id'], correlation_id=run_correlation_id, incremental=is_incremental) as collect_run_span:
+            if run['instrument_type'] == 'ILLUMINA':
+                skip_demultiplexing_ids = collected_demultiplexing_ids if is_incremental else None
+                collected_run = core.collect_illumina_run(config, run, fastq_stats_pool, checkpoint_dir, skip_demultiplexing_ids)
+            elif run['instrument_type'] == 'NANOPORE':
+                collected_run = core.collect_nanopore_run(config, run)
+
+            if collected_run is not None:
+                with tracing.span('write_output'):
+                    # Output left by an attempt that was interrupted while writing is discarded. Writing is quick, compared to collecting.
+                    shutil.rmtree(staging_output_dir, ignore_errors=True)
+                    os.makedirs(staging_output_dir)
+                    if run['instrument_type'] == 'ILLUMINA':
+                        core.write_collected_illumina_run(collected_run, staging_output_dir)
+                    else:
+                        core.write_collected_nanopore_run(collected_run, staging_output_dir)
+
+        if collected_run is None:
+            logging.error(json.dumps({
+                'event_type': 'collect_run_returned_none',
+                'sequencing_run_id': run['run_id'],
+            }))
+            outcome['error'] = 'collect_run_returned_none'
+        else:
+            # The profile is published with the rest of the output. An incremental collection's profile replaces the
+            # run's previous one, as it only covers the new demultiplexings.
+            collection_profile_filename = f"{run['run_id']}_collection_profile.json"
+            tracing.write_collection_profile(collect_run_span, os.path.join(staging_output_dir, collection_profile_filename))
+            if is_incremental:
+                run_staging.publish_demultiplexings(staging_output_dir, run_output_dir)
+                os.replace(os.path.join(staging_output_dir, collection_profile_filename), os.path.join(run_output_dir, collection_profile_filename))
+            else:
+                run_staging.publish_run_output(staging_output_dir, run_output_dir)
+            run_staging.remove_run_staging_dir(run_staging_dir)
+            written_demultiplexing_ids = [demultiplexing['demultiplexing_id'] for demultiplexing in collected_run.get('demultiplexings', [])]
+            outcome['demultiplexing_ids'] = sorted(set(written_demultiplexing_ids) | collected_demultiplexing_ids) if is_incremental else written_demultiplexing_ids
+            logging.info(json.dumps({
+                'event_type': 'run_data_written',
+                'sequencing_run_id': run['run_id'],
+                'output_dir': os.path.abspath(run_output_dir),
+                'demultiplexing_ids': written_demultiplexing_ids,
+                'incremental': is_incremental,
+            }))
+            outcome['status'] = 'collected'
+            outcome['output_dir'] = os.path.abspath(run_output_dir)
+    except Exception as e:
+        logging.error(json.dumps({
+            'event_type': 'collect_run_failed',
+            'sequencing_run_id': run['run_id'],
+            'error': f"{type(e).__name__}: {e}",
+            'traceback': traceback.format_exc(),
+        }))
+        outcome['error'] = f"{type(e).__name__}: {e}"
+
+    timestamp_collect_run_complete = datetime.datetime.now()
+    logging.info(json.dumps({
+        'event_type': 'collect_run_complete',
+        'sequencing_run_id': run['run_id'],
+        'run_status': outcome['status'],
+        'collect_run_duration_seconds': (timestamp_collect_run_complete - timestamp_collect_run_start).total_seconds()
+    }))
+
+    return outcome
+
+
+def submit_run(run_executor, config, run, fastq_stats_pool, wake_fd: Optional[int] = None):
+    """
+    Start collecting a run in a run collection thread.
+
+    :param run_executor: Executor, as returned by `update_run_executor`
+    :type run_executor: dict[str, object]
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Run. Keys: [run_id, instrument_type, instrument_model, run_dir]
+    :type run: dict[str, object]
+    :param fastq_stats_pool: Worker pool for FASTQ statistics, as returned by `core.update_fastq_stats_pool`
+    :type fastq_stats_pool: Optional[dict[str, object]]
+    :param wake_fd: File descriptor to write a byte to when the run is finished, to wake the main loop.
+    :type wake_fd: Optional[int]
+    :return: Run in progress. Keys: [run, correlation_id, future]
+    :rtype: dict[str, object]
+    """
+    run_correlation_id = uuid.uuid4().hex
+    logging.info(json.dumps({
+        'event_type': 'run_collection_submitted',
+        'sequencing_run_id': run['run_id'],
+        'correlation_id': run_correlation_id,
+        'queue_wait_seconds': run.get('queue_wait_seconds', None),
+    }))
+    future = run_executor['executor'].submit(collect_and_write_run, config, run, fastq_stats_pool, run_correlation_id)
+    if wake_fd is not None:
+        future.add_done_callback(lambda f: os.write(wake_fd, b'\0'))
+    run_in_progress = {
+        'run': run,
+        'correlation_id': run_correlation_id,
+        'future': future,
+    }
+
+    return run_in_progress
+
+
+def finish_completed_runs(runs_in_progress, run_state_conn):
+    """
+    Record the outcome of each run that has finished, and remove it from `runs_in_progress`.
+
+    :param runs_in_progress: Runs in progress, indexed by run ID. Values as returned by `submit_run`. Updated in place.
+    :type runs_in_progress: dict[str, dict[str, object]]
+    :param run_state_conn: Connection to the run state store
+    :type run_state_conn: sqlite3.Connection
+    :return: Outcomes of the finished runs, as returned by `collect_and_write_run`
+    :rtype: list[dict[str, object]]
+    """
+    outcomes = []
+    for run_id in list(runs_in_progress):
+        future = runs_in_progress[run_id]['future']
+        if not future.done():
+            continue
+        del runs_in_progress[run_id]
+        outcome = future.result()
+        run_state.set_run_status(run_state_conn, run_id, outcome['status'], error=outcome['error'])
+        if outcome['status'] == 'collected':
+            run_state.add_collected_demultiplexings(run_state_conn, run_id, outcome['demultiplexing_ids'])
+            metrics.increment('runs_collected_total')
+        else:
+            metrics.increment('runs_failed_total')
+        outcomes.append(outcome)
+
+    return outcomes
+
+
+def wait_for_runs(runs_in_progress, run_state_conn):
+    """
+    Wait for every run in progress to finish, and record their outcomes.
+
+    :param runs_in_progress: Runs in progress, indexed by run ID. Values as returned by `submit_run`. Updated in place.
+    :type runs_in_progress: dict[str, dict[str, object]]
+    :param run_state_conn: Connection to the run state store
+    :type run_state_conn: sqlite3.Connection
+    :return: None
+    :rtype: NoneType
+    """
+    if runs_in_progress:
+        logging.info(json.dumps({
+            'event_type': 'waiting_for_runs_in_progress',
+            'sequencing_run_ids': sorted(runs_in_progress),
+        }))
+    concurrent.futures.wait([run_in_progress['future'] for run_in_progress in runs_in_progress.values()])
+    finish_completed_runs(runs_in_progress, run_state_conn)
+
+
+def drain_wake_fd(wake_fd: int):
+    """
+    Read everything written to the (non-blocking) wake pipe, so that it can be waited on again.
+
+    :param wake_fd: Read end of the wake pipe
+    :type wake_fd: int
+    :return: None
+    :rtype: NoneType
+    """
+    try:
+        while os.read(wake_fd, 4096):
+            pass
+    except BlockingIOError as e:
+        pass
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from pathlib import Path
+from typing import Optional
+
+import sequencing_runs_collector.fastq_stats_cache as fastq_stats_cache
+
+# Under the output directory, so that the finished output can be moved into place with a rename.
+# The leading '.' keeps it from being mistaken for an instrument type's output directory.
+STAGING_DIRNAME = '.staging'
+
+
+def get_run_staging_dir(output_directory: Path, run: dict[str, object]) -> str:
+    """
+    Get the staging directory for a run. A run's output is written to `output/` in its staging directory,
+    and its checkpoints are kept in `checkpoints/`.
+
+    :param output_directory: Output directory, from the config
+    :type output_directory: Path
+    :param run: Run. Keys: [run_id, instrument_type]
+    :type run: dict[str, object]
+    :return: Path to the run's staging directory
+    :rtype: str
+    """
+    run_staging_dir = os.path.join(str(output_directory), STAGING_DIRNAME, run['instrument_type'].lower(), run['run_id'])
+
+    return run_staging_dir
+
+
+def _write_json_atomic(path: str, data: object):
+    """
+    Write JSON to a temporary file, then rename it into place, so that a reader never sees a partly-written file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str) -> Optional[object]:
+    """
+    Read a checkpoint file. Returns None if it doesn't exist or can't be parsed.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        return None
+
+
+def load_demultiplexing_checkpoint(checkpoint_dir: Path, demultiplexing_id: str, checkpoint_key: dict[str, object]) -> Optional[list[dict[str, object]]]:
+    """
+    Load the sequenced libraries of a demultiplexing, from a checkpoint made by an earlier attempt at collecting the run.
+
+    :param checkpoint_dir: Run's checkpoint directory
+    :type checkpoint_dir: Path
+    :param demultiplexing_id: Demultiplexing ID
+    :type demultiplexing_id: str
+    :param checkpoint_key: Everything that the sequenced libraries depend on. The checkpoint is only used if it was made with the same key.
+    :type checkpoint_key: dict[str, object]
+    :return: Sequenced libraries, or None if there is no usable checkpoint
+    :rtype: Optional[list[dict[str, object]]]
+    """
+    checkpoint = _read_json(os.path.join(checkpoint_dir, f"{demultiplexing_id}_demultiplexing_checkpoint.json"))
+    if checkpoint is None or checkpoint.get('checkpoint_key', None) != checkpoint_key:
+        return None
+    logging.info(json.dumps({
+        'event_type': 'demultiplexing_checkpoint_loaded',
+        'demultiplexing_id': demultiplexing_id,
+        'num_sequenced_libraries': len(checkpoint['sequenced_libraries']),
+    }))
+
+    return checkpoint['sequenced_libraries']
+
+
+def store_demultiplexing_checkpoint(checkpoint_dir: Path, demultiplexing_id: str, checkpoint_key: dict[str, object], sequenced_libraries: list[dict[str, object]]):
+    """
+    Checkpoint the sequenced libraries of a demultiplexing, once they have been collected.
+
+    :param checkpoint_dir: Run's checkpoint directory
+    :type checkpoint_dir: Path
+    :param demultiplexing_id: Demultiplexing ID
+    :type demultiplexing_id: str
+    :param checkpoint_key: Everything that the sequenced libraries depend on (see `load_demultiplexing_checkpoint`)
+    :type checkpoint_key: dict[str, object]
+    :param sequenced_libraries: Sequenced libraries
+    :type sequenced_libraries: list[dict[str, object]]
+    :return: None
+    :rtype: NoneType
+    """
+    checkpoint = {
+        'checkpoint_key': checkpoint_key,
+        'sequenced_libraries': sequenced_libraries,
+    }
+    _write_json_atomic(os.path.join(checkpoint_dir, f"{demultiplexing_id}_demultiplexing_checkpoint.json"), checkpoint)
+
+
+def _get_fastq_stats_checkpoint_path(checkpoint_dir: Path, fastq_path: Path) -> str:
+    """
+    FASTQ filenames can be repeated across demultiplexings, so checkpoints are named by a hash of the file's full path.
+    """
+    fastq_path_hash = hashlib.sha1(os.path.abspath(fastq_path).encode('utf-8')).hexdigest()
+
+    return os.path.join(checkpoint_dir, 'fastq_stats', f"{fastq_path_hash}.json")
+
+
+def load_fastq_stats_checkpoint(checkpoint_dir: Path, fastq_path: Path) -> Optional[dict[str, object]]:
+    """
+    Load the statistics for a FASTQ file, from a checkpoint made by an earlier attempt at collecting the run.
+    Like the FASTQ statistics cache, the checkpoint is only used if the file hasn't changed since it was made.
+
+    :param checkpoint_dir: Run's checkpoint directory
+    :type checkpoint_dir: Path
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: Path
+    :return: FASTQ stats summary, as returned by `illumina.get_fastq_stats`, or None if there is no usable checkpoint
+    :rtype: Optional[dict[str, object]]
+    """
+    checkpoint = _read_json(_get_fastq_stats_checkpoint_path(checkpoint_dir, fastq_path))
+    if checkpoint is None:
+        return None
+    try:
+        file_identity = fastq_stats_cache.get_file_identity(fastq_path)
+    except OSError as e:
+        return None
+    if checkpoint.get('file_identity', None) != file_identity:
+        return None
+
+    return checkpoint['fastq_stats_summary']
+
+
+def store_fastq_stats_checkpoint(checkpoint_dir: Path, fastq_path: Path, fastq_stats_summary: dict[str, object]):
+    """
+    Checkpoint the statistics for a FASTQ file, as soon as they have been collected.
+
+    :param checkpoint_dir: Run's checkpoint directory
+    :type checkpoint_dir: Path
+    :param fastq_path: Path to FASTQ file
+    :type fastq_path: Path
+    :param fastq_stats_summary: FASTQ stats summary, as returned by `illumina.get_fastq_stats`
+    :type fastq_stats_summary: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    checkpoint_path = _get_fastq_stats_checkpoint_path(checkpoint_dir, fastq_path)
+    os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+    checkpoint = {
+        'file_identity': fastq_stats_cache.get_file_identity(fastq_path),
+        'fastq_stats_summary': fastq_stats_summary,
+    }
+    _write_json_atomic(checkpoint_path, checkpoint)
+
+
+def publish_run_output(staging_output_dir: Path, run_output_dir: Path):
+    """
+    Move a run's finished output from its staging directory into place, with a single rename.
+    The run's output directory either doesn't exist, or is complete.
+
+    :param staging_output_dir: Directory that the run's output was written to
+    :type staging_output_dir: Path
+    :param run_output_dir: Run's output directory
+    :type run_output_dir: Path
+    :return: None
+    :rtype: NoneType
+    :raises OSError: If the run's output directory already exists and isn't empty
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(run_output_dir)), exist_ok=True)
+    os.rename(staging_output_dir, run_output_dir)
+
+
+def publish_demultiplexings(staging_output_dir: Path, run_output_dir: Path) -> list[str]:
+    """
+    Move newly-collected demultiplexings from a run's staging directory into its existing output directory.
+    Each demultiplexing is moved with a single rename, so each one is either missing or complete.
+    The rest of the staged output (e.g. the run summary) is left where it is.
+
+    :param staging_output_dir: Directory that the run's output was written to
+    :type staging_output_dir: Path
+    :param run_output_dir: Run's output directory
+    :type run_output_dir: Path
+    :return: IDs of the demultiplexings that were moved
+    :rtype: list[str]
+    :raises OSError: If one of the demultiplexings is already in the run's output directory
+    """
+    staging_demultiplexings_dir = os.path.join(staging_output_dir, 'demultiplexings')
+    run_demultiplexings_dir = os.path.join(run_output_dir, 'demultiplexings')
+    demultiplexing_ids = sorted(os.listdir(staging_demultiplexings_dir)) if os.path.exists(staging_demultiplexings_dir) else []
+    if demultiplexing_ids:
+        # Not created otherwise, e.g. for Nanopore runs, which don't have demultiplexings.
+        os.makedirs(run_demultiplexings_dir, exist_ok=True)
+    for demultiplexing_id in demultiplexing_ids:
+        os.rename(os.path.join(staging_demultiplexings_dir, demultiplexing_id), os.path.join(run_demultiplexings_dir, demultiplexing_id))
+
+    return demultiplexing_ids
+
+
+def remove_run_staging_dir(run_staging_dir: Path):
+    """
+    Remove a run's staging directory, and its checkpoints, once its output has been published.
+
+    :param run_staging_dir: Run's staging directory, as returned by `get_run_staging_dir`
+    :type run_staging_dir: Path
+    :return: None
+    :rtype: NoneType
+    """
+    shutil.rmtree(run_staging_dir, ignore_errors=True)
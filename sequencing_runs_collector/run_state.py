@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from pathlib import Path
+from typing import Iterable, Optional
+
+import sequencing_runs_collector.config
+
+IN_MEMORY_RUN_STATE_PATH = ':memory:'
+# discovered: the run directory exists, but the upload isn't complete yet.
+# ready: the upload is complete, and the run is waiting to be collected.
+# collecting: the run is being collected. Runs left in this state by a crash are reset to 'ready' on startup.
+# collected: the run's output has been written.
+# failed: collection didn't produce any output. Failed runs are tried again after a retry interval.
+RUN_STATUSES = ['discovered', 'ready', 'collecting', 'collected', 'failed']
+# Directory mtimes may only have 1-second resolution on network filesystems. A parent directory that
+# was modified less than this long before it was scanned is scanned again, in case it changed in the same tick.
+PARENT_DIR_MTIME_RESOLUTION_NS = 2 * 1000 * 1000 * 1000
+
+
+def open_run_state(run_state_path: Path) -> sqlite3.Connection:
+    """
+    Open (and create, if needed) the run state store.
+
+    The store should be kept on local disk. SQLite locking is unreliable on network filesystems.
+
+    :param run_state_path: Path to the SQLite run state file, or ':memory:' for a store that isn't kept between restarts.
+    :type run_state_path: Path
+    :return: Connection to the run state store
+    :rtype: sqlite3.Connection
+    """
+    conn = sqlite3.connect(run_state_path, timeout=30)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            instrument_type TEXT NOT NULL,
+            instrument_model TEXT NOT NULL,
+            run_dir TEXT NOT NULL,
+            run_parent_dir TEXT NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            timestamp_discovered REAL NOT NULL,
+            timestamp_updated REAL NOT NULL,
+            estimated_fastq_bytes INTEGER,
+            timestamp_collected REAL,
+            demultiplexing_parent_dirs_mtime_ns INTEGER
+        )
+        """
+    )
+    # Added after the runs table was first released.
+    run_columns = [row[1] for row in conn.execute("PRAGMA table_info(runs)").fetchall()]
+    if 'estimated_fastq_bytes' not in run_columns:
+        conn.execute("ALTER TABLE runs ADD COLUMN estimated_fastq_bytes INTEGER")
+    if 'timestamp_collected' not in run_columns:
+        conn.execute("ALTER TABLE runs ADD COLUMN timestamp_collected REAL")
+        # The best guess for runs that were already collected.
+        conn.execute("UPDATE runs SET timestamp_collected = timestamp_updated WHERE status = 'collected'")
+    if 'demultiplexing_parent_dirs_mtime_ns' not in run_columns:
+        conn.execute("ALTER TABLE runs ADD COLUMN demultiplexing_parent_dirs_mtime_ns INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS runs_status ON runs (status)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS run_parent_dirs (
+            run_parent_dir TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            timestamp_scanned_ns INTEGER NOT NULL
+        )
+        """
+    )
+    # Demultiplexings whose output has been written, so that new demultiplexings of a collected run can be found.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS demultiplexings (
+            run_id TEXT NOT NULL,
+            demultiplexing_id TEXT NOT NULL,
+            timestamp_collected REAL NOT NULL,
+            PRIMARY KEY (run_id, demultiplexing_id)
+        )
+        """
+    )
+    conn.commit()
+
+    return conn
+
+
+def reset_interrupted_runs(conn: sqlite3.Connection) -> int:
+    """
+    Set runs that were left in the 'collecting' state (e.g. by a crash or restart) back to 'ready'.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :return: Number of runs reset
+    :rtype: int
+    """
+    cursor = conn.execute(
+        "UPDATE runs SET status = 'ready', timestamp_updated = ? WHERE status = 'collecting'",
+        (time.time(),),
+    )
+    conn.commit()
+
+    return cursor.rowcount
+
+
+def get_parent_dir_scan(conn: sqlite3.Connection, run_parent_dir: str) -> Optional[dict[str, int]]:
+    """
+    Get the last recorded scan of a run parent directory.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param run_parent_dir: Absolute path to the run parent directory
+    :type run_parent_dir: str
+    :return: Last scan, or None if the directory has never been scanned. Keys: [mtime_ns, timestamp_scanned_ns]
+    :rtype: Optional[dict[str, int]]
+    """
+    row = conn.execute(
+        "SELECT mtime_ns, timestamp_scanned_ns FROM run_parent_dirs WHERE run_parent_dir = ?",
+        (run_parent_dir,),
+    ).fetchone()
+    if row is None:
+        return None
+    last_mtime_ns, timestamp_scanned_ns = row
+
+    return {'mtime_ns': last_mtime_ns, 'timestamp_scanned_ns': timestamp_scanned_ns}
+
+
+def parent_dir_unchanged(last_scan: Optional[dict[str, int]], mtime_ns: int) -> bool:
+    """
+    Check whether a run parent directory is unchanged since it was last scanned.
+
+    Adding or removing a run directory changes the mtime of its parent directory, so an unchanged
+    parent directory has no new runs. Changes inside existing run directories (e.g. `upload_complete.json`
+    appearing) don't change the parent directory's mtime.
+
+    This doesn't use the run state store, so that it can be called from the threads that scan run parent directories.
+
+    :param last_scan: Last scan of the directory, as returned by `get_parent_dir_scan`
+    :type last_scan: Optional[dict[str, int]]
+    :param mtime_ns: Current mtime of the run parent directory
+    :type mtime_ns: int
+    :return: True if the directory has been scanned since it was last modified
+    :rtype: bool
+    """
+    if last_scan is None:
+        return False
+
+    return last_scan['mtime_ns'] == mtime_ns and last_scan['timestamp_scanned_ns'] - mtime_ns >= PARENT_DIR_MTIME_RESOLUTION_NS
+
+
+def store_parent_dir_scan(conn: sqlite3.Connection, run_parent_dir: str, mtime_ns: int, timestamp_scanned_ns: int):
+    """
+    Record that a run parent directory was scanned.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param run_parent_dir: Absolute path to the run parent directory
+    :type run_parent_dir: str
+    :param mtime_ns: mtime of the run parent directory, taken before it was scanned
+    :type mtime_ns: int
+    :param timestamp_scanned_ns: Time that the scan started (`time.time_ns()`)
+    :type timestamp_scanned_ns: int
+    :return: None
+    :rtype: NoneType
+    """
+    conn.execute(
+        "INSERT OR REPLACE INTO run_parent_dirs VALUES (?, ?, ?)",
+        (run_parent_dir, mtime_ns, timestamp_scanned_ns),
+    )
+    conn.commit()
+
+
+def _row_to_run(row: tuple) -> dict[str, object]:
+    """
+    Convert a row of the runs table to a run dict.
+    """
+    run = {
+        'run_id': row[0],
+        'instrument_type': row[1],
+        'instrument_model': row[2],
+        'run_dir': row[3],
+        'run_parent_dir': row[4],
+        'status': row[5],
+        'error': row[6],
+        'timestamp_updated': row[8],
+        'estimated_fastq_bytes': row[9],
+        'timestamp_collected': row[10],
+        'demultiplexing_parent_dirs_mtime_ns': row[11],
+    }
+
+    return run
+
+
+def get_run_ids(conn: sqlite3.Connection, run_parent_dir: str) -> set[str]:
+    """
+    Get the IDs of all runs that have been found in a run parent directory.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param run_parent_dir: Absolute path to the run parent directory
+    :type run_parent_dir: str
+    :return: Sequencing run IDs
+    :rtype: set[str]
+    """
+    rows = conn.execute("SELECT run_id FROM runs WHERE run_parent_dir = ?", (run_parent_dir,)).fetchall()
+
+    return set(row[0] for row in rows)
+
+
+def get_runs(conn: sqlite3.Connection, statuses: Iterable[str], run_parent_dirs: Iterable[str]) -> list[dict[str, object]]:
+    """
+    Get the runs in the given run parent directories that have one of the given statuses.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param statuses: Run statuses. See `RUN_STATUSES`.
+    :type statuses: Iterable[str]
+    :param run_parent_dirs: Absolute paths to run parent directories
+    :type run_parent_dirs: Iterable[str]
+    :return: Runs, sorted by run ID. Keys: ['run_id', 'instrument_type', 'instrument_model', 'run_dir', 'run_parent_dir', 'status', 'error', 'timestamp_updated', 'estimated_fastq_bytes', 'timestamp_collected', 'demultiplexing_parent_dirs_mtime_ns']
+    :rtype: list[dict[str, object]]
+    """
+    statuses = list(statuses)
+    run_parent_dirs = list(run_parent_dirs)
+    if not statuses or not run_parent_dirs:
+        return []
+    status_placeholders = ', '.join('?' * len(statuses))
+    run_parent_dir_placeholders = ', '.join('?' * len(run_parent_dirs))
+    rows = conn.execute(
+        f"SELECT * FROM runs WHERE status IN ({status_placeholders}) AND run_parent_dir IN ({run_parent_dir_placeholders}) ORDER BY run_id",
+        statuses + run_parent_dirs,
+    ).fetchall()
+
+    return [_row_to_run(row) for row in rows]
+
+
+def add_run(conn: sqlite3.Connection, run: dict[str, object], run_parent_dir: str, status: str, timestamp_collected: Optional[float] = None) -> bool:
+    """
+    Add a newly-found run. Nothing is changed if a run with the same ID has already been added,
+    for example from another run parent directory.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param run: Run. Keys: ['run_id', 'instrument_type', 'instrument_model', 'run_dir']
+    :type run: dict[str, object]
+    :param run_parent_dir: Absolute path to the run parent directory that the run was found in
+    :type run_parent_dir: str
+    :param status: Run status. See `RUN_STATUSES`.
+    :type status: str
+    :param timestamp_collected: When the run was collected, for a run that is added as 'collected'. Defaults to now.
+    :type timestamp_collected: Optional[float]
+    :return: True if the run was added
+    :rtype: bool
+    """
+    now = time.time()
+    if status == 'collected' and timestamp_collected is None:
+        timestamp_collected = now
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO runs (run_id, instrument_type, instrument_model, run_dir, run_parent_dir, status, error, timestamp_discovered, timestamp_updated, timestamp_collected) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (run['run_id'], run['instrument_type'], run['instrument_model'], run['run_dir'], run_parent_dir, status, None, now, now, timestamp_collected),
+    )
+    conn.commit()
+
+    return cursor.rowcount > 0
+
+
+def set_run_status(conn: sqlite3.Connection, run_id: str, status: str, error: Optional[str] = None):
+    """
+    Update the status of a run. A run that is set to 'collected' is recorded as collected now.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param status: Run status. See `RUN_STATUSES`.
+    :type status: str
+    :param error: Why the run failed, if it did.
+    :type error: Optional[str]
+    :return: None
+    :rtype: NoneType
+    """
+    if status not in RUN_STATUSES:
+        raise ValueError(f"Unknown run status: {status}. Supported: {RUN_STATUSES}")
+    now = time.time()
+    conn.execute(
+        "UPDATE runs SET status = ?, error = ?, timestamp_updated = ? WHERE run_id = ?",
+        (status, error, now, run_id),
+    )
+    if status == 'collected':
+        conn.execute("UPDATE runs SET timestamp_collected = ? WHERE run_id = ?", (now, run_id))
+    conn.commit()
+
+
+def set_estimated_fastq_bytes(conn: sqlite3.Connection, run_id: str, estimated_fastq_bytes: int):
+    """
+    Record how much FASTQ data a run has. This is only estimated once the upload is complete, so it doesn't change.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param estimated_fastq_bytes: Total size of the run's FASTQ files, in bytes
+    :type estimated_fastq_bytes: int
+    :return: None
+    :rtype: NoneType
+    """
+    conn.execute("UPDATE runs SET estimated_fastq_bytes = ? WHERE run_id = ?", (estimated_fastq_bytes, run_id))
+    conn.commit()
+
+
+def set_demultiplexing_parent_dirs_mtime_ns(conn: sqlite3.Connection, run_id: str, mtime_ns: int):
+    """
+    Record the mtime of a collected run's demultiplexing parent directories (see `illumina.get_demultiplexing_parent_dirs_mtime_ns`)
+    when it was checked for new demultiplexings and none were still being written. The run isn't checked again until it changes.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param mtime_ns: Latest mtime of the run's demultiplexing parent directories
+    :type mtime_ns: int
+    :return: None
+    :rtype: NoneType
+    """
+    conn.execute("UPDATE runs SET demultiplexing_parent_dirs_mtime_ns = ? WHERE run_id = ?", (mtime_ns, run_id))
+    conn.commit()
+
+
+def get_collected_demultiplexing_ids(conn: sqlite3.Connection, run_id: str) -> set[str]:
+    """
+    Get the IDs of a run's demultiplexings that have been collected.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :return: Demultiplexing IDs
+    :rtype: set[str]
+    """
+    rows = conn.execute("SELECT demultiplexing_id FROM demultiplexings WHERE run_id = ?", (run_id,)).fetchall()
+
+    return set(row[0] for row in rows)
+
+
+def add_collected_demultiplexings(conn: sqlite3.Connection, run_id: str, demultiplexing_ids: Iterable[str]):
+    """
+    Record that a run's demultiplexings have been collected.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param demultiplexing_ids: Demultiplexing IDs
+    :type demultiplexing_ids: Iterable[str]
+    :return: None
+    :rtype: NoneType
+    """
+    now = time.time()
+    conn.executemany(
+        "INSERT OR IGNORE INTO demultiplexings (run_id, demultiplexing_id, timestamp_collected) VALUES (?, ?, ?)",
+        [(run_id, demultiplexing_id, now) for demultiplexing_id in demultiplexing_ids],
+    )
+    conn.commit()
+
+
+def remove_missing_runs(conn: sqlite3.Connection, run_parent_dir: str, present_run_ids: set[str]) -> int:
+    """
+    Remove the runs in a run parent directory whose run directories are no longer there.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param run_parent_dir: Absolute path to the run parent directory
+    :type run_parent_dir: str
+    :param present_run_ids: IDs of the runs that are in the run parent directory now
+    :type present_run_ids: set[str]
+    :return: Number of runs removed
+    :rtype: int
+    """
+    missing_run_ids = get_run_ids(conn, run_parent_dir) - present_run_ids
+    for run_id in missing_run_ids:
+        conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+        conn.execute("DELETE FROM demultiplexings WHERE run_id = ?", (run_id,))
+    conn.commit()
+
+    return len(missing_run_ids)
+
+
+def remove_runs(conn: sqlite3.Connection, run_ids: Iterable[str]) -> int:
+    """
+    Remove runs from the store. Their run parent directories are scanned again on the next scan,
+    so any of the runs that still exist are found again.
+
+    :param conn: Connection to the run state store
+    :type conn: sqlite3.Connection
+    :param run_ids: Sequencing run IDs
+    :type run_ids: Iterable[str]
+    :return: Number of runs removed
+    :rtype: int
+    """
+    num_runs_removed = 0
+    for run_id in run_ids:
+        row = conn.execute("SELECT run_parent_dir FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            continue
+        conn.execute("DELETE FROM run_parent_dirs WHERE run_parent_dir = ?", (row[0],))
+        conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+        conn.execute("DELETE FROM demultiplexings WHERE run_id = ?", (run_id,))
+        num_runs_removed += 1
+    conn.commit()
+
+    return num_runs_removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Remove runs from the run state store, so that they are found again on the next scan')
+    parser.add_argument('-c', '--config', help='Config file. The run state path is taken from `run_state_path`.')
+    parser.add_argument('--run-state-path', help='Path to the run state file. Overrides the config.')
+    parser.add_argument('--run-id', action='append', required=True, help='Sequencing run ID to reset. May be repeated.')
+    parser.add_argument('--log-level')
+    args = parser.parse_args()
+
+    try:
+        log_level = getattr(logging, args.log_level.upper())
+    except AttributeError as e:
+        log_level = logging.INFO
+
+    logging.basicConfig(
+        format='{"timestamp": "%(asctime)s.%(msecs)03d", "level": "%(levelname)s", "module": "%(module)s", "function_name": "%(funcName)s", "line_num": %(lineno)d, "message": %(message)s}',
+        datefmt='%Y-%m-%dT%H:%M:%S',
+        encoding='utf-8',
+        level=log_level,
+    )
+
+    run_state_path = args.run_state_path
+    if run_state_path is None and args.config:
+        config = sequencing_runs_collector.config.load_config(args.config)
+        run_state_path = config.get('run_state_path', None)
+    if run_state_path is None:
+        logging.error(json.dumps({"event_type": "run_state_path_not_provided"}))
+        exit(-1)
+    if not os.path.exists(run_state_path):
+        logging.error(json.dumps({"event_type": "run_state_not_found", "run_state_path": os.path.abspath(run_state_path)}))
+        exit(-1)
+
+    conn = open_run_state(run_state_path)
+    for run_id in args.run_id:
+        num_runs_removed = remove_runs(conn, [run_id])
+        logging.info(json.dumps({
+            "event_type": "run_state_reset",
+            "sequencing_run_id": run_id,
+            "num_runs_removed": num_runs_removed,
+        }))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import os
+import re
+import select
+import struct
+import sys
+import time
+
+from typing import Iterable, Optional
+
+UPLOAD_COMPLETE_FILENAME = "upload_complete.json"
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+RUN_PARENT_DIR_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+RUN_DIR_WATCH_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR
+# struct inotify_event: int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[len];
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+INOTIFY_READ_SIZE_BYTES = 64 * 1024
+# inotify only sees changes made through the local kernel. Changes made on other hosts
+# (e.g. by the instrument or upload tooling writing to an NFS export) are never reported.
+NETWORK_FILESYSTEM_TYPES = {
+    'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', '9p', 'fuse.sshfs',
+    'lustre', 'gpfs', 'ceph', 'fuse.ceph', 'glusterfs', 'fuse.glusterfs', 'beegfs',
+}
+
+
+def _load_inotify_functions() -> Optional[ctypes.CDLL]:
+    """
+    Load libc and check that it has the inotify functions. Returns None if it doesn't (e.g. not on Linux).
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError) as e:
+        return None
+
+    return libc
+
+
+def get_filesystem_type(path: str, mounts_path: str = '/proc/mounts') -> Optional[str]:
+    """
+    Get the type of the filesystem that a path is on, from the longest matching mount point.
+
+    :param path: Path
+    :type path: str
+    :param mounts_path: Mount table to read
+    :type mounts_path: str
+    :return: Filesystem type (e.g. 'ext4', 'nfs4'), or None if it can't be determined.
+    :rtype: Optional[str]
+    """
+    real_path = os.path.realpath(path)
+    filesystem_type = None
+    longest_mount_point_length = -1
+    try:
+        with open(mounts_path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces etc. in mount points are octal-escaped in the mount table.
+                mount_point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1])
+                is_mounted_on = real_path == mount_point or real_path.startswith(mount_point.rstrip('/') + '/')
+                if is_mounted_on and len(mount_point) > longest_mount_point_length:
+                    filesystem_type = fields[2]
+                    longest_mount_point_length = len(mount_point)
+    except OSError as e:
+        return None
+
+    return filesystem_type
+
+
+def open_watcher() -> Optional[dict[str, object]]:
+    """
+    Start watching for new sequencing runs with inotify.
+
+    :return: Watcher, or None if inotify isn't available. Keys: ['libc', 'fd', 'paths_by_wd', 'wds_by_path', 'run_parent_dirs', 'unwatchable_paths']
+    :rtype: Optional[dict[str, object]]
+    """
+    libc = _load_inotify_functions()
+    if libc is None:
+        logging.warning(json.dumps({"event_type": "inotify_unavailable", "platform": sys.platform}))
+        return None
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        error_number = ctypes.get_errno()
+        logging.warning(json.dumps({"event_type": "inotify_unavailable", "error": os.strerror(error_number)}))
+        return None
+
+    watcher = {
+        'libc': libc,
+        'fd': fd,
+        'paths_by_wd': {},
+        'wds_by_path': {},
+        'run_parent_dirs': set(),
+        'unwatchable_paths': set(),
+    }
+
+    return watcher
+
+
+def close_watcher(watcher: dict[str, object]):
+    """
+    Stop watching, and release the inotify file descriptor.
+
+    :param watcher: Watcher, as returned by `open_watcher`
+    :type watcher: dict[str, object]
+    :return: None
+    :rtype: NoneType
+    """
+    os.close(watcher['fd'])
+    watcher['paths_by_wd'].clear()
+    watcher['wds_by_path'].clear()
+
+
+def _add_watch(watcher: dict[str, object], path: str, mask: int) -> bool:
+    """
+    Watch a directory. Directories on network filesystems aren't watched, since inotify doesn't see changes made
+    on other hosts. Each directory that can't be watched is logged once.
+    """
+    if path in watcher['wds_by_path']:
+        return True
+    if path in watcher['unwatchable_paths']:
+        return False
+    filesystem_type = get_filesystem_type(path)
+    if filesystem_type in NETWORK_FILESYSTEM_TYPES:
+        watcher['unwatchable_paths'].add(path)
+        logging.warning(json.dumps({"event_type": "directory_not_watchable", "directory": path, "filesystem_type": filesystem_type}))
+        return False
+    wd = watcher['libc'].inotify_add_watch(watcher['fd'], os.fsencode(path), mask)
+    if wd < 0:
+        error_number = ctypes.get_errno()
+        # A directory that doesn't exist (yet) may be watchable later.
+        if error_number != errno.ENOENT:
+            watcher['unwatchable_paths'].add(path)
+            logging.warning(json.dumps({"event_type": "directory_not_watchable", "directory": path, "error": os.strerror(error_number)}))
+        return False
+    watcher['paths_by_wd'][wd] = path
+    watcher['wds_by_path'][path] = wd
+
+    return True
+
+
+def _remove_watch(watcher: dict[str, object], path: str):
+    """
+    Stop watching a directory.
+    """
+    wd = watcher['wds_by_path'].pop(path, None)
+    if wd is None:
+        return
+    watcher['paths_by_wd'].pop(wd, None)
+    watcher['libc'].inotify_rm_watch(watcher['fd'], wd)
+
+
+def update_watches(watcher: dict[str, object], run_parent_dirs: Iterable[str], pending_run_dirs: Iterable[str]) -> bool:
+    """
+    Watch the run parent directories, and the directories of runs that are still uploading.
+    Directories that no longer need to be watched are dropped.
+
+    An upload may finish between a scan and its run directory being watched, which inotify won't report.
+    So each newly-watched run directory is checked for `upload_complete.json`.
+
+    :param watcher: Watcher, as returned by `open_watcher`
+    :type watcher: dict[str, object]
+    :param run_parent_dirs: Absolute paths to run parent directories
+    :type run_parent_dirs: Iterable[str]
+    :param pending_run_dirs: Absolute paths to the directories of runs whose uploads aren't complete
+    :type pending_run_dirs: Iterable[str]
+    :return: True if a newly-watched run directory already has `upload_complete.json`, and should be scanned now.
+    :rtype: bool
+    """
+    run_parent_dirs = set(run_parent_dirs)
+    pending_run_dirs = set(pending_run_dirs)
+    paths_to_watch = run_parent_dirs | pending_run_dirs
+    for path in list(watcher['wds_by_path']):
+        if path not in paths_to_watch:
+            _remove_watch(watcher, path)
+    watcher['run_parent_dirs'] = run_parent_dirs
+
+    for run_parent_dir in sorted(run_parent_dirs):
+        _add_watch(watcher, run_parent_dir, RUN_PARENT_DIR_WATCH_MASK)
+
+    upload_completed_before_watch = False
+    for run_dir in sorted(pending_run_dirs):
+        already_watched = run_dir in watcher['wds_by_path']
+        if _add_watch(watcher, run_dir, RUN_DIR_WATCH_MASK) and not already_watched:
+            if os.path.exists(os.path.join(run_dir, UPLOAD_COMPLETE_FILENAME)):
+                upload_completed_before_watch = True
+
+    return upload_completed_before_watch
+
+
+def _read_events(watcher: dict[str, object]) -> list[dict[str, object]]:
+    """
+    Read all of the inotify events that are waiting. Watches that the kernel has dropped (e.g. because
+    the directory was deleted) are forgotten.
+    """
+    try:
+        data = os.read(watcher['fd'], INOTIFY_READ_SIZE_BYTES)
+    except BlockingIOError as e:
+        return []
+
+    events = []
+    offset = 0
+    while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, name_length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+        offset += INOTIFY_EVENT_HEADER.size
+        name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+        offset += name_length
+        if mask & IN_IGNORED:
+            path = watcher['paths_by_wd'].pop(wd, None)
+            if path is not None:
+                watcher['wds_by_path'].pop(path, None)
+            continue
+        events.append({
+            'path': watcher['paths_by_wd'].get(wd, None),
+            'name': name,
+            'mask': mask,
+        })
+
+    return events
+
+
+def _is_run_event(watcher: dict[str, object], event: dict[str, object]) -> bool:
+    """
+    Check whether an event means that a scan is needed: a directory was added to or removed from a run parent directory,
+    `upload_complete.json` appeared in a run directory, or events were lost.
+    """
+    if event['mask'] & IN_Q_OVERFLOW:
+        return True
+    if event['path'] is None:
+        return False
+    if event['path'] in watcher['run_parent_dirs']:
+        return bool(event['mask'] & IN_ISDIR)
+
+    return event['name'] == UPLOAD_COMPLETE_FILENAME
+
+
+def wait_for_run_events(watcher: dict[str, object], timeout_seconds: float, wake_fd: Optional[int] = None) -> list[dict[str, object]]:
+    """
+    Wait until there is an event that means a scan is needed, until `wake_fd` becomes readable, or until `timeout_seconds` have passed.
+
+    :param watcher: Watcher, as returned by `open_watcher`
+    :type watcher: dict[str, object]
+    :param timeout_seconds: Maximum time to wait
+    :type timeout_seconds: float
+    :param wake_fd: Another file descriptor to wait on, e.g. one that is written to when a run finishes collecting.
+    :type wake_fd: Optional[int]
+    :return: Events that mean a scan is needed, or an empty list if the timeout was reached or `wake_fd` became readable. Keys: ['path', 'name', 'mask']
+    :rtype: list[dict[str, object]]
+    """
+    fds = [watcher['fd']] if wake_fd is None else [watcher['fd'], wake_fd]
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        remaining_seconds = deadline - time.monotonic()
+        if remaining_seconds <= 0:
+            return []
+        readable, _, _ = select.select(fds, [], [], remaining_seconds)
+        if not readable:
+            return []
+        run_events = [event for event in _read_events(watcher) if _is_run_event(watcher, event)] if watcher['fd'] in readable else []
+        if run_events or wake_fd in readable:
+            return run_events
@@ -0,0 +1,138 @@
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import os
+import time
+
+from pathlib import Path
+from typing import Iterator, Optional
+
+# The span that new spans are nested under. Set in each run collection thread by `span`.
+# Outside of a trace it is None, and spans are timed but not recorded anywhere.
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def _new_span(name: str, attributes: dict[str, object]) -> dict[str, object]:
+    """
+    Create a span. Keys: [name, attributes, timestamp_start, duration_seconds, bytes_processed, children]
+    """
+    span = {
+        'name': name,
+        'attributes': attributes,
+        'timestamp_start': datetime.datetime.now().astimezone().isoformat(),
+        'duration_seconds': None,
+        'bytes_processed': None,
+        'children': [],
+    }
+
+    return span
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> Iterator[dict[str, object]]:
+    """
+    Time a stage of collecting a run. The span is added to the children of the current span, and becomes
+    the current span until the stage is finished, so that spans opened inside it are nested under it.
+
+    Set `bytes_processed` on the span that is yielded, for stages that read data. If it isn't set, it is the
+    total of the span's children.
+
+    :param name: Name of the stage
+    :type name: str
+    :param attributes: Anything else to record with the span (e.g. demultiplexing_id). Must be JSON-serializable.
+    :return: Span. Keys: [name, attributes, timestamp_start, duration_seconds, bytes_processed, children]
+    :rtype: Iterator[dict[str, object]]
+    """
+    parent = current_span.get()
+    new_span = _new_span(name, attributes)
+    if parent is not None:
+        parent['children'].append(new_span)
+    token = current_span.set(new_span)
+    timestamp_start = time.perf_counter()
+    try:
+        yield new_span
+    finally:
+        new_span['duration_seconds'] = round(time.perf_counter() - timestamp_start, 4)
+        if new_span['bytes_processed'] is None:
+            children_bytes_processed = [child['bytes_processed'] for child in new_span['children'] if child['bytes_processed'] is not None]
+            if len(children_bytes_processed) > 0:
+                new_span['bytes_processed'] = sum(children_bytes_processed)
+        current_span.reset(token)
+
+
+def add_span(name: str, duration_seconds: float, bytes_processed: Optional[int] = None, **attributes):
+    """
+    Add a span for a stage that was timed somewhere else, e.g. a FASTQ file that was read in a pool worker,
+    to the children of the current span. Does nothing outside of a trace.
+
+    :param name: Name of the stage
+    :type name: str
+    :param duration_seconds: Duration of the stage
+    :type duration_seconds: float
+    :param bytes_processed: Number of bytes that the stage read
+    :type bytes_processed: Optional[int]
+    :param attributes: Anything else to record with the span. Must be JSON-serializable.
+    :return: None
+    :rtype: NoneType
+    """
+    parent = current_span.get()
+    if parent is None:
+        return
+    new_span = _new_span(name, attributes)
+    # The stage was timed elsewhere, so its start time isn't known.
+    new_span['timestamp_start'] = None
+    new_span['duration_seconds'] = duration_seconds
+    new_span['bytes_processed'] = bytes_processed
+    parent['children'].append(new_span)
+
+
+def _get_throughput_mb_per_second(bytes_processed: Optional[int], duration_seconds: Optional[float]) -> Optional[float]:
+    """
+    Throughput in MB (MiB) per second, or None if the span didn't read anything or took no time.
+    """
+    if not bytes_processed or not duration_seconds:
+        return None
+
+    return round(bytes_processed / 1024 / 1024 / duration_seconds, 2)
+
+
+def _span_to_profile(span: dict[str, object]) -> dict[str, object]:
+    """
+    Convert a span, and its children, to the form written to a collection profile.
+    """
+    span_profile = {
+        'name': span['name'],
+        **span['attributes'],
+        'timestamp_start': span['timestamp_start'],
+        'duration_seconds': span['duration_seconds'],
+        'bytes_processed': span['bytes_processed'],
+        'throughput_mb_per_second': _get_throughput_mb_per_second(span['bytes_processed'], span['duration_seconds']),
+    }
+    if len(span['children']) > 0:
+        span_profile['spans'] = [_span_to_profile(child) for child in span['children']]
+
+    return span_profile
+
+
+def write_collection_profile(root_span: dict[str, object], output_path: Path):
+    """
+    Write the spans recorded while collecting a run to a JSON file.
+
+    :param root_span: Outermost span of the run's trace, as yielded by `span`
+    :type root_span: dict[str, object]
+    :param output_path: Path to write the profile to
+    :type output_path: Path
+    :return: None
+    :rtype: NoneType
+    """
+    collection_profile = _span_to_profile(root_span)
+    with open(output_path, 'w') as f:
+        json.dump(collection_profile, f, indent=2)
+        f.write('\n')
+
+    logging.debug(json.dumps({
+        'event_type': 'collection_profile_written',
+        'collection_profile_path': os.path.abspath(output_path),
+    }))
@@ -29,8 +29,9 @@ def md5(file_path):
     :return: MD5 checksum
     :rtype: str
     """
+    file_hash = hashlib.md5()
     with open(file_path, 'rb') as f:
-        file_contents = f.read()
-        md5 = hashlib.md5(file_contents).hexdigest()
+        while chunk := f.read(1024 * 1024):
+            file_hash.update(chunk)
 
-    return md5
+    return file_hash.hexdigest()
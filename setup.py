@@ -13,6 +13,7 @@ setup(
         "jsonschema",
         "xmltodict==0.14.2",
         "interop==1.5.0",
+        "numpy",
         "pyfastx==2.2.0",
         "pytz==2023.3"
     ],
@@ -24,6 +25,9 @@ setup(
         'console_scripts': [
             "sequencing-runs-collector = sequencing_runs_collector.__main__:main",
             "collect-single-run = sequencing_runs_collector.collect_single_run:main",
+            "invalidate-fastq-stats-cache = sequencing_runs_collector.fastq_stats_cache:main",
+            "recompute-quality-metrics = sequencing_runs_collector.recompute_quality_metrics:main",
+            "reset-run-state = sequencing_runs_collector.run_state:main",
         ],
     }
 )
@@ -0,0 +1,53 @@
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import sequencing_runs_collector.fastq_checksums as fastq_checksums
+import sequencing_runs_collector.illumina as illumina
+
+FASTQ_DATA = b'@read1\nACGT\n+\nFFFF\n@read2\nTTGCA\n+\nFF:F,\n'
+
+
+class TestFindExistingChecksum(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fastq_path = os.path.join(self.tmp_dir, 'sample_S1_L001_R1_001.fastq.gz')
+        with open(self.fastq_path, 'wb') as f:
+            f.write(gzip.compress(FASTQ_DATA, mtime=0))
+        with open(self.fastq_path, 'rb') as f:
+            self.fastq_bytes = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_sidecar(self, extension, checksum):
+        with open(self.fastq_path + extension, 'w') as f:
+            f.write(f"{checksum}  {os.path.basename(self.fastq_path)}\n")
+
+    def test_sidecar_for_configured_algorithm_is_used(self):
+        sha256 = hashlib.sha256(self.fastq_bytes).hexdigest()
+        self.write_sidecar('.sha256', sha256)
+
+        existing_checksum = fastq_checksums.find_existing_checksum(self.fastq_path, 'sha256')
+
+        self.assertEqual(existing_checksum['checksum'], sha256)
+        self.assertEqual(existing_checksum['checksum_source'], 'sidecar')
+
+    def test_sidecar_for_other_algorithm_is_ignored(self):
+        self.write_sidecar('.sha256', hashlib.sha256(self.fastq_bytes).hexdigest())
+
+        self.assertIsNone(fastq_checksums.find_existing_checksum(self.fastq_path, 'md5'))
+
+        fastq_stats = illumina.get_fastq_stats(self.fastq_path, 'sample', 'R1', hash_algorithm='md5')['fastq_stats']
+
+        self.assertEqual(fastq_stats['fastq_md5_r1'], hashlib.md5(self.fastq_bytes).hexdigest())
+        self.assertEqual(fastq_stats['fastq_checksum_algorithm_r1'], 'md5')
+        self.assertEqual(fastq_stats['fastq_checksum_source_r1'], 'computed')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+import gzip
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+import sequencing_runs_collector.fastq_stats as fastq_stats_engine
+import sequencing_runs_collector.illumina as illumina
+
+# Every quality score from 0 to 41. '@' (Q31) is included, as a quality line starting with it looks like a header line.
+QUALITY_CHARS = ''.join(chr(33 + q) for q in range(42))
+COUNT_FIELDS = ['num_reads', 'num_bases', 'num_bases_over_q30', 'num_bases_over_q30_last_n']
+# Small blocks and chunks, so that a small file is split into many chunks, with records split across them.
+BGZF_BLOCK_SIZE_BYTES = 500
+BGZF_EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+CHUNK_SIZE_BYTES = 4096
+MAX_CHUNKS_IN_FLIGHT = 3
+# Vary from run to run, so aren't compared.
+TIMING_FIELDS = ['duration_seconds', 'chunk_worker_seconds']
+
+
+def random_fastq(rng, num_reads, min_read_length=1, max_read_length=151, line_ending='\n'):
+    """
+    Random FASTQ records. Some reads are shorter than the 25 bases at the end of each read that are counted separately.
+    """
+    records = []
+    for read_num in range(num_reads):
+        read_length = rng.randint(min_read_length, max_read_length)
+        seq = ''.join(rng.choices('ACGTN', k=read_length))
+        qual = ''.join(rng.choices(QUALITY_CHARS, k=read_length))
+        records.append(line_ending.join([f"@read{read_num} 1:N:0:1", seq, '+', qual]) + line_ending)
+
+    return ''.join(records).encode('ascii')
+
+
+def bgzf_compress(fastq_data):
+    """
+    Compress data as BGZF: a series of small gzip members, each with its compressed size in a 'BC' extra field.
+    """
+    blocks = []
+    for offset in range(0, len(fastq_data), BGZF_BLOCK_SIZE_BYTES):
+        block_data = fastq_data[offset:offset + BGZF_BLOCK_SIZE_BYTES]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed_block_data = compressor.compress(block_data) + compressor.flush()
+        block_size = 18 + len(compressed_block_data) + 8
+        header = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', block_size - 1)
+        blocks.append(header + compressed_block_data + struct.pack('<II', zlib.crc32(block_data), len(block_data)))
+    blocks.append(BGZF_EOF_BLOCK)
+
+    return b''.join(blocks)
+
+
+def multi_member_gzip_compress(fastq_data, rng):
+    """
+    Compress data as several gzip members, split at random points, as if the file had been written in pieces.
+    """
+    split_offsets = sorted(rng.sample(range(1, len(fastq_data)), 10))
+    pieces = [fastq_data[start:end] for start, end in zip([0] + split_offsets, split_offsets + [len(fastq_data)])]
+
+    return b''.join(gzip.compress(piece) for piece in pieces)
+
+
+def count_quality_legacy(fastq_data):
+    """
+    The original per-base loop from `illumina.get_fastq_stats`, for comparison.
+    """
+    lines = fastq_data.decode('ascii').splitlines()
+    num_reads = 0
+    num_bases = 0
+    num_bases_over_q30 = 0
+    num_bases_over_q30_last_25 = 0
+    for seq, qual in zip(lines[1::4], lines[3::4]):
+        for q in qual:
+            phred_quality = ord(q) - 33
+            if phred_quality >= 30:
+                num_bases_over_q30 += 1
+        for q in qual[-25:]:
+            phred_quality = ord(q) - 33
+            if phred_quality >= 30:
+                num_bases_over_q30_last_25 += 1
+        num_reads += 1
+        num_bases += len(seq)
+
+    return {
+        'num_reads': num_reads,
+        'num_bases': num_bases,
+        'num_bases_over_q30': num_bases_over_q30,
+        'num_bases_over_q30_last_n': num_bases_over_q30_last_25,
+    }
+
+
+class TestCollectFastqStats(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rng = random.Random(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_fastq(self, fastq_data, compressed=True):
+        fastq_path = os.path.join(self.tmp_dir, 'sample_S1_L001_R1_001.fastq' + ('.gz' if compressed else ''))
+        with open(fastq_path, 'wb') as f:
+            f.write(gzip.compress(fastq_data) if compressed else fastq_data)
+
+        return fastq_path
+
+    def collect_counts(self, fastq_path, **kwargs):
+        fastq_stats = fastq_stats_engine.collect_fastq_stats(fastq_path, **kwargs)
+
+        return {field: fastq_stats[field] for field in COUNT_FIELDS}
+
+    def test_matches_legacy_loop(self):
+        fastq_data = random_fastq(self.rng, 2000)
+        expected_counts = count_quality_legacy(fastq_data)
+
+        for compressed in [True, False]:
+            fastq_path = self.write_fastq(fastq_data, compressed)
+            with self.subTest(compressed=compressed):
+                self.assertEqual(self.collect_counts(fastq_path), expected_counts)
+            # Batch boundaries don't change the counts.
+            with self.subTest(compressed=compressed, batch_size=7):
+                self.assertEqual(self.collect_counts(fastq_path, batch_size=7), expected_counts)
+
+    def test_reads_shorter_than_last_bases(self):
+        fastq_data = random_fastq(self.rng, 500, max_read_length=24)
+        fastq_path = self.write_fastq(fastq_data)
+
+        counts = self.collect_counts(fastq_path)
+
+        self.assertEqual(counts, count_quality_legacy(fastq_data))
+        self.assertEqual(counts['num_bases_over_q30_last_n'], counts['num_bases_over_q30'])
+
+    def test_crlf_line_endings(self):
+        fastq_data = random_fastq(self.rng, 500, line_ending='\r\n')
+        fastq_path = self.write_fastq(fastq_data)
+
+        counts = self.collect_counts(fastq_path)
+
+        self.assertEqual(counts, count_quality_legacy(fastq_data))
+        self.assertEqual(counts, count_quality_legacy(fastq_data.replace(b'\r', b'')))
+
+    def test_empty_file(self):
+        for compressed in [True, False]:
+            fastq_path = self.write_fastq(b'', compressed)
+            with self.subTest(compressed=compressed):
+                fastq_stats = fastq_stats_engine.collect_fastq_stats(fastq_path)
+                self.assertEqual({field: fastq_stats[field] for field in COUNT_FIELDS}, dict.fromkeys(COUNT_FIELDS, 0))
+                self.assertEqual(sum(fastq_stats['quality_histogram']), 0)
+                self.assertIsNone(fastq_stats['mean_read_length'])
+
+    def test_no_last_bases(self):
+        fastq_data = random_fastq(self.rng, 500)
+        fastq_path = self.write_fastq(fastq_data)
+
+        fastq_stats = fastq_stats_engine.collect_fastq_stats(fastq_path, num_last_bases=0)
+
+        self.assertEqual(fastq_stats['num_bases_over_q30'], count_quality_legacy(fastq_data)['num_bases_over_q30'])
+        self.assertEqual(fastq_stats['num_bases_over_q30_last_n'], 0)
+        self.assertEqual(sum(fastq_stats['quality_histogram_last_n']), 0)
+        self.assertEqual(fastq_stats['num_last_bases'], 0)
+
+    def test_count_quality_batch_with_no_last_bases(self):
+        quals = [b'FFFF', b'#', b'F,F']
+        for count_histograms in [False, True]:
+            with self.subTest(count_histograms=count_histograms):
+                counts = fastq_stats_engine.count_quality_batch(quals, num_last_bases=0, count_histograms=count_histograms)
+                self.assertEqual(counts['num_bases_over_q30'], 6)
+                self.assertEqual(counts['num_bases_over_q30_last_n'], 0)
+
+
+class TestCollectCountsChunked(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = illumina.new_fastq_stats_pool(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+        cls.pool.join()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rng = random.Random(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_chunked_matches_sequential(self, compressed_fastq_data, fastq_data):
+        fastq_path = os.path.join(self.tmp_dir, 'sample_S1_L001_R1_001.fastq.gz')
+        with open(fastq_path, 'wb') as f:
+            f.write(compressed_fastq_data)
+
+        for num_last_bases in [fastq_stats_engine.NUM_LAST_BASES, 0]:
+            with self.subTest(num_last_bases=num_last_bases):
+                fastq_stats_sequential = fastq_stats_engine.collect_fastq_stats(fastq_path, num_last_bases=num_last_bases)
+                fastq_stats_chunked = fastq_stats_engine.collect_fastq_stats(
+                    fastq_path,
+                    num_last_bases=num_last_bases,
+                    pool=self.pool,
+                    chunk_size_bytes=CHUNK_SIZE_BYTES,
+                    max_chunks_in_flight=MAX_CHUNKS_IN_FLIGHT,
+                )
+                self.assertIn('chunk_worker_seconds', fastq_stats_chunked)
+                for field in TIMING_FIELDS:
+                    fastq_stats_sequential.pop(field, None)
+                    fastq_stats_chunked.pop(field, None)
+                self.assertEqual(fastq_stats_chunked, fastq_stats_sequential)
+        legacy_counts = count_quality_legacy(fastq_data)
+        self.assertEqual({field: fastq_stats_chunked[field] for field in COUNT_FIELDS[:3]}, {field: legacy_counts[field] for field in COUNT_FIELDS[:3]})
+
+    def test_bgzf(self):
+        fastq_data = random_fastq(self.rng, 2000)
+        compressed_fastq_data = bgzf_compress(fastq_data)
+        self.assertIsNotNone(fastq_stats_engine._bgzf_block_size(compressed_fastq_data, 0))
+
+        self.assert_chunked_matches_sequential(compressed_fastq_data, fastq_data)
+
+    def test_multi_member_gzip(self):
+        fastq_data = random_fastq(self.rng, 2000)
+
+        self.assert_chunked_matches_sequential(multi_member_gzip_compress(fastq_data, self.rng), fastq_data)
+
+    def test_multi_member_gzip_with_crlf_line_endings(self):
+        fastq_data = random_fastq(self.rng, 2000, line_ending='\r\n')
+
+        self.assert_chunked_matches_sequential(multi_member_gzip_compress(fastq_data, self.rng), fastq_data)
+
+    def test_empty_file(self):
+        self.assert_chunked_matches_sequential(gzip.compress(b''), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
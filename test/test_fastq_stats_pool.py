@@ -0,0 +1,109 @@
+import gzip
+import multiprocessing.pool
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import sequencing_runs_collector.core as core
+import sequencing_runs_collector.illumina as illumina
+import sequencing_runs_collector.metrics as metrics
+
+CONFIG = {
+    'collect_fastq_stats': True,
+    'num_fastq_stats_collection_processes': 2,
+    'fastq_stats_max_tasks_per_worker': 1,
+}
+
+
+class TestUpdateFastqStatsPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fastq_stats_pool = None
+
+    def tearDown(self):
+        core.close_fastq_stats_pool(self.fastq_stats_pool)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_workers_are_not_forked_from_the_daemon(self):
+        self.fastq_stats_pool = core.update_fastq_stats_pool(None, CONFIG)
+
+        self.assertEqual(self.fastq_stats_pool['pool']._ctx.get_start_method(), 'forkserver')
+
+    def test_pool_collects_fastq_stats(self):
+        fastq_path = os.path.join(self.tmp_dir, 'LIB01_S1_L001_R1_001.fastq.gz')
+        with open(fastq_path, 'wb') as f:
+            f.write(gzip.compress(b'@read\nACGT\n+\nFFF,\n' * 1000))
+        self.fastq_stats_pool = core.update_fastq_stats_pool(None, CONFIG)
+        fastq_stats_task = {
+            'task_type': 'single',
+            'library_id': 'LIB01',
+            'read_type': 'R1',
+            'fastq_path': fastq_path,
+            'hash_algorithm': 'md5',
+            'reader_backend': illumina.fastq_stats_engine.DEFAULT_READER_BACKEND,
+        }
+
+        # More tasks than workers, so that workers are replaced after their one task.
+        fastq_stats = list(self.fastq_stats_pool['pool'].imap(illumina._run_fastq_stats_task, [fastq_stats_task] * 3))
+
+        for (fastq_stat,) in fastq_stats:
+            self.assertEqual(fastq_stat['counts']['num_reads'], 1000)
+            self.assertEqual(fastq_stat['fastq_stats']['q30_percent_r1'], 75.0)
+
+    def test_unchanged_config_keeps_pool(self):
+        self.fastq_stats_pool = core.update_fastq_stats_pool(None, CONFIG)
+
+        self.assertIs(core.update_fastq_stats_pool(self.fastq_stats_pool, CONFIG), self.fastq_stats_pool)
+
+
+class TestImapUnorderedBounded(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = multiprocessing.pool.ThreadPool(3)
+        self.finished_tasks = []
+        self.finished_tasks_lock = threading.Lock()
+
+    def tearDown(self):
+        self.pool.close()
+        self.pool.join()
+
+    def run_task(self, task):
+        """
+        Fail straight away for a negative task, otherwise take a while to finish.
+        """
+        if task < 0:
+            raise ValueError(f"Task failed: {task}")
+        time.sleep(0.2)
+        with self.finished_tasks_lock:
+            self.finished_tasks.append(task)
+
+        return task
+
+    def get_tasks_in_flight(self):
+        return metrics._metric_values.get('fastq_stats_tasks_in_flight', 0)
+
+    def test_failed_task_waits_for_tasks_in_flight(self):
+        tasks_in_flight = self.get_tasks_in_flight()
+        results = illumina._imap_unordered_bounded(self.pool, self.run_task, [-1, 1, 2, 3, 4], 3)
+
+        with self.assertRaises(ValueError):
+            list(results)
+
+        self.assertEqual(self.get_tasks_in_flight(), tasks_in_flight)
+        self.assertEqual(sorted(self.finished_tasks), [1, 2])
+
+    def test_all_results(self):
+        tasks_in_flight = self.get_tasks_in_flight()
+
+        results = illumina._imap_unordered_bounded(self.pool, self.run_task, [1, 2, 3, 4], 2)
+
+        self.assertEqual(sorted(results), [1, 2, 3, 4])
+        self.assertEqual(self.get_tasks_in_flight(), tasks_in_flight)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from unittest import mock
+
+import sequencing_runs_collector.core as core
+import sequencing_runs_collector.illumina as illumina
+import sequencing_runs_collector.run_state as run_state
+
+RUN_ID = '240101_VH00123_1_AAAA00001'
+DEMULTIPLEXING_ID = RUN_ID + '-DEMUX-1'
+AN_HOUR_AGO = time.time() - 3600
+
+
+class TestNewDemultiplexingChecks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_parent_dir = os.path.join(self.tmp_dir, 'runs')
+        self.run_dir = os.path.join(self.run_parent_dir, RUN_ID)
+        self.add_demultiplexing(1)
+        self.config = {
+            'run_parent_dirs': [self.run_parent_dir],
+            'output_directory': os.path.join(self.tmp_dir, 'output'),
+        }
+        self.run_output_dir = os.path.join(self.config['output_directory'], 'illumina', RUN_ID)
+        os.makedirs(os.path.join(self.run_output_dir, 'demultiplexings', DEMULTIPLEXING_ID))
+        self.run_state_conn = run_state.open_run_state(run_state.IN_MEMORY_RUN_STATE_PATH)
+
+    def tearDown(self):
+        self.run_state_conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def add_demultiplexing(self, demultiplexing_num):
+        """
+        Add a NextSeq demultiplexing, whose FASTQ directory was last modified an hour ago, so that it has settled.
+        """
+        data_dir = os.path.join(self.run_dir, 'Analysis', str(demultiplexing_num), 'Data')
+        os.makedirs(os.path.join(data_dir, 'fastq'))
+        open(os.path.join(data_dir, 'SampleSheet.csv'), 'w').close()
+        os.utime(os.path.join(data_dir, 'fastq'), (AN_HOUR_AGO, AN_HOUR_AGO))
+        # Older than the mtime resolution allowed for (see `run_state.PARENT_DIR_MTIME_RESOLUTION_NS`).
+        timestamp_modified = AN_HOUR_AGO + demultiplexing_num
+        os.utime(os.path.join(self.run_dir, 'Analysis'), (timestamp_modified, timestamp_modified))
+
+    def scan(self):
+        """
+        Scan for runs, and return the queued run IDs and the IDs of the runs that were checked for demultiplexings.
+        """
+        with mock.patch.object(illumina, 'find_demultiplexings', wraps=illumina.find_demultiplexings) as find_demultiplexings:
+            queued_run_ids = [run['run_id'] for run in core.find_runs(self.config, self.run_state_conn) if run is not None]
+        checked_run_ids = [call.args[0] for call in find_demultiplexings.call_args_list]
+
+        return queued_run_ids, checked_run_ids
+
+    def test_run_collected_long_ago_is_not_checked(self):
+        timestamp_collected = time.time() - 60 * 24 * 60 * 60
+        os.utime(self.run_output_dir, (timestamp_collected, timestamp_collected))
+        self.scan()
+        self.add_demultiplexing(2)
+
+        self.assertEqual(self.scan(), ([], []))
+
+    def test_unchanged_run_is_only_checked_once(self):
+        self.scan()
+        self.assertEqual(self.scan(), ([], [RUN_ID]))
+        self.assertEqual(self.scan(), ([], []))
+
+        self.add_demultiplexing(2)
+
+        self.assertEqual(self.scan(), ([RUN_ID], [RUN_ID]))
+
+    def test_unsettled_demultiplexing_is_checked_until_it_settles(self):
+        self.scan()
+        self.scan()
+        self.add_demultiplexing(2)
+        os.utime(os.path.join(self.run_dir, 'Analysis', '2', 'Data', 'fastq'))
+
+        self.assertEqual(self.scan(), ([], [RUN_ID]))
+        self.assertEqual(self.scan(), ([], [RUN_ID]))
+
+        os.utime(os.path.join(self.run_dir, 'Analysis', '2', 'Data', 'fastq'), (AN_HOUR_AGO, AN_HOUR_AGO))
+
+        self.assertEqual(self.scan(), ([RUN_ID], [RUN_ID]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import sequencing_runs_collector.illumina as illumina
+import sequencing_runs_collector.parsers.samplesheet as samplesheet_parser
+
+SAMPLESHEET = """[Header]
+FileFormatVersion,2
+RunName,test
+InstrumentPlatform,NextSeq1k2k
+InstrumentType,NextSeq2000
+
+[Reads]
+Read1Cycles,4
+Read2Cycles,4
+
+[BCLConvert_Settings]
+SoftwareVersion,3.10.12
+
+[BCLConvert_Data]
+Sample_ID,Index,Index2
+LIB01,AAAAAAAAAA,CCCCCCCCCC
+
+[Cloud_Data]
+Sample_ID,ProjectName,LibraryName
+LIB01,project1,LIB01
+"""
+
+
+def write_fastq(fastq_path, read_ids, qual='FFF,'):
+    """
+    Write a gzipped FASTQ file with one read for each read ID.
+    """
+    records = ''.join(f"@{read_id}\nACGT\n+\n{qual}\n" for read_id in read_ids)
+    with open(fastq_path, 'wb') as f:
+        f.write(gzip.compress(records.encode('ascii')))
+
+
+class TestGetPairedFastqStats(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fastq_path_r1 = os.path.join(self.tmp_dir, 'LIB01_S1_L001_R1_001.fastq.gz')
+        self.fastq_path_r2 = os.path.join(self.tmp_dir, 'LIB01_S1_L001_R2_001.fastq.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_each_file_has_stats(self, fastq_stats_summaries, num_reads_r1, num_reads_r2):
+        fastq_stats_r1, fastq_stats_r2 = fastq_stats_summaries
+        self.assertEqual(fastq_stats_r1['counts']['num_reads'], num_reads_r1)
+        self.assertEqual(fastq_stats_r2['counts']['num_reads'], num_reads_r2)
+        self.assertEqual(fastq_stats_r1['fastq_stats']['q30_percent_r1'], 75.0)
+        self.assertEqual(fastq_stats_r2['fastq_stats']['q30_percent_r2'], 75.0)
+        self.assertIsNotNone(fastq_stats_r1['fastq_stats']['fastq_checksum_r1'])
+        self.assertIsNotNone(fastq_stats_r2['fastq_stats']['fastq_checksum_r2'])
+
+    def test_paired_files_have_no_pairing_error(self):
+        write_fastq(self.fastq_path_r1, ['read1 1:N:0', 'read2 1:N:0'])
+        write_fastq(self.fastq_path_r2, ['read1 2:N:0', 'read2 2:N:0'])
+
+        fastq_stats_summaries = illumina.get_paired_fastq_stats(self.fastq_path_r1, self.fastq_path_r2, 'LIB01')
+
+        self.assert_each_file_has_stats(fastq_stats_summaries, 2, 2)
+        for fastq_stats_summary in fastq_stats_summaries:
+            self.assertNotIn('pairing_error', fastq_stats_summary)
+
+    def test_different_numbers_of_reads_keeps_each_files_stats(self):
+        write_fastq(self.fastq_path_r1, ['read1', 'read2', 'read3'])
+        write_fastq(self.fastq_path_r2, ['read1', 'read2'])
+
+        fastq_stats_summaries = illumina.get_paired_fastq_stats(self.fastq_path_r1, self.fastq_path_r2, 'LIB01')
+
+        self.assert_each_file_has_stats(fastq_stats_summaries, 3, 2)
+        for fastq_stats_summary in fastq_stats_summaries:
+            self.assertIn('different numbers of reads', fastq_stats_summary['pairing_error'])
+
+    def test_mismatched_read_ids_keeps_each_files_stats(self):
+        write_fastq(self.fastq_path_r1, ['read1', 'read2'])
+        write_fastq(self.fastq_path_r2, ['read1', 'read3'])
+
+        fastq_stats_summaries = illumina.get_paired_fastq_stats(self.fastq_path_r1, self.fastq_path_r2, 'LIB01')
+
+        self.assert_each_file_has_stats(fastq_stats_summaries, 2, 2)
+        for fastq_stats_summary in fastq_stats_summaries:
+            self.assertIsNotNone(fastq_stats_summary['pairing_error'])
+
+    def test_truncated_r2_keeps_r1_stats(self):
+        write_fastq(self.fastq_path_r1, ['read1', 'read2'])
+        write_fastq(self.fastq_path_r2, ['read1', 'read2'])
+        with open(self.fastq_path_r2, 'rb') as f:
+            fastq_bytes_r2 = f.read()
+        with open(self.fastq_path_r2, 'wb') as f:
+            f.write(fastq_bytes_r2[:len(fastq_bytes_r2) // 2])
+
+        fastq_stats_r1, fastq_stats_r2 = illumina.get_paired_fastq_stats(self.fastq_path_r1, self.fastq_path_r2, 'LIB01')
+
+        self.assertEqual(fastq_stats_r1['counts']['num_reads'], 2)
+        self.assertEqual(fastq_stats_r1['fastq_stats']['q30_percent_r1'], 75.0)
+        self.assertIsNone(fastq_stats_r2['counts'])
+        self.assertIsNotNone(fastq_stats_r1['pairing_error'])
+        self.assertEqual(fastq_stats_r2['pairing_error'], fastq_stats_r1['pairing_error'])
+
+
+class TestPairingErrorInSequencedLibraries(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.demultiplexing_output_dir = os.path.join(self.tmp_dir, 'Analysis', '1')
+        self.fastq_dir = os.path.join(self.demultiplexing_output_dir, 'Data', 'fastq')
+        os.makedirs(self.fastq_dir)
+        samplesheet_path = os.path.join(self.demultiplexing_output_dir, 'Data', 'SampleSheet.csv')
+        with open(samplesheet_path, 'w') as f:
+            f.write(SAMPLESHEET)
+        self.samplesheet = samplesheet_parser.parse_samplesheet(samplesheet_path, 'ILLUMINA', 'NEXTSEQ')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_sequenced_library(self):
+        sequenced_libraries = illumina.get_sequenced_libraries_from_samplesheet(self.samplesheet, 'NEXTSEQ', self.demultiplexing_output_dir, {}, collect_fastq_stats=True)
+        self.assertEqual(len(sequenced_libraries), 1)
+
+        return sequenced_libraries[0]
+
+    def test_paired_library_has_combined_stats(self):
+        write_fastq(os.path.join(self.fastq_dir, 'LIB01_S1_L001_R1_001.fastq.gz'), ['read1', 'read2'])
+        write_fastq(os.path.join(self.fastq_dir, 'LIB01_S1_L001_R2_001.fastq.gz'), ['read1', 'read2'])
+
+        sequenced_library = self.get_sequenced_library()
+
+        self.assertIsNone(sequenced_library['pairing_error'])
+        self.assertEqual(sequenced_library['num_reads'], 4)
+        self.assertEqual(sequenced_library['q30_percent'], 75.0)
+
+    def test_unpaired_library_has_only_each_files_stats(self):
+        write_fastq(os.path.join(self.fastq_dir, 'LIB01_S1_L001_R1_001.fastq.gz'), ['read1', 'read2', 'read3'])
+        write_fastq(os.path.join(self.fastq_dir, 'LIB01_S1_L001_R2_001.fastq.gz'), ['read1', 'read2'])
+
+        sequenced_library = self.get_sequenced_library()
+
+        self.assertIn('different numbers of reads', sequenced_library['pairing_error'])
+        self.assertEqual(sequenced_library['q30_percent_r1'], 75.0)
+        self.assertEqual(sequenced_library['q30_percent_r2'], 75.0)
+        self.assertIsNotNone(sequenced_library['fastq_checksum_r1'])
+        self.assertIsNotNone(sequenced_library['fastq_checksum_r2'])
+        for field in ['num_reads', 'num_bases', 'q30_percent', 'q30_percent_last_25_bases']:
+            self.assertIsNone(sequenced_library[field], field)
+
+
+if __name__ == '__main__':
+    unittest.main()
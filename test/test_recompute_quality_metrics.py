@@ -0,0 +1,114 @@
+import gzip
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import sequencing_runs_collector.core as core
+import sequencing_runs_collector.illumina as illumina
+import sequencing_runs_collector.parsers.samplesheet as samplesheet_parser
+import sequencing_runs_collector.recompute_quality_metrics as recompute_quality_metrics
+
+LIBRARY_IDS = ['LIB01', 'LIB02']
+SAMPLESHEET = """[Header]
+FileFormatVersion,2
+RunName,test
+InstrumentPlatform,NextSeq1k2k
+InstrumentType,NextSeq2000
+
+[Reads]
+Read1Cycles,30
+Read2Cycles,30
+
+[BCLConvert_Settings]
+SoftwareVersion,3.10.12
+
+[BCLConvert_Data]
+Sample_ID,Index,Index2
+LIB01,AAAAAAAAAA,CCCCCCCCCC
+LIB02,GGGGGGGGGG,TTTTTTTTTT
+
+[Cloud_Data]
+Sample_ID,ProjectName,LibraryName
+LIB01,project1,LIB01
+LIB02,project1,LIB02
+"""
+QUALITY_COLLECTED_FIELDS = [
+    'q30_percent_r1',
+    'q30_percent_last_25_bases_r1',
+    'q30_percent_r2',
+    'q30_percent_last_25_bases_r2',
+    'q30_percent',
+    'q30_percent_last_25_bases',
+]
+
+
+def write_fastq(fastq_path, num_reads, min_read_length, max_read_length, rng):
+    """
+    Write a gzipped FASTQ file with random read lengths and quality scores.
+    """
+    records = []
+    for read_num in range(num_reads):
+        read_length = rng.randint(min_read_length, max_read_length)
+        seq = ''.join(rng.choices('ACGT', k=read_length))
+        qual = ''.join(rng.choices('#,:F', k=read_length))
+        records.append(f"@read{read_num}\n{seq}\n+\n{qual}\n")
+    with open(fastq_path, 'wb') as f:
+        f.write(gzip.compress(''.join(records).encode('ascii')))
+
+
+class TestRecomputeQualityMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def collect_libraries(self, min_read_length, max_read_length):
+        """
+        Collect the sequenced libraries of a NextSeq demultiplexing, with FASTQ statistics.
+        """
+        rng = random.Random(0)
+        demultiplexing_output_dir = os.path.join(self.tmp_dir, 'Analysis', '1')
+        fastq_dir = os.path.join(demultiplexing_output_dir, 'Data', 'fastq')
+        os.makedirs(fastq_dir)
+        samplesheet_path = os.path.join(demultiplexing_output_dir, 'Data', 'SampleSheet.csv')
+        with open(samplesheet_path, 'w') as f:
+            f.write(SAMPLESHEET)
+        for sample_number, library_id in enumerate(LIBRARY_IDS, 1):
+            for read_type_num in [1, 2]:
+                write_fastq(os.path.join(fastq_dir, f"{library_id}_S{sample_number}_L001_R{read_type_num}_001.fastq.gz"), 500, min_read_length, max_read_length, rng)
+        samplesheet = samplesheet_parser.parse_samplesheet(samplesheet_path, 'ILLUMINA', 'NEXTSEQ')
+
+        return illumina.get_sequenced_libraries_from_samplesheet(samplesheet, 'NEXTSEQ', demultiplexing_output_dir, {}, collect_fastq_stats=True)
+
+    def recompute(self, sequenced_libraries):
+        quality_histograms_path = os.path.join(self.tmp_dir, 'quality_histograms.csv')
+        core.write_quality_histograms(sequenced_libraries, quality_histograms_path)
+        quality_histograms_by_library_id = recompute_quality_metrics.load_quality_histograms(quality_histograms_path)
+        quality_metrics = recompute_quality_metrics.recompute_quality_metrics(quality_histograms_by_library_id, [30])
+
+        return {library_quality_metrics['library_id']: library_quality_metrics for library_quality_metrics in quality_metrics}
+
+    def assert_recomputed_q30_matches_collected(self, min_read_length, max_read_length):
+        sequenced_libraries = self.collect_libraries(min_read_length, max_read_length)
+        quality_metrics_by_library_id = self.recompute(sequenced_libraries)
+
+        self.assertEqual(sorted(quality_metrics_by_library_id), LIBRARY_IDS)
+        for sequenced_library in sequenced_libraries:
+            library_quality_metrics = quality_metrics_by_library_id[sequenced_library['library_id']]
+            for field in QUALITY_COLLECTED_FIELDS:
+                self.assertIsNotNone(sequenced_library[field], field)
+                self.assertEqual(library_quality_metrics[field], sequenced_library[field], field)
+
+    def test_recomputed_q30_matches_collected(self):
+        self.assert_recomputed_q30_matches_collected(30, 30)
+
+    def test_recomputed_q30_matches_collected_for_reads_shorter_than_25_bases(self):
+        self.assert_recomputed_q30_matches_collected(10, 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+import sequencing_runs_collector.core as core
+import sequencing_runs_collector.run_scheduler as run_scheduler
+import sequencing_runs_collector.run_staging as run_staging
+import sequencing_runs_collector.run_state as run_state
+
+RUN_ID = '240101_M00123_0001_000000000-A1B2C'
+
+
+def fake_collect_illumina_run(demultiplexing_ids):
+    """
+    Stand-in for `core.collect_illumina_run`, for a run with the given demultiplexings.
+    """
+    def collect_illumina_run(config, run, fastq_stats_pool=None, checkpoint_dir=None, skip_demultiplexing_ids=None):
+        skip_demultiplexing_ids = skip_demultiplexing_ids or set()
+        collected_run = {
+            'sequencing_run_id': run['run_id'],
+            'demultiplexings': [
+                {'demultiplexing_id': demultiplexing_id, 'sequenced_libraries': []}
+                for demultiplexing_id in demultiplexing_ids
+                if demultiplexing_id not in skip_demultiplexing_ids
+            ],
+        }
+        return collected_run
+
+    return collect_illumina_run
+
+
+def finish_run(run_state_conn, outcome):
+    """
+    Record a run's outcome, as the main loop does once its collection thread has finished.
+    """
+    future = concurrent.futures.Future()
+    future.set_result(outcome)
+    run_scheduler.finish_completed_runs({outcome['run_id']: {'future': future}}, run_state_conn)
+
+
+class TestCollectAndWriteRun(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {'output_directory': os.path.join(self.tmp_dir, 'output')}
+        self.run = {
+            'run_id': RUN_ID,
+            'instrument_type': 'ILLUMINA',
+            'instrument_model': 'MISEQ',
+            'run_dir': os.path.join(self.tmp_dir, 'runs', RUN_ID),
+            'collected_demultiplexing_ids': [],
+        }
+        self.run_output_dir = os.path.join(self.config['output_directory'], 'illumina', RUN_ID)
+        self.run_state_conn = run_state.open_run_state(run_state.IN_MEMORY_RUN_STATE_PATH)
+        run_state.add_run(self.run_state_conn, self.run, os.path.join(self.tmp_dir, 'runs'), 'collecting')
+
+    def tearDown(self):
+        self.run_state_conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def collect_and_write_run(self, demultiplexing_ids):
+        run = dict(self.run, collected_demultiplexing_ids=sorted(run_state.get_collected_demultiplexing_ids(self.run_state_conn, RUN_ID)))
+        with mock.patch.object(core, 'collect_illumina_run', side_effect=fake_collect_illumina_run(demultiplexing_ids)) as collect_illumina_run:
+            outcome = run_scheduler.collect_and_write_run(self.config, run, None, 'correlation_id')
+
+        return outcome, collect_illumina_run
+
+    def test_crash_after_publish_before_state_update(self):
+        outcome, _ = self.collect_and_write_run(['1'])
+        self.assertEqual(outcome['status'], 'collected')
+        # The collector stops before `finish_completed_runs` records the outcome, and the run is reset on startup.
+        self.assertEqual(run_state.reset_interrupted_runs(self.run_state_conn), 1)
+        self.assertEqual(run_state.get_collected_demultiplexing_ids(self.run_state_conn, RUN_ID), set())
+
+        run_state.set_run_status(self.run_state_conn, RUN_ID, 'collecting')
+        outcome, collect_illumina_run = self.collect_and_write_run(['1'])
+
+        self.assertEqual(outcome['status'], 'collected', outcome['error'])
+        self.assertEqual(outcome['demultiplexing_ids'], ['1'])
+        self.assertEqual(collect_illumina_run.call_args.args[4], {'1'})
+        self.assertEqual(core.get_written_demultiplexing_ids(self.run_output_dir), {'1'})
+        self.assertFalse(os.path.exists(run_staging.get_run_staging_dir(self.config['output_directory'], self.run)))
+        finish_run(self.run_state_conn, outcome)
+        self.assertEqual(run_state.get_runs(self.run_state_conn, ['collected'], [os.path.join(self.tmp_dir, 'runs')])[0]['run_id'], RUN_ID)
+        self.assertEqual(run_state.get_collected_demultiplexing_ids(self.run_state_conn, RUN_ID), {'1'})
+
+    def test_crash_after_incremental_publish_before_state_update(self):
+        outcome, _ = self.collect_and_write_run(['1'])
+        finish_run(self.run_state_conn, outcome)
+        outcome, _ = self.collect_and_write_run(['1', '2'])
+        self.assertEqual(outcome['status'], 'collected', outcome['error'])
+        # The collector stops before the new demultiplexing is recorded.
+        self.assertEqual(run_state.get_collected_demultiplexing_ids(self.run_state_conn, RUN_ID), {'1'})
+
+        outcome, collect_illumina_run = self.collect_and_write_run(['1', '2'])
+
+        self.assertEqual(outcome['status'], 'collected', outcome['error'])
+        self.assertEqual(collect_illumina_run.call_args.args[4], {'1', '2'})
+        finish_run(self.run_state_conn, outcome)
+        self.assertEqual(run_state.get_collected_demultiplexing_ids(self.run_state_conn, RUN_ID), {'1', '2'})
+        self.assertEqual(core.get_written_demultiplexing_ids(self.run_output_dir), {'1', '2'})
+
+
+if __name__ == '__main__':
+    unittest.main()